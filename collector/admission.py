@@ -0,0 +1,267 @@
+#!/usr/bin/python
+#
+# Copyright 2015 The Cluster-Insight Authors. All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Admission control of concurrent operations, such as graph builds.
+
+AdmissionController limits the number of concurrent operations. The
+operations that exceed the limit wait in a bounded first-in first-out queue
+until an active operation finishes or their deadline passes.
+
+An operation is rejected at once with an OverloadError if the queue is full,
+or if its estimated waiting time plus its estimated duration would exceed
+its deadline, even if it could start at once. The estimates are based on
+the recent durations of the operations.
+
+The concurrency limit adapts to the observed durations by additive increase
+and multiplicative decrease: when the limit is reached and the operations
+are about as fast as the fastest recent operations, the limit grows by one
+per 'limit' operations. When the operations become much slower, the
+additional concurrency is not helping, and the limit decreases.
+
+This class is thread-safe.
+
+Usage:
+  controller = AdmissionController(1, 2, 8, 16)
+
+  with controller.admit(time.time() + 10):
+    do_operation()
+"""
+
+import collections
+import contextlib
+import math
+import threading
+import time
+
+# local imports
+import collector_error
+
+# The weight of the latest duration in the average duration of operations.
+DURATION_AVERAGE_WEIGHT = 0.2
+
+# The number of recent operations whose minimal duration is the reference
+# duration for adapting the concurrency limit.
+DURATION_WINDOW_SIZE = 50
+
+# Operations slower than this multiple of the reference duration decrease
+# the concurrency limit.
+DURATION_TOLERANCE = 2.0
+
+# The factor by which slow operations decrease the concurrency limit.
+LIMIT_DECREASE_FACTOR = 0.9
+
+
+class AdmissionController(object):
+  """Limits the concurrency of operations and queues the excess operations.
+
+  Attributes:
+    _lock: a lock protecting access to all other attributes.
+    _min_limit, _max_limit: the bounds of the concurrency limit.
+    _limit: the current concurrency limit. It is a float, and its integral
+      part is the number of operations that may be active.
+    _max_queue_size: the maximal number of waiting operations.
+    _active: the number of active operations.
+    _queue: a deque of the threading.Event objects of the waiting
+      operations. An Event is set when its operation is admitted.
+    _average_duration: the exponential moving average of the durations
+      of the operations, or None before the first operation finished.
+    _recent_durations: a deque of the durations of the recent operations.
+    _stats: a dictionary of the counters returned by get_stats().
+  """
+
+  def __init__(self, min_limit, initial_limit, max_limit, max_queue_size):
+    """Initializes the controller.
+
+    Args:
+      min_limit: the minimal concurrency limit.
+      initial_limit: the initial concurrency limit.
+      max_limit: the maximal concurrency limit.
+      max_queue_size: the maximal number of waiting operations.
+    """
+    assert isinstance(min_limit, int) and min_limit > 0
+    assert isinstance(initial_limit, int)
+    assert isinstance(max_limit, int)
+    assert min_limit <= initial_limit <= max_limit
+    assert isinstance(max_queue_size, int) and max_queue_size >= 0
+    self._lock = threading.Lock()
+    self._min_limit = min_limit
+    self._max_limit = max_limit
+    self._limit = float(initial_limit)
+    self._max_queue_size = max_queue_size
+    self._active = 0
+    self._queue = collections.deque()
+    self._average_duration = None
+    self._recent_durations = collections.deque(maxlen=DURATION_WINDOW_SIZE)
+    self._stats = {'admitted': 0, 'rejected_queue_full': 0,
+                   'rejected_deadline': 0, 'wait_seconds_total': 0.0,
+                   'wait_seconds_max': 0.0}
+
+  def _estimated_wait_seconds(self, position):
+    """Returns the estimated waiting time of a queued operation.
+
+    Must be called when '_lock' is held.
+
+    Args:
+      position: the number of operations that will be admitted before the
+        operation, including itself.
+    """
+    if self._average_duration is None:
+      return 0.0
+    return self._average_duration * position / int(self._limit)
+
+  def _reject(self, reason, position):
+    """Counts a rejected operation and returns an OverloadError.
+
+    Must be called when '_lock' is held.
+
+    Args:
+      reason: 'queue_full' or 'deadline'.
+      position: the position of the operation in the queue if it would have
+        waited.
+    """
+    self._stats['rejected_' + reason] += 1
+    retry_after = int(math.ceil(self._estimated_wait_seconds(position)))
+    return collector_error.OverloadError(
+        'the server is overloaded (%s)' % reason.replace('_', ' '),
+        max(retry_after, 1))
+
+  def _admit_waiting(self):
+    """Admits the waiting operations while the limit allows.
+
+    Must be called when '_lock' is held.
+    """
+    while self._queue and (self._active < int(self._limit)):
+      self._active += 1
+      self._queue.popleft().set()
+
+  def acquire(self, deadline):
+    """Waits until the operation is admitted.
+
+    Args:
+      deadline: the time (in seconds since the epoch) by which the
+        operation should finish.
+
+    Raises:
+      OverloadError: if the operation was rejected because the queue is full
+      or its deadline cannot be met.
+    """
+    assert isinstance(deadline, (int, float))
+    start_time = time.time()
+    with self._lock:
+      expected_duration = self._average_duration or 0.0
+      if (not self._queue) and (self._active < int(self._limit)):
+        if start_time + expected_duration > deadline:
+          raise self._reject('deadline', 1)
+        self._active += 1
+        self._stats['admitted'] += 1
+        return
+
+      position = len(self._queue) + 1
+      if len(self._queue) >= self._max_queue_size:
+        raise self._reject('queue_full', position)
+      if (start_time + self._estimated_wait_seconds(position) +
+          expected_duration > deadline):
+        raise self._reject('deadline', position)
+
+      admitted = threading.Event()
+      self._queue.append(admitted)
+
+    # Wait until the operation can still finish by its deadline.
+    admitted.wait(max(deadline - start_time - expected_duration, 0))
+    with self._lock:
+      if not admitted.is_set():
+        self._queue.remove(admitted)
+        raise self._reject('deadline', len(self._queue) + 1)
+
+      wait_seconds = time.time() - start_time
+      self._stats['admitted'] += 1
+      self._stats['wait_seconds_total'] += wait_seconds
+      self._stats['wait_seconds_max'] = max(
+          self._stats['wait_seconds_max'], wait_seconds)
+
+  def reject_expired(self):
+    """Counts an operation whose deadline passed before it was submitted.
+
+    For example, the operation waited for another operation that it depends
+    on.
+
+    Returns:
+    An OverloadError describing the rejection.
+    """
+    with self._lock:
+      return self._reject('deadline', len(self._queue) + 1)
+
+  def release(self, duration):
+    """Ends an admitted operation and adapts the concurrency limit.
+
+    Args:
+      duration: the duration of the operation in seconds.
+    """
+    assert isinstance(duration, float) and duration >= 0
+    with self._lock:
+      limit_reached = bool(self._queue) or (self._active >= int(self._limit))
+      self._active -= 1
+
+      if self._average_duration is None:
+        self._average_duration = duration
+      else:
+        self._average_duration += (
+            DURATION_AVERAGE_WEIGHT * (duration - self._average_duration))
+      self._recent_durations.append(duration)
+
+      if duration > DURATION_TOLERANCE * min(self._recent_durations):
+        self._limit = max(self._limit * LIMIT_DECREASE_FACTOR,
+                          self._min_limit)
+      elif limit_reached:
+        self._limit = min(self._limit + 1.0 / int(self._limit),
+                          self._max_limit)
+
+      self._admit_waiting()
+
+  @contextlib.contextmanager
+  def admit(self, deadline):
+    """A context manager running an operation once it is admitted.
+
+    Args:
+      deadline: the time (in seconds since the epoch) by which the
+        operation should finish.
+
+    Raises:
+      OverloadError: if the operation was rejected.
+    """
+    self.acquire(deadline)
+    start_time = time.time()
+    try:
+      yield
+    finally:
+      self.release(time.time() - start_time)
+
+  def get_stats(self):
+    """Returns the current state and the counters of the controller.
+
+    Returns:
+    A dictionary containing the current concurrency limit, the numbers of
+    active and waiting operations, the average duration of the operations,
+    the numbers of admitted and rejected operations, and the total and
+    maximal waiting times of the admitted operations.
+    """
+    with self._lock:
+      stats = dict(self._stats)
+      stats['limit'] = int(self._limit)
+      stats['active'] = self._active
+      stats['queued'] = len(self._queue)
+      stats['average_duration_seconds'] = self._average_duration
+      return stats
@@ -0,0 +1,137 @@
+#!/usr/bin/python
+#
+# Copyright 2015 The Cluster-Insight Authors. All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for collector/admission.py."""
+
+import threading
+import time
+import unittest
+
+# local imports
+import admission
+import collector_error
+
+
+class TestAdmissionController(unittest.TestCase):
+
+  def acquire_in_thread(self, controller, deadline):
+    """Calls controller.acquire() in a new thread.
+
+    Returns:
+    The thread and a list that will contain the exception raised by
+    acquire() or None if the operation was admitted.
+    """
+    results = []
+
+    def acquire():
+      try:
+        controller.acquire(deadline)
+        results.append(None)
+      except collector_error.OverloadError as e:
+        results.append(e)
+
+    t = threading.Thread(target=acquire)
+    t.start()
+    return t, results
+
+  def wait_for_queued(self, controller, n):
+    """Waits until 'n' operations are waiting in the queue."""
+    for _ in xrange(100):
+      if controller.get_stats()['queued'] == n:
+        return
+      time.sleep(0.01)
+    self.fail('%d operations were not queued' % n)
+
+  def test_queue(self):
+    """Tests that the excess operations wait in a bounded queue."""
+    controller = admission.AdmissionController(1, 1, 1, 1)
+    deadline = time.time() + 10
+    controller.acquire(deadline)
+
+    t, results = self.acquire_in_thread(controller, deadline)
+    self.wait_for_queued(controller, 1)
+    with self.assertRaises(collector_error.OverloadError) as cm:
+      controller.acquire(deadline)
+    self.assertEqual(1, cm.exception.retry_after)
+
+    controller.release(0.0)
+    t.join()
+    self.assertEqual([None], results)
+    stats = controller.get_stats()
+    self.assertEqual(1, stats['active'])
+    self.assertEqual(0, stats['queued'])
+    self.assertEqual(2, stats['admitted'])
+    self.assertEqual(1, stats['rejected_queue_full'])
+    self.assertTrue(stats['wait_seconds_max'] > 0)
+
+  def test_deadline(self):
+    """Tests that operations that cannot meet their deadline are rejected."""
+    controller = admission.AdmissionController(1, 1, 1, 10)
+    with controller.admit(time.time() + 10):
+      pass
+    controller.acquire(time.time() + 10)
+
+    # The queued operation times out.
+    t, results = self.acquire_in_thread(controller, time.time() + 0.1)
+    t.join()
+    self.assertTrue(isinstance(results[0], collector_error.OverloadError))
+    self.assertEqual(0, controller.get_stats()['queued'])
+
+    # An operation whose estimated wait exceeds its deadline is rejected at
+    # once.
+    controller.release(5.0)
+    controller.acquire(time.time() + 10)
+    with self.assertRaises(collector_error.OverloadError) as cm:
+      controller.acquire(time.time() + 1)
+    self.assertTrue(cm.exception.retry_after >= 1)
+    self.assertEqual(2, controller.get_stats()['rejected_deadline'])
+
+    # An operation that cannot meet its deadline is rejected even if it
+    # could start at once.
+    controller.release(1.0)
+    self.assertEqual(0, controller.get_stats()['active'])
+    self.assertRaises(collector_error.OverloadError,
+                      controller.acquire, time.time() + 0.5)
+    self.assertRaises(collector_error.OverloadError,
+                      controller.acquire, time.time() - 1)
+    self.assertTrue(isinstance(controller.reject_expired(),
+                               collector_error.OverloadError))
+    stats = controller.get_stats()
+    self.assertEqual(5, stats['rejected_deadline'])
+    self.assertEqual(0, stats['active'])
+
+  def test_adaptive_limit(self):
+    """Tests that the concurrency limit adapts to the durations."""
+    controller = admission.AdmissionController(1, 1, 3, 10)
+    deadline = time.time() + 10
+
+    # Fast operations at the limit increase the limit.
+    for _ in xrange(5):
+      for _ in xrange(controller.get_stats()['limit']):
+        controller.acquire(deadline)
+      for _ in xrange(controller.get_stats()['limit']):
+        controller.release(0.1)
+    self.assertEqual(3, controller.get_stats()['limit'])
+
+    # Slow operations decrease the limit.
+    for _ in xrange(20):
+      controller.acquire(deadline)
+      controller.release(1.0)
+    self.assertEqual(1, controller.get_stats()['limit'])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -21,7 +21,9 @@ Collects context metadata from the Kubernetes API and computes a graph from it.
 """
 
 import argparse
+import math
 import sys
+import time
 
 import flask
 from flask_cors import CORS
@@ -32,6 +34,11 @@ import constants
 import context
 import global_state
 import kubernetes
+import monitoring
+import msgpack_format
+import profiling
+import serving
+import tracing
 import utilities
 
 app = flask.Flask(__name__)
@@ -39,43 +46,378 @@ app = flask.Flask(__name__)
 # enable cross-origin resource sharing (CORS) HTTP headers on all routes
 cors = CORS(app)
 
+# The query parameters that select a page of '/cluster/resources'.
+RESOURCES_PAGE_PARAMETERS = ('type', 'namespace', 'selector', 'limit',
+                             'continue')
 
-def return_elapsed(gs):
+
+def get_projection():
+  """Returns the projection requested by the 'fields' query parameter.
+
+  The value of 'fields' is either a comma-separated list of attribute paths
+  (see utilities.parse_fields()) or the name of a profile in
+  constants.FIELDS_PROFILES, such as 'compact'.
+
+  Returns:
+  The projection or None if the request has no 'fields' parameter.
+
+  Raises:
+    CollectorError: if the value of 'fields' is invalid.
+  """
+  fields = flask.request.args.get('fields')
+  if fields is None:
+    return None
+
+  return utilities.parse_fields(constants.FIELDS_PROFILES.get(fields, fields))
+
+
+def get_encoding():
+  """Returns the encoding of the response requested by the client.
+
+  The 'format' query parameter selects the encoding explicitly. Otherwise
+  the encoding is selected by the 'Accept' header, and the default is JSON.
+
+  Returns:
+  Either 'json' or 'msgpack' (see msgpack_format).
+
+  Raises:
+    CollectorError: if the value of 'format' is invalid.
+  """
+  encoding = flask.request.args.get('format')
+  if encoding is None:
+    best = flask.request.accept_mimetypes.best_match(
+        ['application/json', msgpack_format.MIMETYPE],
+        default='application/json')
+    return 'msgpack' if best == msgpack_format.MIMETYPE else 'json'
+
+  if encoding not in ('json', 'msgpack'):
+    raise collector_error.CollectorError('invalid "format" parameter')
+  return encoding
+
+
+def request_endpoint():
+  """Returns the route of the current request for labeling its metrics.
+
+  Labeling the requests by their routes rather than their URLs keeps the
+  number of distinct labels small. Requests that match no route are labeled
+  'other'.
+  """
+  rule = flask.request.url_rule
+  return 'other' if rule is None else rule.rule
+
+
+@app.before_request
+def start_request():
+  """Starts the timer and the trace of the current request.
+
+  Long-lived streaming requests are not traced, because their traces would
+  grow without bound.
+  """
+  flask.g.request_start_time = time.time()
+  if flask.request.path not in constants.STREAMING_PATHS:
+    tracing.start_trace('%s %s' % (flask.request.method, flask.request.path))
+
+
+@app.after_request
+def record_request(response):
+  """Records the latency and the status code of the current request.
+
+  The latency ends when the response is returned to the web server, so it
+  excludes sending the response and generating streamed responses.
+  """
+  gs = app.context_graph_global_state
+  endpoint = request_endpoint()
+  gs.get_monitoring().request_seconds.observe_since(
+      (endpoint,), flask.g.request_start_time)
+  gs.get_monitoring().requests.inc((endpoint, str(response.status_code)))
+
+  trace = tracing.current_trace()
+  if trace is not None:
+    trace.attributes['status_code'] = response.status_code
+    response.headers['X-Trace-Id'] = trace.trace_id
+  return response
+
+
+@app.teardown_request
+def end_request(exc):
+  """Ends the trace of the current request.
+
+  The trace is kept for '/traces' and exported only if it contains spans,
+  so requests that do no traced work, such as health checks, are omitted.
+  The trace of a streamed response is recorded when the body ends (see
+  _TracedBody), so it includes the serialization of the body.
+  Also counts the requests that failed with an unhandled exception, both
+  as requests and as errors.
+  """
+  gs = app.context_graph_global_state
+  if exc is not None:
+    gs.get_monitoring().requests.inc((request_endpoint(), '500'))
+    gs.get_monitoring().request_errors.inc((request_endpoint(),))
+
+  trace = tracing.end_trace()
+  if trace is None:
+    return
+  if exc is not None:
+    trace.attributes['status_code'] = 500
+  elif getattr(flask.g, 'streamed_trace', None) is trace:
+    # The streamed response body records the trace (see _TracedBody).
+    return
+  record_trace(gs, trace)
+
+
+def record_trace(gs, trace):
+  """Keeps and exports the finished trace if it contains spans."""
+  if not trace.get_spans():
+    return
+  try:
+    gs.record_trace(trace)
+  except Exception:
+    app.logger.exception('exporting trace %s failed', trace.trace_id)
+
+
+class _TracedBody(object):
+  """A streamed response body that records the trace of its request.
+
+  The body is generated after the trace of the request ended, so
+  end_request() does not record the trace. The body records it when its
+  generation ends or the web server closes it, whichever comes first, so
+  the trace includes the spans of the generation.
+  """
+
+  def __init__(self, gs, trace, chunks):
+    self._gs = gs
+    self._trace = trace
+    self._chunks = chunks
+
+  def __iter__(self):
+    try:
+      for chunk in self._chunks:
+        yield chunk
+    finally:
+      self.close()
+
+  def close(self):
+    if hasattr(self._chunks, 'close'):
+      self._chunks.close()
+    trace, self._trace = self._trace, None
+    if trace is not None:
+      record_trace(self._gs, trace)
+
+
+def traced_json_body(gs, chunks):
+  """Returns a streamed JSON response body that is traced.
+
+  The generation of 'chunks' is recorded as the 'serialize' span of the
+  current trace, which is recorded when the body ends (see _TracedBody).
+
+  Args:
+    gs: global state.
+    chunks: an iterable of the chunks of the body.
+
+  Returns:
+  An iterable of the chunks of the body.
+  """
+  trace = tracing.current_trace()
+  if trace is None:
+    return chunks
+  flask.g.streamed_trace = trace
+  return _TracedBody(
+      gs, trace, tracing.iter_span('serialize', chunks, {'encoding': 'json'}))
+
+
+def error_response(e):
+  """Returns a Flask response describing the error 'e'.
+
+  Args:
+    e: a CollectorError.
+
+  Returns:
+  An error response. If the server is overloaded, the HTTP status is
+  '503 Service Unavailable' and the 'Retry-After' header tells the client
+  when to retry.
+  """
+  assert isinstance(e, collector_error.CollectorError)
+  if not isinstance(e, collector_error.OverloadError):
+    return error_message_response(str(e))
+  response = error_message_response(str(e), 503)
+  response.headers['Retry-After'] = str(e.retry_after)
+  return response
+
+
+def error_message_response(msg, status_code=200):
+  """Returns a Flask response describing an error and counts the error.
+
+  Every error response is made by this function, so the 'request_errors'
+  counter (see monitoring.Monitoring) counts all of them.
+
+  Args:
+    msg: the error message.
+    status_code: the HTTP status code of the response.
+
+  Returns:
+  An error response.
+  """
+  assert utilities.valid_string(msg)
+  assert isinstance(status_code, int)
+  gs = app.context_graph_global_state
+  gs.get_monitoring().request_errors.inc((request_endpoint(),))
+  response = flask.jsonify(utilities.make_error(msg))
+  response.status_code = status_code
+  return response
+
+
+def encoded_response(response, encoding):
+  """Returns a Flask response containing 'response' in the given encoding.
+
+  Args:
+    response: a response dictionary.
+    encoding: either 'json' or 'msgpack'.
+
+  Returns:
+  A Flask response.
+  """
+  with tracing.span('serialize', {'encoding': encoding}):
+    if encoding == 'msgpack':
+      result = flask.Response(msgpack_format.pack(response),
+                              mimetype=msgpack_format.MIMETYPE)
+    else:
+      result = flask.jsonify(response)
+  result.vary.add('Accept')
+  return result
+
+
+def requested_graph(gs):
+  """Returns the context graph for a '/cluster' or '/cluster/resources' request.
+
+  A conditional request (with an 'If-None-Match' header) is answered from a
+  recently built graph (see context.get_recent_graph()), so a client whose
+  copy is up to date gets '304 Not Modified' without a new graph build.
+  Other requests build the graph from the current data.
+
+  Args:
+    gs: global state.
+
+  Returns:
+  The published context graph.
+
+  Raises:
+    CollectorError: inconsistent or invalid graph data.
+    OverloadError: if the server is too busy to build the graph in time.
+  """
+  if flask.request.if_none_match:
+    return context.get_recent_graph(gs)
+  return context.build_graph(gs)
+
+
+def graph_response(gs, g, output_format, projection, encoding):
+  """Returns the response containing the given output of a context graph.
+
+  The response carries a strong entity tag (ETag) identifying the graph
+  version. If the request's 'If-None-Match' header matches it, the response
+  is '304 Not Modified' without a body. If the client accepts gzip, the body
+  is the cached compressed output of the graph. If the client requested
+  the 'msgpack' encoding, the body is the cached packed output of the
+  graph. Otherwise the body is streamed in chunks, so the entire output is
+  never kept in memory.
+
+  Args:
+    gs: global state.
+    g: the published context graph.
+    output_format: either 'context_graph' or 'resources'.
+    projection: the projection of the resources (see
+      utilities.parse_fields()) or None.
+    encoding: either 'json' or 'msgpack'.
+
+  Returns:
+  A Flask response.
+  """
+  if encoding == 'msgpack':
+    if projection is not None:
+      return encoded_response(utilities.project_response(
+          g.dump(output_format), projection), encoding)
+    etag = '%s-msgpack' % gs.get_etag(g)
+    if flask.request.if_none_match.contains_weak(etag):
+      response = flask.Response(status=304)
+    else:
+      with tracing.span('serialize', {'encoding': 'msgpack'}):
+        response = flask.Response(g.dump_packed(output_format),
+                                  mimetype=msgpack_format.MIMETYPE)
+    response.set_etag(etag)
+    response.vary.add('Accept')
+    return response
+
+  compressed = ((projection is None) and
+                flask.request.accept_encodings['gzip'] > 0)
+  etag = gs.get_etag(g)
+  if compressed:
+    # The compressed and uncompressed representations must have different
+    # strong entity tags.
+    etag += '-gzip'
+
+  if flask.request.if_none_match.contains_weak(etag):
+    response = flask.Response(status=304)
+  elif compressed:
+    with tracing.span('serialize', {'encoding': 'gzip'}):
+      response = flask.Response(g.dump_compressed(output_format),
+                                mimetype='application/json')
+    response.headers['Content-Encoding'] = 'gzip'
+  elif projection is None:
+    # The JSON output is generated as it is streamed, after the request's
+    # trace ends, and the body records its 'serialize' span.
+    response = flask.Response(
+        traced_json_body(gs, g.iter_json(g.dump(output_format))),
+        mimetype='application/json')
+  else:
+    with tracing.span('serialize', {'encoding': 'json'}):
+      response = flask.jsonify(utilities.project_response(
+          g.dump(output_format), projection))
+
+  response.set_etag(etag)
+  response.vary.add('Accept')
+  response.vary.add('Accept-Encoding')
+  return response
+
+
+def return_elapsed(gs, since):
   """Returns a description of the elapsed time of recent operations.
 
   Args:
     gs: global state.
+    since: the sequence number of the first elapsed time record.
 
   Returns:
   A dictionary containing the count, minimum elapsed time,
-  maximum elapsed time, average elapsed time, and list of elapsed time
-  records.
+  maximum elapsed time, average elapsed time, percentiles of the elapsed
+  times (see constants.ELAPSED_PERCENTILES), and list of the elapsed time
+  records since 'since'. The attribute 'next' is the value of 'since' for
+  reading only the newer records, and 'missed' is the number of records
+  since 'since' that were discarded before they were read.
   """
   assert isinstance(gs, global_state.GlobalState)
-  elapsed_list = []
-  elapsed_sum = 0.0
-  elapsed_min = None
-  elapsed_max = None
-  for elapsed_record in gs.get_elapsed():
-    duration = elapsed_record.elapsed_seconds
-    elapsed_list.append(
-        {'start_time': utilities.seconds_to_timestamp(
-            elapsed_record.start_time),
-         'what': elapsed_record.what,
-         'threadIdentifier': elapsed_record.thread_identifier,
-         'elapsed_seconds': duration})
-    elapsed_sum += duration
-    if (elapsed_min is None) or (elapsed_max is None):
-      elapsed_min = duration
-      elapsed_max = duration
-    else:
-      elapsed_min = min(elapsed_min, duration)
-      elapsed_max = max(elapsed_max, duration)
-
-  return {'count': len(elapsed_list),
-          'min': elapsed_min,
-          'max': elapsed_max,
-          'average': elapsed_sum / len(elapsed_list) if elapsed_list else None,
+  records, start, end = gs.get_elapsed(since)
+  elapsed_list = [
+      {'start_time': utilities.seconds_to_timestamp(
+          elapsed_record.start_time),
+       'what': elapsed_record.what,
+       'threadIdentifier': elapsed_record.thread_identifier,
+       'elapsed_seconds': elapsed_record.elapsed_seconds}
+      for elapsed_record in records]
+
+  # The nearest-rank percentiles of the elapsed times.
+  durations = sorted(r.elapsed_seconds for r in records)
+  percentiles = {}
+  for p in constants.ELAPSED_PERCENTILES:
+    percentiles['p%d' % p] = (
+        durations[max(int(math.ceil(p * len(durations) / 100.0)) - 1, 0)]
+        if durations else None)
+
+  return {'count': len(durations),
+          'min': durations[0] if durations else None,
+          'max': durations[-1] if durations else None,
+          'average': sum(durations) / len(durations) if durations else None,
+          'percentiles': percentiles,
+          'next': end,
+          'missed': start - since if since < start else 0,
           'items': elapsed_list}
 
 
@@ -98,11 +440,16 @@ def get_nodes():
   """
   gs = app.context_graph_global_state
   try:
+    projection = get_projection()
+    encoding = get_encoding()
     nodes_list = kubernetes.get_nodes_with_metrics(gs)
   except collector_error.CollectorError as e:
-    return flask.jsonify(utilities.make_error(str(e)))
+    return error_response(e)
 
-  return flask.jsonify(utilities.make_response(nodes_list, 'resources'))
+  return encoded_response(
+      utilities.project_response(
+          utilities.make_response(nodes_list, 'resources'), projection),
+      encoding)
 
 
 @app.route('/cluster/resources/services', methods=['GET'])
@@ -114,11 +461,16 @@ def get_services():
   """
   gs = app.context_graph_global_state
   try:
+    projection = get_projection()
+    encoding = get_encoding()
     services_list = kubernetes.get_services(gs)
   except collector_error.CollectorError as e:
-    return flask.jsonify(utilities.make_error(str(e)))
+    return error_response(e)
 
-  return flask.jsonify(utilities.make_response(services_list, 'resources'))
+  return encoded_response(
+      utilities.project_response(
+          utilities.make_response(services_list, 'resources'), projection),
+      encoding)
 
 
 @app.route('/cluster/resources/rcontrollers', methods=['GET'])
@@ -130,11 +482,16 @@ def get_rcontrollers():
   """
   gs = app.context_graph_global_state
   try:
+    projection = get_projection()
+    encoding = get_encoding()
     rcontrollers_list = kubernetes.get_rcontrollers(gs)
   except collector_error.CollectorError as e:
-    return flask.jsonify(utilities.make_error(str(e)))
+    return error_response(e)
 
-  return flask.jsonify(utilities.make_response(rcontrollers_list, 'resources'))
+  return encoded_response(
+      utilities.project_response(
+          utilities.make_response(rcontrollers_list, 'resources'), projection),
+      encoding)
 
 
 @app.route('/cluster/resources/pods', methods=['GET'])
@@ -146,40 +503,78 @@ def get_pods():
   """
   gs = app.context_graph_global_state
   try:
+    projection = get_projection()
+    encoding = get_encoding()
     pods_list = kubernetes.get_pods(gs)
   except collector_error.CollectorError as e:
-    return flask.jsonify(utilities.make_error(str(e)))
+    return error_response(e)
 
-  return flask.jsonify(utilities.make_response(pods_list, 'resources'))
+  return encoded_response(
+      utilities.project_response(
+          utilities.make_response(pods_list, 'resources'), projection),
+      encoding)
 
 
 @app.route('/debug', methods=['GET'])
 def get_debug():
   """Computes the response of the '/cluster/resources/debug' endpoint.
 
+  The optional query parameter 'detail' selects the level of detail of the
+  DOT graph. It is one of the keys of constants.DOT_DETAIL_LEVELS, such as
+  'nocontainers'. The default is 'full'.
+
   Returns:
-    The DOT graph depicting the context graph.
+    The DOT graph depicting the context graph. It is streamed in chunks.
   """
   gs = app.context_graph_global_state
+  detail = flask.request.args.get('detail', 'full')
+  if detail not in constants.DOT_DETAIL_LEVELS:
+    msg = 'invalid detail level: %s' % detail
+    app.logger.error(msg)
+    return error_message_response(msg)
+
   try:
-    return context.compute_graph(gs, 'dot')
+    g = context.build_graph(gs)
   except collector_error.CollectorError as e:
-    return flask.jsonify(utilities.make_error(str(e)))
+    return error_response(e)
+
+  return flask.Response(
+      g.iter_dot(omitted_types=constants.DOT_DETAIL_LEVELS[detail]))
 
 
 @app.route('/cluster/resources', methods=['GET'])
 def get_resources():
   """Computes the response of the '/cluster/resources' endpoint.
 
+  The optional query parameters 'type', 'namespace', 'selector' (of the form
+  'key1=value1,key2=value2'), 'limit' (the page size) and 'continue' (the
+  continuation token of the previous page) select a page of the matching
+  resources. See context.compute_resources_page() for details.
+
   Returns:
     The 'resources' section of the context graph.
   """
   gs = app.context_graph_global_state
+  args = flask.request.args
   try:
-    response = context.compute_graph(gs, 'resources')
-    return flask.jsonify(response)
+    projection = get_projection()
+    encoding = get_encoding()
+    if not any(name in args for name in RESOURCES_PAGE_PARAMETERS):
+      return graph_response(gs, requested_graph(gs), 'resources',
+                            projection, encoding)
+
+    try:
+      limit = int(args['limit']) if 'limit' in args else None
+    except ValueError:
+      return error_message_response('invalid "limit" parameter')
+
+    response = context.compute_resources_page(
+        gs, args.get('type'), args.get('namespace'), args.get('selector'),
+        limit, args.get('continue'))
+    return encoded_response(utilities.project_response(response, projection),
+                            encoding)
   except collector_error.CollectorError as e:
-    return flask.jsonify(utilities.make_error(str(e)))
+    return error_response(e)
 
 
 @app.route('/cluster', methods=['GET'])
@@ -191,27 +586,262 @@ def get_cluster():
   """
   gs = app.context_graph_global_state
   try:
-    response = context.compute_graph(gs, 'context_graph')
-    return flask.jsonify(response)
+    projection = get_projection()
+    encoding = get_encoding()
+    return graph_response(gs, requested_graph(gs), 'context_graph',
+                          projection, encoding)
   except collector_error.CollectorError as e:
-    return flask.jsonify(utilities.make_error(str(e)))
+    return error_response(e)
+
+
+@app.route('/cluster/subgraph', methods=['GET'])
+def get_subgraph():
+  """Computes the response of the '/cluster/subgraph' endpoint.
+
+  The query parameters are 'root' (the ID of the root resource; required),
+  'depth' (the maximal distance from the root; default is
+  constants.DEFAULT_SUBGRAPH_DEPTH, and at most constants.MAX_SUBGRAPH_DEPTH),
+  and 'direction' (one of 'out', 'in' or
+  'both'; default is 'out').
+
+  Returns:
+    The part of the context graph around the root resource.
+  """
+  gs = app.context_graph_global_state
+  root = flask.request.args.get('root')
+  if not utilities.valid_string(root):
+    return error_message_response('missing "root" parameter')
+
+  try:
+    depth = int(flask.request.args.get('depth',
+                                       constants.DEFAULT_SUBGRAPH_DEPTH))
+  except ValueError:
+    return error_message_response('invalid "depth" parameter')
+
+  direction = flask.request.args.get('direction', 'out')
+  try:
+    projection = get_projection()
+    encoding = get_encoding()
+    response = context.compute_subgraph(gs, root, depth, direction)
+    return encoded_response(utilities.project_response(response, projection),
+                            encoding)
+  except collector_error.CollectorError as e:
+    return error_response(e)
+
+
+@app.route('/cluster/changes', methods=['GET'])
+def get_changes():
+  """Computes the response of the '/cluster/changes' endpoint.
+
+  The query parameter 'since' is the graph version that the client has.
+  Every response of '/cluster' and '/cluster/changes' contains the current
+  graph version in its 'version' attribute.
+
+  Returns:
+    The resources and relations that were added, modified or removed since
+    the given version, or an error response with 'resync_required' set to
+    True if these changes are no longer available.
+  """
+  gs = app.context_graph_global_state
+  try:
+    since = int(flask.request.args.get('since'))
+  except (TypeError, ValueError):
+    return error_message_response('missing or invalid "since" parameter')
+
+  try:
+    projection = get_projection()
+    response = context.compute_changes(gs, since)
+    return flask.jsonify(utilities.project_response(response, projection))
+  except collector_error.CollectorError as e:
+    return error_response(e)
+
+
+@app.route('/cluster/stream', methods=['GET'])
+def get_stream():
+  """Computes the response of the '/cluster/stream' endpoint.
+
+  Returns:
+    A stream of server-sent events. The first event is a snapshot of the
+    context graph, and it is followed by the changes of the context graph
+    as they are detected. See context.stream_changes() for details.
+  """
+  gs = app.context_graph_global_state
+  try:
+    projection = get_projection()
+  except collector_error.CollectorError as e:
+    return error_response(e)
+
+  return flask.Response(
+      flask.stream_with_context(context.stream_changes(gs, projection)),
+      mimetype='text/event-stream')
 
 
 @app.route('/elapsed', methods=['GET'])
 def get_elapsed():
   """Computes the response of the '/elapsed' endpoint.
 
+  The optional query parameter 'since' is the value of the 'next' attribute
+  of a previous response. It selects the elapsed time records that were
+  recorded after that response.
+
   Returns:
   A successful response containing the list of elapsed time records of the
-  most recent Kubernetes API invocations since the previous call to the
-  '/elapsed' endpoint. Never returns more than constants.MAX_ELAPSED_QUEUE_SIZE
-  elapsed time records.
+  most recent Kubernetes API invocations and a summary of their elapsed
+  times (see return_elapsed()). Never returns more than
+  constants.MAX_ELAPSED_RECORDS elapsed time records. Reading the records
+  does not remove them.
   """
   gs = app.context_graph_global_state
-  result = return_elapsed(gs)
+  try:
+    since = int(flask.request.args.get('since', 0))
+    if since < 0:
+      raise ValueError(since)
+  except ValueError:
+    return error_message_response('invalid "since" parameter')
+
+  result = return_elapsed(gs, since)
   return flask.jsonify(utilities.make_response(result, 'elapsed'))
 
 
+@app.route('/traces', methods=['GET'])
+def get_traces():
+  """Computes the response of the '/traces' endpoint.
+
+  The optional query parameter 'since' is the value of the 'next' attribute
+  of a previous response. It selects the traces that were recorded after
+  that response.
+
+  Returns:
+  A successful response containing the most recent traces of requests
+  (see tracing.Trace.to_dict()), the attribute 'next' for reading only the
+  newer traces, and the number 'missed' of traces since 'since' that were
+  discarded before they were read. Never returns more than
+  constants.MAX_TRACES traces.
+  """
+  gs = app.context_graph_global_state
+  try:
+    since = int(flask.request.args.get('since', 0))
+    if since < 0:
+      raise ValueError(since)
+  except ValueError:
+    return error_message_response('invalid "since" parameter')
+
+  traces, start, end = gs.get_traces(since)
+  result = {'count': len(traces),
+            'next': end,
+            'missed': start - since if since < start else 0,
+            'items': [trace.to_dict() for trace in traces]}
+  return flask.jsonify(utilities.make_response(result, 'traces'))
+
+
+@app.route('/profile', methods=['GET'])
+def get_profile():
+  """Computes the response of the '/profile' endpoint.
+
+  Profiles the next context graph builds (see profiling.Profiler). The
+  request must carry the token given by the '--profiling-token' flag in the
+  'X-Profiling-Token' header. The optional query parameters are:
+  - 'mode': 'sample' (the default) or 'cprofile'.
+  - 'builds': the number of builds to profile, at most
+    constants.MAX_PROFILED_BUILDS. The default is
+    constants.DEFAULT_PROFILED_BUILDS.
+  - 'seconds': the maximal duration of the profiling, at most
+    constants.MAX_PROFILE_SECONDS. The default is
+    constants.DEFAULT_PROFILE_SECONDS.
+
+  Returns:
+  The profile as text, either collapsed stacks or cProfile statistics. The
+  'X-Profiled-Builds' header contains the number of profiled builds.
+  The HTTP status is '404 Not Found' if profiling is disabled and
+  '403 Forbidden' if the token is missing or wrong.
+  """
+  gs = app.context_graph_global_state
+  profiler = gs.get_profiler()
+  if not profiler.is_enabled():
+    return error_message_response('profiling is disabled', 404)
+  if not profiler.check_token(
+      flask.request.headers.get('X-Profiling-Token')):
+    return error_message_response('invalid profiling token', 403)
+
+  args = flask.request.args
+  mode = args.get('mode', 'sample')
+  if mode not in profiling.PROFILE_MODES:
+    return error_message_response('invalid "mode" parameter')
+  try:
+    max_builds = int(args.get('builds', constants.DEFAULT_PROFILED_BUILDS))
+    if not 0 < max_builds <= constants.MAX_PROFILED_BUILDS:
+      raise ValueError(max_builds)
+  except ValueError:
+    return error_message_response('invalid "builds" parameter')
+  try:
+    seconds = float(args.get('seconds', constants.DEFAULT_PROFILE_SECONDS))
+    if not 0 < seconds <= constants.MAX_PROFILE_SECONDS:
+      raise ValueError(seconds)
+  except ValueError:
+    return error_message_response('invalid "seconds" parameter')
+
+  try:
+    text, builds = profiler.profile(mode, max_builds, seconds)
+  except collector_error.CollectorError as e:
+    return error_response(e)
+
+  response = flask.Response(text, content_type='text/plain; charset=utf-8')
+  response.headers['X-Profiled-Builds'] = str(builds)
+  return response
+
+
+@app.route('/admission', methods=['GET'])
+def get_admission():
+  """Computes the response of the '/admission' endpoint.
+
+  Returns:
+  A successful response containing the state and the counters of the
+  admission control of context graph builds. See
+  admission.AdmissionController.get_stats() for details.
+  """
+  gs = app.context_graph_global_state
+  stats = gs.get_admission_controller().get_stats()
+  return flask.jsonify(utilities.make_response(stats, 'admission'))
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+  """Computes the response of the '/metrics' endpoint.
+
+  Returns:
+  The latency histograms and the counters of the data collector (see
+  monitoring.Monitoring) and the state of the admission control of context
+  graph builds, in the Prometheus text exposition format.
+  """
+  gs = app.context_graph_global_state
+  stats = gs.get_admission_controller().get_stats()
+  admission_metrics = [
+      monitoring.format_samples(
+          'collector_admission_' + name, help_text, 'gauge',
+          [('', [], stats[name])])
+      for name, help_text in (
+          ('limit', 'Concurrency limit of context graph builds.'),
+          ('active', 'Number of active context graph builds.'),
+          ('queued', 'Number of requests waiting to build a context graph.'))]
+  admission_metrics.append(monitoring.format_samples(
+      'collector_admission_admitted_total',
+      'Number of admitted context graph builds.', 'counter',
+      [('', [], stats['admitted'])]))
+  admission_metrics.append(monitoring.format_samples(
+      'collector_admission_rejected_total',
+      'Number of rejected context graph builds.', 'counter',
+      [('', [('reason', reason)], stats['rejected_' + reason])
+       for reason in ('queue_full', 'deadline')]))
+  admission_metrics.append(monitoring.format_samples(
+      'collector_admission_wait_seconds_total',
+      'Total waiting time of the admitted context graph builds.', 'counter',
+      [('', [], stats['wait_seconds_total'])]))
+
+  return flask.Response(
+      gs.get_monitoring().render() + ''.join(admission_metrics),
+      content_type=monitoring.CONTENT_TYPE)
+
+
 @app.route('/healthz', methods=['GET'])
 def get_health():
   """Computes the response of the '/healthz' endpoint.
@@ -233,13 +863,48 @@ def main():
   parser.add_argument('-p', '--port', action='store', type=int,
                       default=constants.DATA_COLLECTOR_PORT,
                       help='data collector port number [default=%(default)d]')
+  parser.add_argument('--build-processes', action='store', type=int,
+                      default=constants.DEFAULT_BUILD_PROCESSES,
+                      help=('number of worker processes for building the '
+                            'context graph; zero builds it serially '
+                            '[default=%(default)d]'))
+  parser.add_argument('--threads', action='store', type=int,
+                      default=constants.DEFAULT_SERVER_THREADS,
+                      help=('number of worker threads of the web server; '
+                            'zero selects the Flask development server '
+                            '[default=%(default)d]'))
+  parser.add_argument('--priority-threads', action='store', type=int,
+                      default=constants.DEFAULT_PRIORITY_SERVER_THREADS,
+                      help=('number of worker threads reserved for health '
+                            'and statistics requests [default=%(default)d]'))
+  parser.add_argument('--trace-file', action='store', type=str,
+                      help=('append the traces of requests to this file as '
+                            'JSON lines'))
+  parser.add_argument('--profiling-token', action='store', type=str,
+                      help=('enable the \'/profile\' endpoint for requests '
+                            'carrying this token in the X-Profiling-Token '
+                            'header [default=disabled]'))
   args = parser.parse_args()
 
   g_state = global_state.GlobalState()
   g_state.init_caches_and_synchronization()
+  g_state.init_build_pool(args.build_processes)
+  if args.trace_file:
+    g_state.add_trace_exporter(tracing.FileExporter(args.trace_file))
+  g_state.get_profiler().set_token(args.profiling_token)
   app.context_graph_global_state = g_state
 
-  app.run(host=args.host, port=args.port, debug=args.debug)
+  if args.debug or (args.threads <= 0):
+    # Serve each request in its own thread, so long-lived '/cluster/stream'
+    # responses do not block other requests.
+    app.run(host=args.host, port=args.port, debug=args.debug, threaded=True)
+    return
+
+  server = serving.PooledWSGIServer(
+      args.host, args.port, app, args.threads,
+      max(args.priority_threads, 1), constants.PRIORITY_PATHS,
+      constants.STREAMING_PATHS)
+  server.serve_forever()
 
 
 if __name__ == '__main__':
@@ -40,3 +40,15 @@ class CollectorError(Exception):
 
   def __str__(self):
     return repr(self._message)
+
+
+class OverloadError(CollectorError):
+  """Raised when an operation is rejected because the server is overloaded.
+
+  The client should retry the request after 'retry_after' seconds.
+  """
+
+  def __init__(self, message, retry_after):
+    CollectorError.__init__(self, message)
+    assert isinstance(retry_after, int) and retry_after > 0
+    self.retry_after = retry_after
@@ -17,22 +17,31 @@
 """Tests for collector/collector.py."""
 
 # global imports
+import cStringIO
+import gzip
 import json
 import os
 import re
+import thread
+import threading
 import time
 import types
 import unittest
 
 # local imports
 import collector
+import constants
+import context
 import global_state
+import kubernetes
+import metrics
+import msgpack_format
 import utilities
 
 
 # A regular expression that matches the 'timestamp' attribute and value
 # in JSON data.
-TIMESTAMP_REGEXP = r'"timestamp": "[-0-9:.TZ]+"'
+TIMESTAMP_REGEXP = r'"timestamp": ?"[-0-9:.TZ]+"'
 
 
 class TestCollector(unittest.TestCase):
@@ -206,6 +215,84 @@ class TestCollector(unittest.TestCase):
     self.assertTrue(utilities.valid_string(result.get('timestamp')))
     self.assertTrue(start_time <= result['timestamp'] <= end_time)
 
+  def test_resources_page(self):
+    """Test the filters and pages of the '/resources' endpoint."""
+    ret_value = self.app.get('/cluster/resources?type=Pod')
+    result = json.loads(ret_value.data)
+    self.assertTrue(result.get('success'))
+    self.assertEqual(14, self.count_resources(result, 'Pod'))
+    self.assertEqual(14, len(result['resources']))
+    self.assertFalse('continue' in result)
+
+    ret_value = self.app.get(
+        '/cluster/resources?type=Container&namespace=default')
+    result = json.loads(ret_value.data)
+    self.assertEqual(16, len(result['resources']))
+
+    ret_value = self.app.get('/cluster/resources?selector=name=guestbook')
+    result = json.loads(ret_value.data)
+    self.assertEqual(5, len(result['resources']))
+    for r in result['resources']:
+      self.assertEqual('guestbook',
+                       r['properties']['metadata']['labels']['name'])
+
+    # Read all pods in pages of 4 pods.
+    ids = []
+    token = None
+    for _ in range(4):
+      url = '/cluster/resources?type=Pod&limit=4'
+      if token is not None:
+        url += '&continue=' + token
+      result = json.loads(self.app.get(url).data)
+      self.assertTrue(result.get('success'))
+      self.assertTrue(len(result['resources']) <= 4)
+      ids.extend([r['id'] for r in result['resources']])
+      token = result.get('continue')
+      if token is None:
+        break
+
+    self.assertTrue(token is None)
+    self.assertEqual(14, len(ids))
+    self.assertEqual(sorted(ids), ids)
+
+    # Invalid requests.
+    for query in ['limit=0', 'limit=x', 'continue=abc', 'selector=name',
+                  'type=', 'namespace=']:
+      ret_value = self.app.get('/cluster/resources?' + query)
+      result = json.loads(ret_value.data)
+      self.assertFalse(result.get('success'))
+
+  def test_fields(self):
+    """Test the 'fields' parameter of the resource and graph endpoints."""
+    ret_value = self.app.get('/cluster?fields=id,properties.metadata.name')
+    result = json.loads(ret_value.data)
+    self.assertTrue(result.get('success'))
+    self.assertEqual(55, len(result['resources']))
+    self.assertEqual(73, len(result['relations']))
+    for r in result['resources']:
+      self.assertEqual(['id', 'properties'], sorted(r.keys()))
+      self.assertTrue(set(r['properties'].keys()) <= set(['metadata']))
+
+    ret_value = self.app.get('/cluster/resources/pods?fields=compact')
+    result = json.loads(ret_value.data)
+    self.assertEqual(14, len(result['resources']))
+    for r in result['resources']:
+      self.assertEqual(['annotations', 'id', 'properties', 'timestamp',
+                        'type'], sorted(r.keys()))
+      self.assertEqual(['label'], r['annotations'].keys())
+      self.assertEqual(['metadata', 'status'], sorted(r['properties'].keys()))
+      self.assertEqual(['phase'], r['properties']['status'].keys())
+
+    ret_value = self.app.get('/cluster/changes?since=0&fields=id')
+    result = json.loads(ret_value.data)
+    self.assertEqual(55, len(result['resources']['added']))
+    for r in result['resources']['added']:
+      self.assertEqual(['id'], r.keys())
+
+    ret_value = self.app.get('/cluster/resources?fields=id..name')
+    result = json.loads(ret_value.data)
+    self.assertFalse(result.get('success'))
+
   def test_cluster(self):
     """Test the '/cluster' endpoint."""
     start_time = utilities.now()
@@ -274,7 +361,7 @@ class TestCollector(unittest.TestCase):
     self.assertTrue(len(nodes) >= 1)
     self.assertTrue(utilities.is_wrapped_object(nodes[0], 'Node'))
     nodes[0]['properties']['newAttribute123'] = 'the quick brown fox jumps over'
-    nodes[0]['timestamp'] = utilities.now()
+    nodes[0]['timestamp'] = time.time()
     gs.get_nodes_cache().update('', nodes)
     timestamp_after_update = utilities.now()
     _, timestamp_seconds = gs.get_nodes_cache().lookup('')
@@ -305,11 +392,755 @@ class TestCollector(unittest.TestCase):
     """Test the '/debug' endpoint."""
     ret_value = self.app.get('/debug')
     self.compare_to_golden(ret_value.data, 'debug')
+    self.assertEqual(ret_value.data, self.app.get('/debug?detail=full').data)
+
+    # Omit the containers and images together with their relations.
+    ret_value = self.app.get('/debug?detail=nocontainers')
+    self.assertTrue(ret_value.data.startswith('digraph{'))
+    self.assertTrue(ret_value.data.endswith('}'))
+    self.assertTrue('Pod:' in ret_value.data)
+    self.assertFalse('Container:' in ret_value.data)
+    self.assertFalse('Image:' in ret_value.data)
+    self.assertFalse('"Container:' in ret_value.data)
+
+    result = json.loads(self.app.get('/debug?detail=none').data)
+    self.assertFalse(result.get('success'))
+
+  def test_subgraph(self):
+    """Test the '/cluster/subgraph' endpoint."""
+    start_time = utilities.now()
+    # The pods running on a node.
+    ret_value = self.app.get(
+        '/cluster/subgraph?root=Node:k8s-guestbook-node-1')
+    result = json.loads(ret_value.data)
+    self.assertTrue(result.get('success'))
+    self.assertEqual(1, self.count_resources(result, 'Node'))
+    self.assertEqual(4, self.count_resources(result, 'Pod'))
+    self.assertEqual(4, self.count_relations(result, 'runs', 'Node', 'Pod'))
+    self.assertEqual(4, len(result['relations']))
+
+    # The node and its parent cluster.
+    ret_value = self.app.get(
+        '/cluster/subgraph?root=Node:k8s-guestbook-node-1&direction=in')
+    result = json.loads(ret_value.data)
+    self.assertEqual(1, self.count_resources(result, 'Cluster'))
+    self.assertEqual(1, self.count_resources(result, 'Node'))
+    self.assertEqual(1, self.count_relations(result, 'contains'))
+
+    # The entire graph is reachable from the cluster.
+    ret_value = self.app.get(
+        '/cluster/subgraph?root=Cluster:_unknown_&depth=10')
+    result = json.loads(ret_value.data)
+    self.verify_resources(result, start_time, utilities.now())
+    self.assertEqual(73, len(result['relations']))
+
+    # Invalid requests.
+    for query in ['', 'root=Node:unknown', 'root=Cluster:_unknown_&depth=x',
+                  'root=Cluster:_unknown_&depth=-1',
+                  'root=Cluster:_unknown_&depth=100000000',
+                  'root=Cluster:_unknown_&direction=up']:
+      ret_value = self.app.get('/cluster/subgraph?' + query)
+      result = json.loads(ret_value.data)
+      self.assertFalse(result.get('success'))
+      self.assertTrue(utilities.valid_string(result.get('error_message')))
+
+  def test_changes(self):
+    """Test the '/cluster/changes' endpoint."""
+    result = json.loads(self.app.get('/cluster').data)
+    self.assertEqual(1, result.get('version'))
+
+    # The first version adds the entire graph.
+    ret_value = self.app.get('/cluster/changes?since=0')
+    result = json.loads(ret_value.data)
+    self.assertTrue(result.get('success'))
+    self.assertEqual(1, result['version'])
+    self.assertEqual(55, len(result['resources']['added']))
+    self.assertEqual(73, len(result['relations']['added']))
+
+    # Building an identical graph does not change the version, and the
+    # previously published graph is kept.
+    gs = collector.app.context_graph_global_state
+    published_graph, _ = gs.get_context_graph()
+    result = json.loads(self.app.get('/cluster').data)
+    self.assertEqual(1, result.get('version'))
+    self.assertTrue(gs.get_context_graph()[0] is published_graph)
+    ret_value = self.app.get('/cluster/changes?since=1')
+    result = json.loads(ret_value.data)
+    self.assertTrue(result.get('success'))
+    self.assertEqual(1, result['version'])
+    for changes in (result['resources'], result['relations']):
+      self.assertEqual({'added': [], 'modified': [], 'removed': []}, changes)
+
+    # Modify a node.
+    nodes, _ = gs.get_nodes_cache().lookup('')
+    nodes[0]['properties']['newAttribute123'] = 'the quick brown fox jumps over'
+    nodes[0]['timestamp'] = time.time()
+    gs.get_nodes_cache().update('', nodes)
+    result = json.loads(self.app.get('/cluster').data)
+    self.assertEqual(2, result.get('version'))
+
+    ret_value = self.app.get('/cluster/changes?since=1')
+    result = json.loads(ret_value.data)
+    self.assertTrue(result.get('success'))
+    self.assertEqual(2, result['version'])
+    self.assertEqual([], result['resources']['added'])
+    self.assertEqual([], result['resources']['removed'])
+    self.assertEqual(1, len(result['resources']['modified']))
+    self.assertEqual('Node:' + nodes[0]['id'],
+                     result['resources']['modified'][0]['id'])
+
+    # The changes since version 0 are merged: all items are added.
+    ret_value = self.app.get('/cluster/changes?since=0')
+    result = json.loads(ret_value.data)
+    self.assertEqual(55, len(result['resources']['added']))
+    self.assertEqual([], result['resources']['modified'])
+
+    # A version from the future requires a resync.
+    ret_value = self.app.get('/cluster/changes?since=3')
+    result = json.loads(ret_value.data)
+    self.assertFalse(result.get('success'))
+    self.assertTrue(result.get('resync_required'))
+    self.assertEqual(2, result.get('version'))
+
+    ret_value = self.app.get('/cluster/changes?since=abc')
+    result = json.loads(ret_value.data)
+    self.assertFalse(result.get('success'))
+    self.assertFalse(result.get('resync_required'))
+
+  def fetch_changed_pod(self):
+    """Makes the data collector fetch the pods with one changed pod.
+
+    The caches of the global state always miss, so every request fetches
+    the data again, and the first fetched pod has a new attribute. The
+    caller must call self.restore_fetch() afterwards.
+
+    Returns:
+    The ID of the changed pod in the context graph.
+    """
+    self._saved_max_age = constants.MAX_CACHED_DATA_AGE_SECONDS
+    self._saved_fetch_data = kubernetes.fetch_data
+    constants.MAX_CACHED_DATA_AGE_SECONDS = 0
+    self.setUp()
+    self.changed = False
+    fetch_data = self._saved_fetch_data
+
+    def fetch_changed_data(gs, url):
+      result = fetch_data(gs, url)
+      if self.changed and url.endswith('/pods'):
+        result['items'][0]['metadata']['newAttribute123'] = 'changed'
+      return result
+
+    kubernetes.fetch_data = fetch_changed_data
+    pods = json.loads(open('testdata/pods.input.json').read())['items']
+    return 'Pod:' + pods[0]['metadata']['name']
+
+  def restore_fetch(self):
+    constants.MAX_CACHED_DATA_AGE_SECONDS = self._saved_max_age
+    kubernetes.fetch_data = self._saved_fetch_data
+
+  def pod_descendants(self, pod_id):
+    """Returns the IDs of the pod, its containers and their images."""
+    gs = collector.app.context_graph_global_state
+    relations = gs.get_context_graph()[0].to_context_graph()['relations']
+    containers = set(rel['target'] for rel in relations
+                     if rel['source'] == pod_id and rel['type'] == 'contains')
+    self.assertTrue(containers)
+    images = set(rel['target'] for rel in relations
+                 if rel['source'] in containers)
+    return set([pod_id]) | containers | images
+
+  def verify_pod_changes(self, pod_id, resources):
+    """Verifies that 'resources' are the changed pod and its descendants."""
+    self.assertEqual(sorted(self.pod_descendants(pod_id)),
+                     sorted(r['id'] for r in resources))
+
+  def test_publish_without_lock(self):
+    """Test that readers do not wait while a graph is prepared for output."""
+    self.assertEqual(200, self.app.get('/cluster').status_code)
+    gs = collector.app.context_graph_global_state
+    published_graph, _ = gs.get_context_graph()
+    readers = []
+
+    def read_graph():
+      t = threading.Thread(target=lambda: readers.append(
+          gs.get_context_graph()[0]))
+      t.daemon = True
+      t.start()
+      t.join(5)
+
+    saved_compute_delta = context.ContextGraph.compute_delta
+    saved_prepare_output = context.ContextGraph.prepare_output
+    def compute_delta(g, previous):
+      read_graph()
+      return saved_compute_delta(g, previous)
+    def prepare_output(g, previous=None):
+      read_graph()
+      return saved_prepare_output(g, previous)
+
+    nodes, _ = gs.get_nodes_cache().lookup('')
+    nodes[0]['properties']['newAttribute123'] = 'the quick brown fox jumps over'
+    nodes[0]['timestamp'] = time.time()
+    gs.get_nodes_cache().update('', nodes)
+    context.ContextGraph.compute_delta = compute_delta
+    context.ContextGraph.prepare_output = prepare_output
+    try:
+      result = json.loads(self.app.get('/cluster').data)
+    finally:
+      context.ContextGraph.compute_delta = saved_compute_delta
+      context.ContextGraph.prepare_output = saved_prepare_output
+
+    # The graph was read while the new graph was compared and prepared.
+    self.assertEqual(2, result.get('version'))
+    self.assertEqual([published_graph, published_graph], readers[:2])
+
+  def test_changes_of_one_pod(self):
+    """Test that a changed pod does not modify the unchanged resources."""
+    pod_id = self.fetch_changed_pod()
+    try:
+      self.assertEqual(1, json.loads(self.app.get('/cluster').data)['version'])
+      # Fetching the same data again does not create a new version.
+      self.assertEqual(1, json.loads(self.app.get('/cluster').data)['version'])
+
+      self.changed = True
+      self.assertEqual(2, json.loads(self.app.get('/cluster').data)['version'])
+    finally:
+      self.restore_fetch()
+
+    result = json.loads(self.app.get('/cluster/changes?since=1').data)
+    self.assertTrue(result.get('success'))
+    self.assertEqual([], result['resources']['added'])
+    self.assertEqual([], result['resources']['removed'])
+    self.verify_pod_changes(pod_id, result['resources']['modified'])
+    for changes in result['relations'].values():
+      self.assertEqual([], changes)
+
+  def read_event(self, events):
+    """Reads the next server-sent event from the iterator 'events'.
+
+    Returns:
+    A tuple (event name, JSON data of the event).
+    """
+    event = next(events)
+    match = re.match(r'event: (\w+)\ndata: (.*)\n\n$', event)
+    self.assertTrue(match is not None)
+    return (match.group(1), json.loads(match.group(2)))
+
+  def change_first_node(self, value):
+    """Changes the first node in the cache and rebuilds the graph."""
+    gs = collector.app.context_graph_global_state
+    nodes, _ = gs.get_nodes_cache().lookup('')
+    nodes[0]['properties']['newAttribute123'] = value
+    nodes[0]['timestamp'] = time.time()
+    gs.get_nodes_cache().update('', nodes)
+    self.app.get('/cluster')
+    return 'Node:' + nodes[0]['id']
+
+  def test_stream(self):
+    """Test the '/cluster/stream' endpoint."""
+    saved_queue_size = constants.MAX_SUBSCRIBER_QUEUE_SIZE
+    constants.MAX_SUBSCRIBER_QUEUE_SIZE = 2
+    ret_value = self.app.get('/cluster/stream', buffered=False)
+    try:
+      self.assertEqual('text/event-stream', ret_value.mimetype)
+      events = iter(ret_value.response)
+
+      # The stream starts with a snapshot of the graph.
+      name, data = self.read_event(events)
+      self.assertEqual('snapshot', name)
+      self.assertEqual(1, data['version'])
+      self.assertEqual(55, len(data['resources']))
+      self.assertEqual(73, len(data['relations']))
+
+      # A change of the graph is pushed to the subscriber.
+      node_guid = self.change_first_node('the quick brown fox')
+      name, data = self.read_event(events)
+      self.assertEqual('changes', name)
+      self.assertEqual(1, data['since'])
+      self.assertEqual(2, data['version'])
+      self.assertEqual([node_guid],
+                       [r['id'] for r in data['resources']['modified']])
+
+      # A subscriber that falls behind receives a new snapshot.
+      self.change_first_node('jumps over')
+      self.change_first_node('the lazy dog')
+      self.change_first_node('again')
+      name, data = self.read_event(events)
+      self.assertEqual('snapshot', name)
+      self.assertEqual(5, data['version'])
+    finally:
+      ret_value.close()
+      constants.MAX_SUBSCRIBER_QUEUE_SIZE = saved_queue_size
+
+  def test_stream_of_one_pod(self):
+    """Test that a changed pod pushes only its changes to the subscribers."""
+    pod_id = self.fetch_changed_pod()
+    ret_value = self.app.get('/cluster/stream', buffered=False)
+    try:
+      events = iter(ret_value.response)
+      self.assertEqual('snapshot', self.read_event(events)[0])
+
+      self.changed = True
+      self.app.get('/cluster')
+      name, data = self.read_event(events)
+    finally:
+      ret_value.close()
+      self.restore_fetch()
+
+    self.assertEqual('changes', name)
+    self.assertEqual(2, data['version'])
+    self.assertEqual([], data['resources']['added'])
+    self.verify_pod_changes(pod_id, data['resources']['modified'])
+    self.assertEqual([], data['relations']['modified'])
+
+  def test_pod_containers(self):
+    """Test that derived containers and images are reused across builds."""
+    self.app.get('/cluster')
+    gs = collector.app.context_graph_global_state
+    with collector.app.app_context():
+      pods = kubernetes.get_pods(gs)
+      pods_again = kubernetes.get_pods(gs)
+
+    self.assertEqual(14, len(pods))
+    for pod, pod_again in zip(pods, pods_again):
+      containers = kubernetes.get_pod_containers(gs, pod)
+      self.assertEqual(kubernetes.derive_pod_containers(pod), containers)
+      self.assertTrue(containers is
+                      kubernetes.get_pod_containers(gs, pod_again))
+
+  def test_pod_containers_of_one_pod(self):
+    """Test that a changed pod does not derive the other pods' containers."""
+    pod_id = self.fetch_changed_pod()
+    gs = collector.app.context_graph_global_state
+    try:
+      with collector.app.app_context():
+        pods = kubernetes.get_pods(gs)
+        old_containers = [kubernetes.get_pod_containers(gs, pod)
+                          for pod in pods]
+        self.changed = True
+        changed_pods = kubernetes.get_pods(gs)
+    finally:
+      self.restore_fetch()
+
+    self.assertEqual(len(pods), len(changed_pods))
+    for pod, containers in zip(changed_pods, old_containers):
+      new_containers = kubernetes.get_pod_containers(gs, pod)
+      if 'Pod:' + pod['id'] == pod_id:
+        self.assertFalse(new_containers is containers)
+        self.assertEqual(kubernetes.derive_pod_containers(pod),
+                         new_containers)
+      else:
+        self.assertTrue(new_containers is containers)
+
+  def test_json_fragments(self):
+    """Test that unchanged resources reuse their JSON representations."""
+    gs = collector.app.context_graph_global_state
+    result = json.loads(self.app.get('/cluster').data)
+    g1, _ = gs.get_context_graph()
+    self.assertEqual(json.loads(json.dumps(g1.to_context_graph())), result)
+    self.assertEqual(
+        json.loads(self.app.get('/cluster/resources').data)['resources'],
+        result['resources'])
+
+    node_guid = self.change_first_node('the quick brown fox')
+    g2, _ = gs.get_context_graph()
+    self.assertTrue(g2 is not g1)
+    result = json.loads(self.app.get('/cluster').data)
+    self.assertEqual(json.loads(json.dumps(g2.to_context_graph())), result)
+
+    old_resources = dict((r['id'], r)
+                         for r in g1.to_context_graph()['resources'])
+    for r in g2.to_context_graph()['resources']:
+      if r['id'] == node_guid:
+        self.assertTrue('the quick brown fox' in g2.resource_json(r))
+      elif r['type'] == 'Pod':
+        self.assertTrue(g2.resource_json(r) is
+                        g1.resource_json(old_resources[r['id']]))
+
+  def test_json_fragments_of_one_pod(self):
+    """Test that a changed pod does not encode the other resources again."""
+    pod_id = self.fetch_changed_pod()
+    gs = collector.app.context_graph_global_state
+    try:
+      # Read the responses, so the JSON representations are computed.
+      self.assertTrue(self.app.get('/cluster').data)
+      g1, _ = gs.get_context_graph()
+      self.changed = True
+      self.assertTrue(self.app.get('/cluster').data)
+      g2, _ = gs.get_context_graph()
+    finally:
+      self.restore_fetch()
+
+    self.assertTrue(g2 is not g1)
+    changed_ids = self.pod_descendants(pod_id)
+    self.assertEqual(changed_ids, set(g2.compute_delta(g1)['resources']))
+    old_resources = dict((r['id'], r)
+                         for r in g1.to_context_graph()['resources'])
+    for r in g2.to_context_graph()['resources']:
+      fragment = g2.resource_json(r)
+      if r['id'] in changed_ids:
+        self.assertFalse(fragment is g1.resource_json(old_resources[r['id']]))
+      else:
+        self.assertTrue(fragment is g1.resource_json(old_resources[r['id']]))
 
-  def verify_empty_elapsed(self):
+  def test_packed_values_of_one_pod(self):
+    """Test that a changed pod does not pack the other resources again."""
+    pod_id = self.fetch_changed_pod()
+    gs = collector.app.context_graph_global_state
+    try:
+      self.assertTrue(self.app.get('/cluster?format=msgpack').data)
+      g1, _ = gs.get_context_graph()
+      self.changed = True
+      self.assertTrue(self.app.get('/cluster?format=msgpack').data)
+      g2, _ = gs.get_context_graph()
+    finally:
+      self.restore_fetch()
+
+    changed_ids = self.pod_descendants(pod_id)
+    self.assertEqual(changed_ids, set(g2.compute_delta(g1)['resources']))
+    old_resources = dict((r['id'], r)
+                         for r in g1.to_context_graph()['resources'])
+    for r in g2.to_context_graph()['resources']:
+      old_resource = old_resources[r['id']]
+      for attribute in msgpack_format.PLAIN_KEYS:
+        packed = g2.resource_packed_plain(r, attribute)
+        old_packed = g1.resource_packed_plain(old_resource, attribute)
+        self.assertEqual(r['id'] not in changed_ids, packed is old_packed)
+
+  def test_streamed_output(self):
+    """Test that '/cluster' is streamed in chunks of bounded size."""
+    saved_chunk_size = constants.OUTPUT_CHUNK_SIZE
+    constants.OUTPUT_CHUNK_SIZE = 1000
+    try:
+      ret_value = self.app.get('/cluster', buffered=False)
+      self.assertTrue(ret_value.is_streamed)
+      data = ret_value.data
+      gs = collector.app.context_graph_global_state
+      g, _ = gs.get_context_graph()
+      chunks = list(g.iter_json(g.to_context_graph()))
+    finally:
+      constants.OUTPUT_CHUNK_SIZE = saved_chunk_size
+
+    self.assertTrue(len(chunks) > 1)
+    max_fragment_size = max(len(g.resource_json(r))
+                            for r in g.to_context_graph()['resources'])
+    for chunk in chunks:
+      self.assertTrue(len(chunk) <= 1000 + max_fragment_size + 2)
+    self.assertEqual(data, ''.join(chunks))
+    self.assertEqual(json.loads(json.dumps(g.to_context_graph())),
+                     json.loads(data))
+
+  def test_etag(self):
+    """Test conditional and compressed responses of '/cluster'."""
+    ret_value = self.app.get('/cluster')
+    self.assertEqual(200, ret_value.status_code)
+    etag = ret_value.headers['ETag']
+    self.assertTrue(etag.startswith('"'))
+
+    # The graph did not change, so the client's copy is up to date. The
+    # recent graph answers the conditional request without a new build.
+    gs = collector.app.context_graph_global_state
+    admitted = gs.get_admission_controller().get_stats()['admitted']
+    ret_value = self.app.get('/cluster', headers={'If-None-Match': etag})
+    self.assertEqual(304, ret_value.status_code)
+    self.assertEqual('', ret_value.data)
+    self.assertEqual(etag, ret_value.headers['ETag'])
+    self.assertEqual(admitted,
+                     gs.get_admission_controller().get_stats()['admitted'])
+
+    # The compressed response has a different entity tag.
+    ret_value = self.app.get('/cluster', headers={'Accept-Encoding': 'gzip'})
+    self.assertEqual('gzip', ret_value.headers['Content-Encoding'])
+    self.assertTrue(ret_value.headers['ETag'] != etag)
+    data = gzip.GzipFile(fileobj=cStringIO.StringIO(ret_value.data)).read()
+    self.assertEqual(self.app.get('/cluster').data, data)
+    ret_value = self.app.get(
+        '/cluster', headers={'Accept-Encoding': 'gzip',
+                             'If-None-Match': ret_value.headers['ETag']})
+    self.assertEqual(304, ret_value.status_code)
+
+    # A new graph version has a new entity tag.
+    self.change_first_node('the quick brown fox')
+    ret_value = self.app.get('/cluster', headers={'If-None-Match': etag})
+    self.assertEqual(200, ret_value.status_code)
+    self.assertTrue(ret_value.headers['ETag'] != etag)
+
+  def test_msgpack(self):
+    """Test the compact binary encoding of the graph and resource endpoints.
+    """
+    for url in ['/cluster', '/cluster/resources', '/cluster/resources/nodes',
+                '/cluster/resources?type=Pod',
+                '/cluster/subgraph?root=Node:k8s-guestbook-node-1']:
+      expected = json.loads(self.app.get(url).data)
+      separator = '&' if '?' in url else '?'
+      ret_value = self.app.get(url + separator + 'format=msgpack')
+      self.assertEqual(msgpack_format.MIMETYPE, ret_value.mimetype)
+      self.assertEqual(expected, msgpack_format.unpack(ret_value.data))
+
+      ret_value = self.app.get(
+          url, headers={'Accept': msgpack_format.MIMETYPE})
+      self.assertEqual(msgpack_format.MIMETYPE, ret_value.mimetype)
+      self.assertEqual(expected, msgpack_format.unpack(ret_value.data))
+      self.assertTrue('Accept' in ret_value.headers['Vary'])
+
+    # The packed graph is cached and has its own entity tag.
+    etag = self.app.get('/cluster').headers['ETag']
+    ret_value = self.app.get('/cluster?format=msgpack')
+    self.assertTrue(ret_value.headers['ETag'] != etag)
+    self.assertEqual(
+        304, self.app.get('/cluster?format=msgpack', headers={
+            'If-None-Match': ret_value.headers['ETag']}).status_code)
+
+    result = json.loads(self.app.get('/cluster?format=xml').data)
+    self.assertFalse(result.get('success'))
+
+  def test_node_metrics(self):
+    """Test that node metric annotations share the metric names."""
+    gs = collector.app.context_graph_global_state
+    with collector.app.app_context():
+      nodes = kubernetes.get_nodes_with_metrics(gs)
+
+    self.assertTrue(nodes)
+    for node in nodes:
+      gcm = node['annotations']['metrics']['gcm']
+      self.assertTrue(gcm['names'] is metrics.METRIC_NAMES)
+      self.assertEqual(node['properties']['metadata']['name'],
+                       gcm['labels']['hostname'])
+
+  def test_prefetch(self):
+    """Test that resources of all kinds are fetched concurrently."""
+    gs = collector.app.context_graph_global_state
+    with collector.app.app_context():
+      kubernetes.prefetch_resources(gs)
+
+    for cache in (gs.get_nodes_cache(), gs.get_pods_cache(),
+                  gs.get_services_cache(), gs.get_rcontrollers_cache()):
+      resources, timestamp_secs = cache.lookup('')
+      self.assertTrue(timestamp_secs is not None)
+      self.assertTrue(resources)
+
+    # The elapsed time records of the fetches come from the pool threads.
+    elapsed, _, _ = gs.get_elapsed()
+    self.assertEqual(4, len(elapsed))
+    thread_identifiers = set(r.thread_identifier for r in elapsed)
+    self.assertFalse(thread.get_ident() in thread_identifiers)
+
+  def test_overload(self):
+    """Test that graph builds are rejected when the server is overloaded."""
+    gs = collector.app.context_graph_global_state
+    controller = gs.get_admission_controller()
+    limit = controller.get_stats()['limit']
+    for _ in xrange(limit):
+      controller.acquire(time.time() + 10)
+    saved_deadline = constants.COMPUTE_GRAPH_DEADLINE_SECONDS
+    constants.COMPUTE_GRAPH_DEADLINE_SECONDS = 0
+    try:
+      ret_value = self.app.get('/cluster')
+    finally:
+      constants.COMPUTE_GRAPH_DEADLINE_SECONDS = saved_deadline
+      for _ in xrange(limit):
+        controller.release(0.0)
+
+    self.assertEqual(503, ret_value.status_code)
+    self.assertEqual('1', ret_value.headers['Retry-After'])
+    self.assertFalse(json.loads(ret_value.data)['success'])
+
+    self.assertEqual(200, self.app.get('/cluster').status_code)
+    stats = json.loads(self.app.get('/admission').data)['admission']
+    self.assertEqual(1, stats['rejected_deadline'])
+    self.assertEqual(limit + 1, stats['admitted'])
+    self.assertEqual(0, stats['active'])
+
+  def test_shared_build_deadline(self):
+    """Test that requests waiting for another graph build have a deadline."""
+    gs = collector.app.context_graph_global_state
+    claimed, done = gs.claim_graph_build()
+    self.assertTrue(claimed)
+    saved_deadline = constants.COMPUTE_GRAPH_DEADLINE_SECONDS
+    constants.COMPUTE_GRAPH_DEADLINE_SECONDS = 0.1
+    try:
+      ret_value = self.app.get('/cluster/changes?since=0')
+    finally:
+      constants.COMPUTE_GRAPH_DEADLINE_SECONDS = saved_deadline
+      gs.end_graph_build()
+
+    self.assertTrue(done.is_set())
+    self.assertEqual(503, ret_value.status_code)
+    self.assertEqual('1', ret_value.headers['Retry-After'])
+    stats = json.loads(self.app.get('/admission').data)['admission']
+    self.assertEqual(1, stats['rejected_deadline'])
+    self.assertEqual(0, stats['admitted'])
+
+    self.assertEqual(200, self.app.get('/cluster/changes?since=0').status_code)
+    stats = json.loads(self.app.get('/admission').data)['admission']
+    self.assertEqual(1, stats['admitted'])
+
+  def test_profile(self):
+    """Test profiling of graph builds by the '/profile' endpoint."""
+    ret_value = self.app.get('/profile')
+    self.assertEqual(404, ret_value.status_code)
+
+    gs = collector.app.context_graph_global_state
+    profiler = gs.get_profiler()
+    profiler.set_token('secret')
+    headers = {'X-Profiling-Token': 'secret'}
+    self.assertEqual(403, self.app.get('/profile').status_code)
+    self.assertEqual(
+        403, self.app.get('/profile', headers={'X-Profiling-Token': 'x'})
+        .status_code)
+    for query in ('mode=dtrace', 'builds=0', 'seconds=1000', 'seconds=x'):
+      ret_value = self.app.get('/profile?' + query, headers=headers)
+      self.assertFalse(json.loads(ret_value.data)['success'])
+
+    # Build the context graph once profiling starts.
+    def build():
+      while not profiler.is_active():
+        time.sleep(0.001)
+      collector.app.test_client().get('/cluster')
+
+    for mode, expected in (('cprofile', '_do_build_graph'),
+                           ('sample', ';_do_build_graph (context.py:')):
+      # Start from an empty global state, so '/cluster' builds a new graph.
+      self.setUp()
+      profiler = collector.app.context_graph_global_state.get_profiler()
+      profiler.set_token('secret')
+      t = threading.Thread(target=build)
+      t.start()
+      ret_value = self.app.get('/profile?mode=%s&seconds=10' % mode,
+                               headers=headers)
+      t.join()
+      self.assertEqual(200, ret_value.status_code)
+      self.assertEqual('1', ret_value.headers['X-Profiled-Builds'])
+      self.assertTrue(expected in ret_value.data)
+
+  def test_metrics(self):
+    """Test the latency histograms and counters of the '/metrics' endpoint."""
+    self.app.get('/cluster')
+    self.app.get('/cluster/resources/pods')
+    self.app.get('/cluster/subgraph?root=Node:no-such-node')
+    # Invalid parameters and forbidden requests are errors, too.
+    self.app.get('/cluster/subgraph')
+    self.app.get('/elapsed?since=x')
+    self.app.get('/profile')
+
+    ret_value = self.app.get('/metrics')
+    self.assertEqual('text/plain; version=0.0.4', ret_value.content_type)
+    metrics_text = ret_value.data
+    for line in (
+        'collector_request_duration_seconds_count{endpoint="/cluster"} 1',
+        'collector_request_duration_seconds_count'
+        '{endpoint="/cluster/resources/pods"} 1',
+        'collector_requests_total{endpoint="/cluster",code="200"} 1',
+        'collector_request_errors_total{endpoint="/cluster/subgraph"} 2',
+        'collector_request_errors_total{endpoint="/elapsed"} 1',
+        'collector_request_errors_total{endpoint="/profile"} 1',
+        'collector_requests_total{endpoint="/profile",code="404"} 1',
+        'collector_kubernetes_fetch_duration_seconds_count{kind="pods"} 1',
+        'collector_graph_build_phase_duration_seconds_count'
+        '{phase="publish"} 1',
+        'collector_admission_admitted_total 1'):
+      self.assertTrue(line + '\n' in metrics_text, line)
+
+    # Reading the metrics does not reset them.
+    self.assertTrue(
+        'collector_requests_total{endpoint="/metrics",code="200"} 1\n' in
+        self.app.get('/metrics').data)
+    self.assertTrue(
+        'collector_request_duration_seconds_count{endpoint="/cluster"} 1\n' in
+        self.app.get('/metrics').data)
+
+  def test_traces(self):
+    """Test the traces of the requests in the '/traces' endpoint."""
+    # The trace of the streamed response is recorded when the body ends.
+    response = self.app.get('/cluster')
+    trace_id = response.headers['X-Trace-Id']
+    self.assertEqual(
+        0, json.loads(self.app.get('/traces').data)['traces']['count'])
+    self.assertTrue(response.data)
+    self.app.get('/healthz')
+    self.app.get('/cluster/resources/nodes')
+
+    result = json.loads(self.app.get('/traces').data)['traces']
+    self.assertEqual(2, result['count'])
+    self.assertEqual(2, result['next'])
+    trace, nodes_trace = result['items']
+    self.assertEqual(trace_id, trace['traceId'])
+    self.assertEqual('GET /cluster', trace['name'])
+    self.assertEqual(200, trace['attributes']['status_code'])
+    self.assertEqual('GET /cluster/resources/nodes', nodes_trace['name'])
+
+    # The fetches in the pool threads are children of the fetch phase.
+    spans = dict((s['id'], s) for s in trace['spans'])
+    names = [s['name'] for s in trace['spans']]
+    for name in ('admission', 'build', 'build.fetch', 'build.pods',
+                 'build.publish', 'derive_containers', 'serialize'):
+      self.assertTrue(name in names, name)
+    serialize = [s for s in trace['spans'] if s['name'] == 'serialize'][0]
+    self.assertEqual({'encoding': 'json'}, serialize['attributes'])
+    self.assertTrue(serialize['duration_seconds'] > 0)
+    fetches = [s for s in trace['spans'] if s['name'] == 'fetch']
+    self.assertEqual(['nodes', 'pods', 'replicationcontrollers', 'services'],
+                     sorted(s['attributes']['kind'] for s in fetches))
+    for s in fetches:
+      self.assertEqual('build.fetch', spans[s['parent']]['name'])
+      self.assertEqual('build', spans[spans[s['parent']]['parent']]['name'])
+
+    # Reading the traces does not remove them.
+    result = json.loads(self.app.get('/traces?since=1').data)['traces']
+    self.assertEqual([nodes_trace], result['items'])
+    self.assertEqual(
+        0, json.loads(self.app.get('/traces?since=2').data)['traces']['count'])
+
+  def test_parallel_build(self):
+    """Test that a parallel graph build matches the serial graph build."""
+    serial_value = self.app.get('/cluster').data
+
+    saved_min_pods = constants.MIN_PODS_FOR_PARALLEL_BUILD
+    constants.MIN_PODS_FOR_PARALLEL_BUILD = 0
+    gs = collector.app.context_graph_global_state
+    gs.init_build_pool(2)
+    try:
+      parallel_value = self.app.get('/cluster').data
+      self.compare_to_golden(self.app.get('/debug').data, 'debug')
+    finally:
+      gs.close_build_pool()
+      constants.MIN_PODS_FOR_PARALLEL_BUILD = saved_min_pods
+
+    self.assertEqual(re.sub(TIMESTAMP_REGEXP, '', serial_value),
+                     re.sub(TIMESTAMP_REGEXP, '', parallel_value))
+
+  def test_parallel_build_containers(self):
+    """Test that the build processes reuse the containers of the pods."""
+    serial_value = self.app.get('/cluster').data
+
+    # The worker processes are forked after derive_pod_containers() is
+    # replaced, so they fail if they derive the containers again.
+    parent_pid = os.getpid()
+    saved_derive = kubernetes.derive_pod_containers
+    def derive_pod_containers(pod):
+      assert os.getpid() == parent_pid
+      return saved_derive(pod)
+
+    saved_min_pods = constants.MIN_PODS_FOR_PARALLEL_BUILD
+    constants.MIN_PODS_FOR_PARALLEL_BUILD = 0
+    kubernetes.derive_pod_containers = derive_pod_containers
+    gs = collector.app.context_graph_global_state
+    gs.init_build_pool(2)
+    try:
+      ret_value = self.app.get('/cluster')
+      self.assertEqual(200, ret_value.status_code)
+      parallel_value = ret_value.data
+    finally:
+      gs.close_build_pool()
+      kubernetes.derive_pod_containers = saved_derive
+      constants.MIN_PODS_FOR_PARALLEL_BUILD = saved_min_pods
+
+    self.assertEqual(re.sub(TIMESTAMP_REGEXP, '', serial_value),
+                     re.sub(TIMESTAMP_REGEXP, '', parallel_value))
+
+  def verify_empty_elapsed(self, query=''):
     """Verify that '/elapsed' endoint returns an empty list of elapsed times.
     """
-    ret_value = self.app.get('/elapsed')
+    ret_value = self.app.get('/elapsed' + query)
     result = json.loads(ret_value.data)
     self.assertTrue(result.get('success'))
     elapsed = result.get('elapsed')
@@ -344,9 +1175,27 @@ class TestCollector(unittest.TestCase):
                     elapsed.get('max'))
     self.assertTrue(isinstance(elapsed.get('items'), list))
     self.assertEqual(3, len(elapsed.get('items')))
+    durations = sorted(item['elapsed_seconds'] for item in elapsed['items'])
+    self.assertEqual({'p50': durations[1], 'p90': durations[2],
+                      'p99': durations[2]}, elapsed.get('percentiles'))
+    self.assertEqual(3, elapsed.get('next'))
+    self.assertEqual(0, elapsed.get('missed'))
 
-    # The next call to '/elapsed' should return an empty list
-    self.verify_empty_elapsed()
+    # Reading the records does not remove them.
+    result = json.loads(self.app.get('/elapsed').data)
+    self.assertEqual(3, result['elapsed']['count'])
+
+    # Only the new records are returned since the previous response.
+    self.verify_empty_elapsed('?since=3')
+    self.app.get('/cluster/resources/pods')
+    result = json.loads(self.app.get('/elapsed?since=3').data)
+    self.assertEqual(1, result['elapsed']['count'])
+    self.assertEqual(4, result['elapsed']['next'])
+    self.assertTrue(result['elapsed']['items'][0]['what'].endswith(
+        'pods.input.json'))
+
+    result = json.loads(self.app.get('/elapsed?since=-1').data)
+    self.assertFalse(result.get('success'))
 
   def test_healthz(self):
     """Test the '/healthz' endpoint."""
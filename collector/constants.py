@@ -26,8 +26,145 @@ MAX_CACHED_DATA_AGE_SECONDS = 10
 # cache.
 CACHE_DATA_CLEANUP_AGE_SECONDS = 3600  # one hour
 
-# Maximum number of active context.compute_graph() calls.
-MAX_CONCURRENT_COMPUTE_GRAPH = 2
+# Bounds and initial value of the number of concurrent context graph builds.
+# The limit adapts to the build times (see admission.AdmissionController).
+MIN_CONCURRENT_COMPUTE_GRAPH = 1
+INITIAL_CONCURRENT_COMPUTE_GRAPH = 2
+MAX_CONCURRENT_COMPUTE_GRAPH = 8
 
-# Maximum number of elapsed time records in the elapsed time queue.
-MAX_ELAPSED_QUEUE_SIZE = 1000
+# Maximum number of requests waiting to build a context graph. Further
+# requests are rejected with '503 Service Unavailable'.
+MAX_QUEUED_COMPUTE_GRAPH = 16
+
+# A request that cannot build a context graph within this many seconds
+# after it started waiting is rejected with '503 Service Unavailable'.
+COMPUTE_GRAPH_DEADLINE_SECONDS = 30
+
+# Maximum number of concurrent requests to the Kubernetes API, which is also
+# the number of connections to it that are kept open for reuse.
+MAX_CONCURRENT_FETCHES = 4
+
+# Default maximal distance from the root resource in /cluster/subgraph.
+DEFAULT_SUBGRAPH_DEPTH = 1
+
+# Maximal distance from the root resource in /cluster/subgraph. The context
+# graph is shallow, so a larger depth adds no resources and only bounds the
+# work of a single request.
+MAX_SUBGRAPH_DEPTH = 100
+
+# Number of recent graph versions whose changes are kept for
+# /cluster/changes. Clients that fall further behind must resync.
+MAX_GRAPH_DELTAS = 100
+
+# Maximum number of pending graph changes of a /cluster/stream subscriber.
+# A subscriber that falls further behind receives a new snapshot instead.
+MAX_SUBSCRIBER_QUEUE_SIZE = 20
+
+# Interval in seconds between checks for graph changes in /cluster/stream
+# when no changes are pending.
+STREAM_POLL_SECONDS = MAX_CACHED_DATA_AGE_SECONDS
+
+# Maximum number of resources in a page of /cluster/resources.
+MAX_RESOURCES_PAGE_SIZE = 1000
+
+# Named sets of resource attributes for the 'fields' query parameter.
+FIELDS_PROFILES = {
+    'compact': ','.join([
+        'id', 'type', 'timestamp', 'annotations.label',
+        'properties.metadata.name', 'properties.metadata.namespace',
+        'properties.metadata.labels', 'properties.status.phase']),
+}
+
+# Upper bounds in seconds of the buckets of the latency histograms (see
+# monitoring.Histogram).
+LATENCY_BUCKETS_SECONDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                           2.5, 5.0, 10.0, 30.0)
+
+# Number of the most recent elapsed time records that are kept for
+# '/elapsed'.
+MAX_ELAPSED_RECORDS = 1000
+
+# Percentiles of the elapsed times reported by '/elapsed'.
+ELAPSED_PERCENTILES = (50, 90, 99)
+
+# Number of the most recent request traces that are kept for '/traces'.
+MAX_TRACES = 100
+
+# The default and maximal number of context graph builds profiled by
+# '/profile', and the default and maximal duration of the profiling.
+DEFAULT_PROFILED_BUILDS = 1
+MAX_PROFILED_BUILDS = 100
+DEFAULT_PROFILE_SECONDS = 30
+MAX_PROFILE_SECONDS = 60
+
+# The interval between stack samples in the 'sample' profiling mode.
+PROFILE_SAMPLE_INTERVAL_SECONDS = 0.005
+
+# Number of the functions with the largest cumulative time that are listed
+# in the 'cprofile' profiling mode.
+MAX_PROFILED_FUNCTIONS = 100
+
+# Number of worker processes used for building the pods part of the context
+# graph. Zero means that the context graph is built serially.
+DEFAULT_BUILD_PROCESSES = 0
+
+# Number of pod shards per build process in a parallel graph build.
+BUILD_SHARDS_PER_PROCESS = 4
+
+# Clusters with fewer pods are always built serially, because the cost of
+# sending the pods to the worker processes exceeds the gain.
+MIN_PODS_FOR_PARALLEL_BUILD = 1000
+
+# Maximum number of distinct seconds whose ISO 8601 formatting is memoised
+# by utilities.seconds_to_timestamp().
+MAX_CACHED_TIMESTAMP_SECONDS = 10000
+
+# Approximate size in bytes of the chunks of the streamed graph outputs.
+OUTPUT_CHUNK_SIZE = 64 * 1024
+
+# The number of worker threads of the web server (see
+# serving.PooledWSGIServer). Zero selects the Flask development server,
+# which starts a new thread for every connection.
+DEFAULT_SERVER_THREADS = 8
+
+# The number of worker threads reserved for the requests of PRIORITY_PATHS.
+DEFAULT_PRIORITY_SERVER_THREADS = 2
+
+# Health and statistics requests, which are served by the reserved worker
+# threads, so they are not delayed by slow requests of the context graph.
+PRIORITY_PATHS = ('/healthz', '/elapsed', '/admission', '/metrics',
+                  '/traces')
+
+# Long-lived responses, which are served by their own threads.
+STREAMING_PATHS = ('/cluster/stream',)
+
+# A persistent connection is closed if the next request does not arrive
+# within this time.
+KEEPALIVE_TIMEOUT_SECONDS = 5
+
+# A connection is closed if reading a request or writing a response stalls
+# for this time.
+REQUEST_TIMEOUT_SECONDS = 60
+
+# The web server queues a connection for its worker threads only when the
+# headers of its next request arrived, or the first REQUEST_PEEK_SIZE bytes
+# of the request if the headers are longer. It peeks at partial headers
+# again every REQUEST_PEEK_INTERVAL_SECONDS.
+REQUEST_PEEK_SIZE = 8192
+REQUEST_PEEK_INTERVAL_SECONDS = 0.01
+
+# The web server reads the requests in chunks of this size.
+REQUEST_BUFFER_SIZE = 8192
+
+# Levels of detail of the DOT output of '/debug' (see
+# context.ContextGraph.iter_dot()). Each level maps to the resource types
+# that are omitted from the output together with their relations, so large
+# graphs remain small enough to render.
+DOT_DETAIL_LEVELS = {
+    'full': (),
+    'nocontainers': ('Container', 'Image'),
+    'nopods': ('Pod', 'Container', 'Image'),
+}
+
+# Compression level of the cached gzip-compressed graph outputs (1-9).
+GZIP_COMPRESSION_LEVEL = 6
@@ -33,11 +33,19 @@ import context
 import global_state
 gs = global_state.GlobalState()
 # initialize the global state in 'gs'.
-# select the desired output format.
-context.compute_graph(gs, output_format)
+g = context.build_graph(gs)
+# output the context graph.
+g.dump('context_graph')
 """
 
+import base64
+import bisect
+import contextlib
 import copy
+import functools
+import json
+import operator
+import Queue  # "Queue" was renamed "queue" in Python 3.
 import re
 import threading
 import time
@@ -46,20 +54,35 @@ import types
 from flask import current_app as app
 
 import collector_error
+import constants
 import global_state
 import kubernetes
 import metrics
+import msgpack_format
+import tracing
 import utilities
 
+# Matches any character that is not a hexadecimal digit. See best_label().
+_NON_HEX_REGEXP = re.compile('[^0-9a-fA-F]')
 
-class ContextGraph(object):
-  """Maintains the context graph and outputs it.
 
-  This class is thread-safe.
+class ContextGraph(object):
+  """Builds the context graph and outputs it.
+
+  A context graph is built by a single thread (see _do_build_graph()),
+  so the building methods (add_resource(), add_relation(), set_title(),
+  set_metadata() and set_relations_to_timestamps()) do not acquire any lock.
+  Once the graph is complete, the builder calls freeze(). A frozen graph is
+  immutable, except for prepare_output(), which sorts the output and
+  computes the resources index once. A graph is prepared before it is
+  published in the global state (see GlobalState.set_context_graph()), so
+  a published graph may be shared by any number of reader threads.
+
+  This class is not thread-safe before prepare_output() is called.
   """
 
   def __init__(self):
-    self._lock = threading.Lock()
+    self._frozen = False
     self._graph_metadata = None
     self._graph_title = None
     # Set the color lookup table of various resources.
@@ -74,130 +97,544 @@ class ContextGraph(object):
     }
     self._context_resources = []
     self._context_relations = []
-    self._id_set = set()
+    # Adjacency indexes: resource ID to the resource, and resource ID to
+    # the relations leaving/entering it. See subgraph().
+    self._id_to_resource = {}
+    self._out_relations = {}
+    self._in_relations = {}
+    # Relation key (source, target, type) to the relation. See
+    # compute_delta().
+    self._key_to_relation = {}
+    # The resources and relations in the output format, in which the
+    # timestamps are in ISO 8601 format. Computed by prepare_output().
+    self._output_resources = None
+    self._output_relations = None
+    # (type, namespace) to a tuple (IDs, resources) of the matching output
+    # resources sorted by ID. A None type or namespace matches any value.
+    # Computed by prepare_output(). See resources_page().
+    self._resources_index = None
+    # (ID, timestamp) of an output resource to its JSON representation.
+    # Filled by resource_json() and inherited from the previous graph by
+    # prepare_output().
+    self._resource_fragments = {}
+    # (ID, timestamp, attribute) of an output resource to the packed value
+    # of the attribute. Filled by resource_packed_plain() and inherited from
+    # the previous graph by prepare_output().
+    self._packed_plain = {}
+    # (encoding, output format) to the encoded output. See
+    # dump_compressed() and dump_packed().
+    self._encoded_outputs_lock = threading.Lock()
+    self._encoded_outputs = {}
+    # (alternateLabel, label) annotations to the best label. See
+    # best_label().
+    self._best_labels = {}
+    self._output_ready = False
+    # The version is assigned when the graph is published in the global
+    # state (see GlobalState.set_context_graph()).
+    self._version = None
+    # The maximal timestamp in seconds of the resources and relations. It is
+    # updated by add_resource() and add_relation().
+    self._max_timestamp = None
     self._previous_relations_to_timestamps = {}
     self._current_relations_to_timestamps = {}
 
+  def freeze(self):
+    """Marks the graph as complete.
+
+    After this call the graph must not be modified, and it may be read
+    concurrently by multiple threads without locking.
+
+    Returns:
+    The frozen graph ('self').
+    """
+    assert not self._frozen
+    self._frozen = True
+    return self
+
+  def prepare_output(self, previous=None):
+    """Sorts the resources and relations and computes the output.
+
+    The resources and relations carry timestamps in seconds since the epoch.
+    The output contains shallow copies of them with timestamps in ISO 8601
+    format, and the index of the output resources.
+
+    The JSON representations and the packed annotations and properties of
+    the unchanged resources are inherited from the 'previous' graph (see
+    resource_json() and resource_packed_plain()).
+
+    The work is done only once per graph. It must complete before the
+    graph is shared with other threads, because the lists are sorted in
+    place.
+
+    Args:
+      previous: the previously published graph or None.
+
+    Returns:
+    The prepared graph ('self').
+    """
+    assert self._frozen
+    assert (previous is None) or isinstance(previous, ContextGraph)
+    if not self._output_ready:
+      self._context_resources.sort(key=operator.itemgetter('id'))
+      self._context_relations.sort(
+          key=operator.itemgetter('source', 'target'))
+      self._output_resources = [utilities.with_iso_timestamp(r)
+                                for r in self._context_resources]
+      self._output_relations = [utilities.with_iso_timestamp(r)
+                                for r in self._context_relations]
+      self._resources_index = self._make_resources_index()
+      if previous is not None:
+        # Other threads may add fragments to 'previous' concurrently, so
+        # look them up instead of iterating on them.
+        old_fragments = previous._resource_fragments
+        old_packed_plain = previous._packed_plain
+        for resource in self._output_resources:
+          key = (resource['id'], resource['timestamp'])
+          fragment = old_fragments.get(key)
+          if fragment is not None:
+            self._resource_fragments[key] = fragment
+          for attribute in msgpack_format.PLAIN_KEYS:
+            packed = old_packed_plain.get(key + (attribute,))
+            if packed is not None:
+              self._packed_plain[key + (attribute,)] = packed
+      self._output_ready = True
+    return self
+
+  def resource_json(self, resource):
+    """Returns the JSON representation of an output resource.
+
+    The representation is computed once per resource version and cached.
+    A resource version is identified by the resource ID and timestamp.
+    The caches give an object a new timestamp exactly when its timeless
+    hash changes, and keep it when only other objects of the same kind
+    change (see simple_cache.SimpleCache.update()). Containers and images
+    inherit the timestamps of their pods. Concurrent callers may compute
+    the same representation, which is harmless.
+
+    Args:
+      resource: an output resource of this graph.
+
+    Returns:
+    The JSON representation of 'resource'.
+    """
+    key = (resource['id'], resource['timestamp'])
+    fragment = self._resource_fragments.get(key)
+    if fragment is None:
+      fragment = utilities.dumps_json(resource)
+      self._resource_fragments[key] = fragment
+    return fragment
+
+  def resource_packed_plain(self, obj, attribute):
+    """Returns the packed value of an attribute of an output resource.
+
+    The packed values are computed once per resource version and cached
+    like the JSON representations. A resource version is identified by the
+    resource ID and timestamp, which changes exactly when the resource data
+    changes (see resource_json()). The values of the attributes of other
+    objects, such as relations, are not cached.
+
+    Args:
+      obj: an output resource of this graph or another output object.
+      attribute: an attribute in msgpack_format.PLAIN_KEYS.
+
+    Returns:
+    msgpack_format.pack_plain(obj[attribute]).
+    """
+    if 'id' not in obj:
+      return msgpack_format.pack_plain(obj[attribute])
+
+    key = (obj['id'], obj['timestamp'], attribute)
+    packed = self._packed_plain.get(key)
+    if packed is None:
+      packed = msgpack_format.pack_plain(obj[attribute])
+      self._packed_plain[key] = packed
+    return packed
+
+  def iter_json(self, response):
+    """Generates the JSON representation of a response of this graph.
+
+    The representation is generated in chunks of about
+    constants.OUTPUT_CHUNK_SIZE bytes, and the resources are represented by
+    their cached JSON fragments (see resource_json()).
+
+    Args:
+      response: the output of to_context_graph(), to_context_resources(),
+        or another response whose resources are output resources of this
+        graph.
+
+    Yields:
+    Consecutive chunks of the JSON representation of 'response'.
+    """
+    assert self._output_ready
+    return utilities.iter_response_json(
+        response, self.resource_json, constants.OUTPUT_CHUNK_SIZE)
+
+  def to_json(self, response):
+    """Returns the JSON representation of a response of this graph.
+
+    See iter_json().
+    """
+    return ''.join(self.iter_json(response))
+
+  def _resource_namespace(self, resource):
+    """Returns the Kubernetes namespace of the given resource or None.
+
+    A Container belongs to the namespace of its parent Pod. Nodes, Images
+    and the Cluster do not belong to any namespace.
+    """
+    if resource['type'] == 'Container':
+      for rel in self._in_relations.get(resource['id'], []):
+        if rel['type'] == 'contains':
+          parent = self._id_to_resource.get(rel['source'])
+          return (None if parent is None
+                  else self._resource_namespace(parent))
+      return None
+
+    return utilities.get_attribute(
+        resource, ['properties', 'metadata', 'namespace'])
+
+  def _make_resources_index(self):
+    """Computes the index of the output resources by type and namespace.
+
+    Must be called by prepare_output() after the output resources are
+    computed.
+
+    Returns:
+    A dictionary from (type, namespace) to a tuple (IDs, resources) of the
+    resources with the given type and namespace, sorted by ID. A None type
+    or namespace in the key matches any type or namespace.
+    """
+    index = {}
+    for resource in self._output_resources:
+      rtype = resource['type']
+      namespace = self._resource_namespace(resource)
+      keys = [(None, None), (rtype, None)]
+      if namespace is not None:
+        keys.extend([(None, namespace), (rtype, namespace)])
+      for key in keys:
+        ids, resources = index.setdefault(key, ([], []))
+        ids.append(resource['id'])
+        resources.append(resource)
+
+    return index
+
+  def is_frozen(self):
+    return self._frozen
+
+  def get_version(self):
+    return self._version
+
+  def set_version(self, version):
+    assert self._frozen
+    assert isinstance(version, int) and version >= 0
+    assert self._version is None
+    self._version = version
+
   def get_relations_to_timestamps(self):
-    with self._lock:
-      return self._current_relations_to_timestamps
+    return self._current_relations_to_timestamps
 
   def set_relations_to_timestamps(self, d):
     assert isinstance(d, dict)
-    with self._lock:
-      self._previous_relations_to_timestamps = d
+    assert not self._frozen
+    self._previous_relations_to_timestamps = d
 
   def add_resource(self, rid, annotations, rtype, timestamp, obj):
-    """Adds a resource to the context graph."""
+    """Adds a resource to the context graph.
+
+    'timestamp' is in seconds since the epoch.
+    """
+    assert not self._frozen
     assert utilities.valid_string(rid)
     assert utilities.valid_string(utilities.get_attribute(
         annotations, ['label']))
     assert utilities.valid_string(rtype)
-    assert utilities.valid_string(timestamp)
+    assert isinstance(timestamp, float)
     assert isinstance(obj, dict)
 
-    with self._lock:
-      # It is possible that the same resource is referenced by more than one
-      # parent. In this case the resource is added only once.
-      if rid in self._id_set:
-        return
-
-      # Add the resource to the context graph data structure.
-      resource = {
-          'id': rid,
-          'type': rtype,
-          'timestamp': timestamp,
-          'annotations': copy.deepcopy(annotations)
-      }
+    # It is possible that the same resource is referenced by more than one
+    # parent. In this case the resource is added only once.
+    if rid in self._id_to_resource:
+      return
+
+    # Add the resource to the context graph data structure.
+    resource = {
+        'id': rid,
+        'type': rtype,
+        'timestamp': timestamp,
+        'annotations': copy.deepcopy(annotations)
+    }
 
-      resource['properties'] = obj
+    resource['properties'] = obj
 
-      self._context_resources.append(resource)
-      self._id_set.add(rid)
+    self._context_resources.append(resource)
+    self._id_to_resource[rid] = resource
+    self._update_max_timestamp(timestamp)
 
   def add_relation(self, source, target, kind, label=None, metadata=None):
     """Adds a relation to the context graph."""
+    assert not self._frozen
     assert utilities.valid_string(source) and utilities.valid_string(target)
     assert utilities.valid_string(kind)
     assert utilities.valid_optional_string(label)
     assert (metadata is None) or isinstance(metadata, dict)
 
-    with self._lock:
-      # The timestamp of the relation should be inherited from the previous
-      # context graph.
-      key = (source, target, kind)
-      timestamp = self._previous_relations_to_timestamps.get(key)
-      if not utilities.valid_string(timestamp):
-        timestamp = utilities.now()
-
-      # Add the relation to the context graph data structure.
-      relation = {
-          'source': source,
-          'target': target,
-          'type': kind,
-          'timestamp': timestamp
-      }
-      self._current_relations_to_timestamps[key] = timestamp
-
-      # Add annotations as needed.
-      relation['annotations'] = {}
-      if metadata is not None:
-        relation['annotations']['metadata'] = copy.deep_copy(metadata)
-      relation['annotations']['label'] = label if label is not None else kind
-
-      self._context_relations.append(relation)
+    # The timestamp of the relation should be inherited from the previous
+    # context graph.
+    key = (source, target, kind)
+    timestamp = self._previous_relations_to_timestamps.get(key)
+    if timestamp is None:
+      timestamp = time.time()
+
+    # Add the relation to the context graph data structure.
+    relation = {
+        'source': source,
+        'target': target,
+        'type': kind,
+        'timestamp': timestamp
+    }
+    self._current_relations_to_timestamps[key] = timestamp
+
+    # Add annotations as needed.
+    relation['annotations'] = {}
+    if metadata is not None:
+      relation['annotations']['metadata'] = copy.deepcopy(metadata)
+    relation['annotations']['label'] = label if label is not None else kind
+
+    self._context_relations.append(relation)
+    self._key_to_relation[key] = relation
+    self._out_relations.setdefault(source, []).append(relation)
+    self._in_relations.setdefault(target, []).append(relation)
+    self._update_max_timestamp(timestamp)
+
+  def _update_max_timestamp(self, timestamp):
+    if (self._max_timestamp is None) or (timestamp > self._max_timestamp):
+      self._max_timestamp = timestamp
 
   def set_title(self, title):
     """Sets the title of the context graph."""
-    with self._lock:
-      self._graph_title = title
+    assert not self._frozen
+    self._graph_title = title
 
   def set_metadata(self, metadata):
     """Sets the metadata of the context graph."""
-    with self._lock:
-      self._graph_metadata = metadata
+    assert not self._frozen
+    self._graph_metadata = metadata
 
   def max_resources_and_relations_timestamp(self):
-    """Computes the maximal timestamp of all resources and relations.
+    """Returns the maximal timestamp of all resources and relations.
 
-    Must be called while holding self._lock.
+    The maximal timestamp is tracked as resources and relations are added,
+    so this method does not scan the graph.
     If there are no resources and no relations, return the current time.
 
     Returns:
-    Maximum timestamp of all resources and relations.
+    Maximum timestamp of all resources and relations in ISO 8601 format.
     """
-    max_timestamp = None
-    for r in self._context_resources:
-      if (max_timestamp is None) or (r['timestamp'] > max_timestamp):
-        max_timestamp = r['timestamp']
-
-    for r in self._context_relations:
-      if (max_timestamp is None) or (r['timestamp'] > max_timestamp):
-        max_timestamp = r['timestamp']
-
-    return utilities.now() if max_timestamp is None else max_timestamp
+    if self._max_timestamp is None:
+      return utilities.now()
+    return utilities.seconds_to_timestamp(self._max_timestamp)
 
   def to_context_graph(self):
     """Returns the context graph in cluster-insight context graph format."""
+    assert self._output_ready
     # return graph in Cluster-Insight context graph format.
-    with self._lock:
-      context_graph = {
-          'success': True,
-          'timestamp': self.max_resources_and_relations_timestamp(),
-          'resources': self._context_resources,
-          'relations': self._context_relations,
-      }
-      return context_graph
+    context_graph = {
+        'success': True,
+        'timestamp': self.max_resources_and_relations_timestamp(),
+        'version': self._version,
+        'resources': self._output_resources,
+        'relations': self._output_relations,
+    }
+    return context_graph
 
   def to_context_resources(self):
     """Returns just the resources in Cluster-Insight context graph format."""
-    with self._lock:
-      resources = {
-          'success': True,
-          'timestamp': self.max_resources_and_relations_timestamp(),
-          'resources': self._context_resources,
-      }
-      return resources
+    assert self._output_ready
+    resources = {
+        'success': True,
+        'timestamp': self.max_resources_and_relations_timestamp(),
+        'version': self._version,
+        'resources': self._output_resources,
+    }
+    return resources
+
+  def resources_page(self, rtype, namespace, selector, limit, after):
+    """Returns a page of the resources matching the given filters.
+
+    The resources are returned in the order of their IDs. The cost of a
+    page is proportional to its size (plus the number of resources skipped
+    by 'selector'), and not to the size of the graph.
+
+    Args:
+      rtype: the resource type (for example, 'Pod') or None for any type.
+      namespace: the Kubernetes namespace or None for any namespace.
+      selector: a dictionary of label key/value pairs. A resource matches
+        if all of the pairs appear in its labels. None matches any resource.
+      limit: the maximal number of resources in the page or None for all
+        matching resources.
+      after: return only resources whose ID follows 'after', or None to
+        start from the first resource.
+
+    Returns:
+    A tuple (resources, last_id). 'last_id' is the ID of the last resource
+    in the page if there may be more matching resources after it, and None
+    otherwise.
+    """
+    assert self._output_ready
+    assert (rtype is None) or utilities.valid_string(rtype)
+    assert (namespace is None) or utilities.valid_string(namespace)
+    assert (selector is None) or isinstance(selector, dict)
+    assert (limit is None) or (isinstance(limit, int) and limit > 0)
+    assert (after is None) or isinstance(after, types.StringTypes)
+
+    ids, candidates = self._resources_index.get((rtype, namespace), ([], []))
+    i = 0 if after is None else bisect.bisect_right(ids, after)
+    page = []
+    while i < len(candidates):
+      if (limit is not None) and (len(page) >= limit):
+        return (page, page[-1]['id'])
+
+      resource = candidates[i]
+      i += 1
+      if selector:
+        labels = utilities.get_attribute(
+            resource, ['properties', 'metadata', 'labels'])
+        if not (isinstance(labels, dict) and
+                selector.viewitems() <= labels.viewitems()):
+          continue
+      page.append(resource)
+
+    return (page, None)
+
+  def compute_delta(self, previous):
+    """Computes the changes from the 'previous' graph to this graph.
+
+    Resources are identified by their ID, and relations by their
+    (source, target, type) key. A resource or relation is modified if any
+    of its attributes changed. The caches keep the timestamp of an object
+    until the object changes (see SimpleCache.update()), and relations keep
+    their timestamps across builds, so unchanged items compare equal.
+
+    Args:
+      previous: the previous frozen context graph or None. If it is None,
+        all resources and relations of this graph are added.
+
+    Returns:
+    None if there are no changes. Otherwise a dictionary with the attributes
+    'resources' and 'relations'. Their values are dictionaries from the
+    resource ID or relation key to a tuple (change, value), where 'change' is
+    one of 'added', 'modified' or 'removed', and 'value' is the new resource
+    or relation (None if it was removed).
+    """
+    assert self._frozen
+    assert (previous is None) or previous.is_frozen()
+
+    def diff(old_items, new_items):
+      changes = {}
+      for key, value in new_items.iteritems():
+        old_value = old_items.get(key)
+        if old_value is None:
+          changes[key] = ('added', value)
+        elif old_value != value:
+          changes[key] = ('modified', value)
+      for key in old_items:
+        if key not in new_items:
+          changes[key] = ('removed', None)
+      return changes
+
+    if previous is None:
+      old_resources, old_relations = {}, {}
+    else:
+      old_resources = previous._id_to_resource
+      old_relations = previous._key_to_relation
+
+    resources = diff(old_resources, self._id_to_resource)
+    relations = diff(old_relations, self._key_to_relation)
+    if not (resources or relations):
+      return None
+
+    return {'resources': resources, 'relations': relations}
+
+  def subgraph(self, root, depth, direction):
+    """Returns the part of the context graph around the given resource.
+
+    The subgraph is computed by a breadth-first traversal from 'root' using
+    the adjacency indexes, so its cost is proportional to the size of the
+    subgraph and not to the size of the whole graph.
+
+    Args:
+      root: the ID of the root resource (for example, 'Node:xyz').
+      depth: the maximal number of relations between the root and any
+        resource in the subgraph.
+      direction: 'out' follows relations from their source to their target,
+        'in' follows them from their target to their source, and 'both'
+        follows them in either direction.
+
+    Returns:
+    The subgraph in Cluster-Insight context graph format.
+    The timestamps are in ISO 8601 format.
+
+    Raises:
+      CollectorError: if 'root' is not a resource in the graph.
+    """
+    assert self._frozen
+    assert utilities.valid_string(root)
+    assert isinstance(depth, int) and depth >= 0
+    assert direction in ('out', 'in', 'both')
+
+    if root not in self._id_to_resource:
+      msg = 'resource %s not found in the context graph' % root
+      app.logger.error(msg)
+      raise collector_error.CollectorError(msg)
+
+    visited = set([root])
+    resources = [self._id_to_resource[root]]
+    relations = []
+    frontier = [root]
+    for _ in xrange(depth):
+      if not frontier:
+        break
+      next_frontier = []
+      for rid in frontier:
+        neighbors = []
+        if direction in ('out', 'both'):
+          neighbors.extend((rel, rel['target'])
+                           for rel in self._out_relations.get(rid, []))
+        if direction in ('in', 'both'):
+          neighbors.extend((rel, rel['source'])
+                           for rel in self._in_relations.get(rid, []))
+        for rel, neighbor_id in neighbors:
+          if neighbor_id not in self._id_to_resource:
+            continue
+          relations.append(rel)
+          if neighbor_id not in visited:
+            visited.add(neighbor_id)
+            resources.append(self._id_to_resource[neighbor_id])
+            next_frontier.append(neighbor_id)
+      frontier = next_frontier
+
+    if direction == 'both':
+      # A relation may be reached from both of its ends.
+      unique_relations = {}
+      for rel in relations:
+        unique_relations[id(rel)] = rel
+      relations = unique_relations.values()
+
+    max_timestamp = None
+    for r in resources + relations:
+      if (max_timestamp is None) or (r['timestamp'] > max_timestamp):
+        max_timestamp = r['timestamp']
+
+    return {
+        'success': True,
+        'timestamp': utilities.seconds_to_timestamp(max_timestamp),
+        'version': self._version,
+        'resources': [utilities.with_iso_timestamp(r) for r in
+                      sorted(resources, key=lambda x: x['id'])],
+        'relations': [utilities.with_iso_timestamp(r) for r in
+                      sorted(relations,
+                             key=lambda x: (x['source'], x['target']))],
+    }
 
   def best_label(self, obj):
     """Returns the best human-readable label of the given object.
@@ -205,7 +642,8 @@ class ContextGraph(object):
     We prefer the "alternateLabel" over "label" and a string not composed
     of only hexadecimal digits over hexadecimal digits.
 
-    This function must be called when self._lock is held.
+    The label is selected once per combination of labels and memoised.
+    Concurrent callers may select the same label, which is harmless.
 
     Args:
       obj: a dictionary containing an "annotations" attribute. The value
@@ -215,51 +653,161 @@ class ContextGraph(object):
     Returns:
     The best human-readable label.
     """
-    alt_label = utilities.get_attribute(obj, ['annotations', 'alternateLabel'])
-    label = utilities.get_attribute(obj, ['annotations', 'label'])
+    annotations = obj.get('annotations')
+    if not isinstance(annotations, dict):
+      annotations = {}
+    key = (annotations.get('alternateLabel'), annotations.get('label'))
+    best = self._best_labels.get(key)
+    if best is not None:
+      return best
+
+    alt_label, label = key
     if (utilities.valid_string(alt_label) and
-        re.search('[^0-9a-fA-F]', alt_label)):
-      return alt_label
-    elif utilities.valid_string(label) and re.search('[^0-9a-fA-F]', label):
-      return label
+        _NON_HEX_REGEXP.search(alt_label)):
+      best = alt_label
+    elif utilities.valid_string(label) and _NON_HEX_REGEXP.search(label):
+      best = label
     elif utilities.valid_string(alt_label):
-      return alt_label
+      best = alt_label
     elif utilities.valid_string(label):
-      return label
+      best = label
     else:
       # should not arrive here.
-      return '<unknown>'
-
-  def to_dot_graph(self, show_node_labels=True):
-    """Returns the context graph in DOT graph format."""
-    with self._lock:
+      best = '<unknown>'
+
+    self._best_labels[key] = best
+    return best
+
+  def _iter_dot_items(self, show_node_labels, omitted_types):
+    """Generates the DOT graph items of iter_dot()."""
+    yield 'digraph{'
+    separator = ''
+    graph_color = self._graph_color
+    for res in self._context_resources:
+      rtype = res['type']
+      if rtype in omitted_types:
+        continue
       if show_node_labels:
-        resource_list = [
-            '"{0}"[label="{1}",color={2}]'.format(
-                res['id'],
-                res['type'] + ':' + self.best_label(res),
-                self._graph_color.get(res['type']) or 'black')
-            for res in self._context_resources]
+        yield '%s"%s"[label="%s:%s",color=%s]' % (
+            separator, res['id'], rtype, self.best_label(res),
+            graph_color.get(rtype) or 'black')
       else:
-        resource_list = [
-            '"{0}"[label="",fillcolor={1},style=filled]'.format(
-                res['id'],
-                self._graph_color.get(res['type']) or 'black')
-            for res in self._context_resources]
-      relation_list = [
-          '"{0}"->"{1}"[label="{2}"]'.format(
-              rel['source'], rel['target'], self.best_label(rel))
-          for rel in self._context_relations]
-      graph_items = resource_list + relation_list
-      graph_data = 'digraph{' + ';'.join(graph_items) + '}'
-      return graph_data
+        yield '%s"%s"[label="",fillcolor=%s,style=filled]' % (
+            separator, res['id'], graph_color.get(rtype) or 'black')
+      separator = ';'
+
+    id_to_resource = self._id_to_resource
+    for rel in self._context_relations:
+      if omitted_types:
+        source = id_to_resource.get(rel['source'])
+        target = id_to_resource.get(rel['target'])
+        if (((source is not None) and (source['type'] in omitted_types)) or
+            ((target is not None) and (target['type'] in omitted_types))):
+          continue
+      yield '%s"%s"->"%s"[label="%s"]' % (
+          separator, rel['source'], rel['target'], self.best_label(rel))
+      separator = ';'
+
+    yield '}'
+
+  def iter_dot(self, show_node_labels=True, omitted_types=()):
+    """Generates the context graph in DOT graph format.
+
+    The output is generated in chunks of about constants.OUTPUT_CHUNK_SIZE
+    bytes, so it is never kept in memory.
+
+    Args:
+      show_node_labels: whether the nodes of the DOT graph are labeled.
+      omitted_types: the types of the resources to omit from the output
+        together with their relations (see constants.DOT_DETAIL_LEVELS).
+
+    Yields:
+    Consecutive chunks of the DOT graph.
+    """
+    assert self._output_ready
+    assert isinstance(show_node_labels, bool)
+    return utilities.iter_chunks(
+        self._iter_dot_items(show_node_labels, frozenset(omitted_types)),
+        constants.OUTPUT_CHUNK_SIZE)
+
+  def to_dot_graph(self, show_node_labels=True):
+    """Returns the context graph in DOT graph format.
+
+    See iter_dot().
+    """
+    return ''.join(self.iter_dot(show_node_labels))
+
+  def _dump_encoded(self, encoding, output_format, encode):
+    """Returns the output of the graph in the given encoding.
+
+    The output is encoded once per graph and cached, so all clients of
+    the same graph version share it. Concurrent callers wait for a single
+    encoding of the output.
+
+    Args:
+      encoding: the name of the encoding.
+      output_format: either 'context_graph' or 'resources'.
+      encode: a function from the output to its encoded representation.
+
+    Returns:
+    The encoded output.
+    """
+    assert self._output_ready
+    assert output_format in ('context_graph', 'resources')
+    key = (encoding, output_format)
+    with self._encoded_outputs_lock:
+      data = self._encoded_outputs.get(key)
+      if data is None:
+        data = encode(self.dump(output_format))
+        self._encoded_outputs[key] = data
+    return data
+
+  def dump_compressed(self, output_format):
+    """Returns the gzip-compressed JSON output of the graph.
+
+    The output is compressed once per graph and cached. The uncompressed
+    output is compressed chunk by chunk (see iter_json()), so it is never
+    kept in memory.
+
+    Args:
+      output_format: either 'context_graph' or 'resources'.
+
+    Returns:
+    The compressed output.
+    """
+    return self._dump_encoded(
+        'gzip', output_format,
+        lambda output: utilities.gzip_compress(self.iter_json(output)))
+
+  def dump_packed(self, output_format):
+    """Returns the output of the graph in the compact binary format.
+
+    The output is packed once per graph and cached, and the annotations
+    and properties of the resources are packed once per resource version
+    (see resource_packed_plain()).
+
+    Args:
+      output_format: either 'context_graph' or 'resources'.
+
+    Returns:
+    The packed output.
+    """
+    return self._dump_encoded(
+        'msgpack', output_format,
+        lambda output: msgpack_format.pack(
+            output, self.resource_packed_plain))
 
   def dump(self, output_format):
-    """Returns the context graph in the specified format."""
+    """Returns the context graph in the specified format.
+
+    If the graph is not frozen yet, dump() freezes it. If it is not prepared
+    for output yet, dump() prepares it.
+    """
     assert isinstance(output_format, types.StringTypes)
 
-    self._context_resources.sort(key=lambda x: x['id'])
-    self._context_relations.sort(key=lambda x: (x['source'], x['target']))
+    if not self._frozen:
+      self.freeze()
+    self.prepare_output()
 
     if output_format == 'dot':
       return self.to_dot_graph()
@@ -273,6 +821,52 @@ class ContextGraph(object):
       raise collector_error.CollectorError(msg)
 
 
+class ContextGraphShard(ContextGraph):
+  """Records the operations that build one shard of a context graph.
+
+  A ContextGraphShard is used by the worker processes of a parallel graph
+  build (see _do_compute_pods()). Instead of building a graph, it records
+  the add_resource() and add_relation() calls, so the calling process can
+  replay them into the real graph in a deterministic order.
+
+  The recorded operations are picklable, so they can be returned from
+  a worker process.
+  """
+
+  def __init__(self):
+    super(ContextGraphShard, self).__init__()
+    self._operations = []
+
+  def add_resource(self, rid, annotations, rtype, timestamp, obj):
+    self._operations.append(
+        ('add_resource', (rid, annotations, rtype, timestamp, obj)))
+
+  def add_relation(self, source, target, kind, label=None, metadata=None):
+    self._operations.append(
+        ('add_relation', (source, target, kind, label, metadata)))
+
+  def get_operations(self):
+    return self._operations
+
+
+def replay_operations(operations, g):
+  """Applies the operations recorded by a ContextGraphShard to 'g'.
+
+  Args:
+    operations: a list of operations returned by
+      ContextGraphShard.get_operations().
+    g: the context graph under construction.
+  """
+  assert isinstance(operations, list)
+  assert isinstance(g, ContextGraph)
+  for name, args in operations:
+    if name == 'add_resource':
+      g.add_resource(*args)
+    else:
+      assert name == 'add_relation'
+      g.add_relation(*args)
+
+
 def _do_compute_node(cluster_guid, node, g):
   assert utilities.valid_string(cluster_guid)
   assert utilities.is_wrapped_object(node, 'Node')
@@ -285,10 +879,21 @@ def _do_compute_node(cluster_guid, node, g):
   g.add_relation(cluster_guid, node_guid, 'contains')  # Cluster contains Node
 
 
-def _do_compute_pod(cluster_guid, pod, g):
+def _do_compute_pod(cluster_guid, pod, g, containers=None):
+  """Adds the pod, its containers and their images to the graph.
+
+  Args:
+    cluster_guid: the cluster's ID.
+    pod: a wrapped Pod object.
+    g: the context graph under construction.
+    containers: the (container, image) pairs of the pod as returned by
+      kubernetes.get_pod_containers(). If it is None, they are derived from
+      the pod.
+  """
   assert utilities.valid_string(cluster_guid)
   assert utilities.is_wrapped_object(pod, 'Pod')
   assert isinstance(g, ContextGraph)
+  assert (containers is None) or isinstance(containers, list)
 
   pod_id = pod['id']
   pod_guid = 'Pod:' + pod_id
@@ -306,14 +911,90 @@ def _do_compute_pod(cluster_guid, pod, g):
     # Pod is not running.
     g.add_relation(cluster_guid, pod_guid, 'contains')  # Cluster contains Pod
 
-  for container in kubernetes.get_containers_from_pod(pod):
-    metrics.annotate_container(container, pod)
-    _do_compute_container(pod_guid, container, g)
+  if containers is None:
+    containers = kubernetes.derive_pod_containers(pod)
+  for container, image in containers:
+    _do_compute_container(pod_guid, container, image, g)
+
+
+def _compute_pods_shard(args):
+  """Computes the graph operations of a shard of pods in a worker process.
+
+  Args:
+    args: a tuple (cluster_guid, indexed_pods), where 'indexed_pods' is a
+      list of (index, wrapped Pod object, containers) tuples, and
+      'containers' is the list of (container, image) pairs of the pod as
+      returned by kubernetes.get_pod_containers().
+
+  Returns:
+  A list of (index, operations) pairs, where 'operations' is the list of
+  graph operations computed for the pod at position 'index' of the pods list.
+  """
+  cluster_guid, indexed_pods = args
+  result = []
+  for index, pod, containers in indexed_pods:
+    shard = ContextGraphShard()
+    _do_compute_pod(cluster_guid, pod, shard, containers)
+    result.append((index, shard.get_operations()))
+
+  return result
+
 
+def _do_compute_pods(gs, cluster_guid, pods_list, g):
+  """Adds the pods, their containers and their images to the graph.
+
+  If the global state has a pool of build processes, the pods are sharded
+  by their node name across the pool. Each worker computes the resources
+  and relations of its pods, and the results are merged into 'g' in the
+  order of 'pods_list', so the resulting graph is identical to the one
+  computed serially. The containers of the pods are looked up by the
+  calling process (see kubernetes.get_pod_containers()) and passed to the
+  workers, so the workers do not derive them again.
+
+  Args:
+    gs: the global state.
+    cluster_guid: the cluster's ID.
+    pods_list: a list of wrapped Pod objects.
+    g: the context graph under construction.
+  """
+  assert isinstance(gs, global_state.GlobalState)
+  assert utilities.valid_string(cluster_guid)
+  assert isinstance(pods_list, list)
+  assert isinstance(g, ContextGraph)
 
-def _do_compute_container(parent_guid, container, g):
+  pool = gs.get_build_pool()
+  if (pool is None) or (len(pods_list) < constants.MIN_PODS_FOR_PARALLEL_BUILD):
+    for pod in pods_list:
+      _do_compute_pod(cluster_guid, pod, g,
+                      kubernetes.get_pod_containers(gs, pod))
+    return
+
+  # Shard the pods by their node name, so that the pods of a node are
+  # processed by the same worker.
+  num_shards = gs.get_build_processes() * constants.BUILD_SHARDS_PER_PROCESS
+  shards = [[] for _ in range(num_shards)]
+  for index, pod in enumerate(pods_list):
+    node_id = utilities.get_attribute(pod, ['properties', 'spec', 'nodeName'])
+    shard_index = hash(node_id or '') % num_shards
+    shards[shard_index].append(
+        (index, pod, kubernetes.get_pod_containers(gs, pod)))
+
+  indexed_operations = []
+  for shard_result in pool.map(
+      _compute_pods_shard,
+      [(cluster_guid, shard) for shard in shards if shard], chunksize=1):
+    indexed_operations.extend(shard_result)
+
+  # Merge the results in the original order of the pods.
+  indexed_operations.sort(key=lambda x: x[0])
+  for _, operations in indexed_operations:
+    replay_operations(operations, g)
+
+
+def _do_compute_container(parent_guid, container, image, g):
   assert utilities.valid_string(parent_guid)
   assert utilities.is_wrapped_object(container, 'Container')
+  assert utilities.is_wrapped_object(image, 'Image')
   assert isinstance(g, ContextGraph)
 
   container_id = container['id']
@@ -326,7 +1007,6 @@ def _do_compute_container(parent_guid, container, g):
   # The parent Pod contains Container.
   g.add_relation(parent_guid, container_guid, 'contains')
 
-  image = kubernetes.get_image_from_container(container)
   image_guid = 'Image:' + image['id']
 
   # Add the image to the graph only if we have not added it before.
@@ -419,13 +1099,13 @@ def _do_compute_other_nodes(gs, cluster_guid, nodes_list, oldest_timestamp, g):
     gs: the global state.
     cluster_guid: the cluster's ID.
     nodes_list: a list of wrapped Node objects.
-    oldest_timestamp: the timestamp of the oldest Node object.
+    oldest_timestamp: the timestamp in seconds of the oldest Node object.
     g: the context graph under construction.
   """
   assert isinstance(gs, global_state.GlobalState)
   assert utilities.valid_string(cluster_guid)
   assert isinstance(nodes_list, list)
-  assert utilities.valid_string(oldest_timestamp)
+  assert isinstance(oldest_timestamp, float)
   assert isinstance(g, ContextGraph)
 
   # Compute the set of known Node names.
@@ -463,88 +1143,550 @@ def _do_compute_other_nodes(gs, cluster_guid, nodes_list, oldest_timestamp, g):
     g.add_relation(cluster_guid, node_guid, 'contains')  # Cluster contains Node
 
 
-def _do_compute_graph(gs, output_format):
-  """Returns the context graph in the specified format.
+def _do_build_graph(gs):
+  """Builds the context graph and publishes it in the global state.
+
+  Every phase of the build is traced as a span named 'build.<phase>', and
+  its duration is recorded in gs.get_monitoring().build_phase_seconds.
 
   Args:
     gs: the global state.
-    output_format: one of 'dot', 'context_graph', or 'resources'.
 
   Returns:
-    A successful response in the specified format.
+    The published context graph. If the new graph is identical to the
+    previously published graph, returns the previous graph, so its sorted
+    output is reused.
 
   Raises:
     CollectorError: inconsistent or invalid graph data.
   """
   assert isinstance(gs, global_state.GlobalState)
-  assert utilities.valid_string(output_format)
+
+  phase_seconds = gs.get_monitoring().build_phase_seconds
+
+  def phase(name):
+    # A span whose duration is also recorded in the histogram of the phase.
+    return tracing.span(
+        'build.' + name,
+        observe=functools.partial(phase_seconds.observe, (name,)))
+
+  with phase('fetch'):
+    # Fetch the resources of all kinds concurrently.
+    kubernetes.prefetch_resources(gs)
 
   g = ContextGraph()
   g.set_relations_to_timestamps(gs.get_relations_to_timestamps())
 
   # Nodes
-  nodes_list = kubernetes.get_nodes_with_metrics(gs)
-  if not nodes_list:
-    return g.dump(output_format)
+  with phase('nodes'):
+    nodes_list = kubernetes.get_nodes_with_metrics(gs)
+    if nodes_list:
+      # Find the timestamp of the oldest node. This will be the timestamp of
+      # the cluster.
+      oldest_timestamp = time.time()
+      for node in nodes_list:
+        assert utilities.is_wrapped_object(node, 'Node')
+        oldest_timestamp = min(oldest_timestamp, node['timestamp'])
+
+      # The cluster name may be available through the Kubernetes API
+      # someday.
+      # TODO(rimey): Determine the cluster name.
+      cluster_name = '_unknown_'
+      cluster_guid = 'Cluster:' + cluster_name
+      g.set_title(cluster_name)
+      g.add_resource(cluster_guid, {'label': cluster_name}, 'Cluster',
+                     oldest_timestamp, {})
+
+      for node in nodes_list:
+        _do_compute_node(cluster_guid, node, g)
 
-  # Find the timestamp of the oldest node. This will be the timestamp of
-  # the cluster.
-  oldest_timestamp = utilities.now()
-  for node in nodes_list:
-    assert utilities.is_wrapped_object(node, 'Node')
-    # note: we cannot call min(oldest_timestamp, node['timestamp']) here
-    # because min(string) returnes the smallest character in the string.
-    if node['timestamp'] < oldest_timestamp:
-      oldest_timestamp = node['timestamp']
-
-  # The cluster name may be available through the Kubernetes API someday.
-  # TODO(rimey): Determine the cluster name.
-  cluster_name = '_unknown_'
-  cluster_guid = 'Cluster:' + cluster_name
-  g.set_title(cluster_name)
-  g.add_resource(cluster_guid, {'label': cluster_name}, 'Cluster',
-                 oldest_timestamp, {})
-
-  # Nodes
-  for node in nodes_list:
-    _do_compute_node(cluster_guid, node, g)
+  if not nodes_list:
+    with phase('publish'):
+      return gs.set_context_graph(g.freeze())
 
   # Pods
-  for pod in kubernetes.get_pods(gs):
-    _do_compute_pod(cluster_guid, pod, g)
+  with phase('pods'):
+    _do_compute_pods(gs, cluster_guid, kubernetes.get_pods(gs), g)
 
   # Services
-  for service in kubernetes.get_services(gs):
-    _do_compute_service(gs, cluster_guid, service, g)
+  with phase('services'):
+    for service in kubernetes.get_services(gs):
+      _do_compute_service(gs, cluster_guid, service, g)
 
   # ReplicationControllers
-  for rcontroller in kubernetes.get_rcontrollers(gs):
-    _do_compute_rcontroller(gs, cluster_guid, rcontroller, g)
+  with phase('rcontrollers'):
+    for rcontroller in kubernetes.get_rcontrollers(gs):
+      _do_compute_rcontroller(gs, cluster_guid, rcontroller, g)
+
+  with phase('finish'):
+    # Other nodes, not on the list, such as the Kubernetes master.
+    _do_compute_other_nodes(gs, cluster_guid, nodes_list, oldest_timestamp,
+                            g)
+
+    # Keep the relations_to_timestamps mapping for next call.
+    gs.set_relations_to_timestamps(g.get_relations_to_timestamps())
+    g.set_metadata({'timestamp': g.max_resources_and_relations_timestamp()})
+
+  # Freeze the graph, sort it and prepare its output.
+  with phase('publish'):
+    return gs.set_context_graph(g.freeze())
+
+
+@contextlib.contextmanager
+def _admit_build(gs, deadline=None):
+  """A context manager that runs a graph build once it is admitted.
+
+  The wait for admission and the build are traced as the spans 'admission'
+  and 'build'. The build is profiled if gs.get_profiler() is active.
+
+  Args:
+    gs: global state.
+    deadline: the time (in seconds since the epoch) by which the build
+      should finish. The default is constants.COMPUTE_GRAPH_DEADLINE_SECONDS
+      from now.
+
+  Raises:
+    OverloadError: if the build was rejected by gs.get_admission_controller()
+    because the server is too busy to build the graph by the deadline.
+  """
+  if deadline is None:
+    deadline = time.time() + constants.COMPUTE_GRAPH_DEADLINE_SECONDS
+  controller = gs.get_admission_controller()
+  with tracing.span('admission'):
+    controller.acquire(deadline)
+
+  start_time = time.time()
+  try:
+    with tracing.span('build'):
+      profiler = gs.get_profiler()
+      if profiler.is_active():
+        with profiler.profile_build():
+          yield
+      else:
+        yield
+  finally:
+    controller.release(time.time() - start_time)
+
+
+@utilities.global_state_arg
+def build_graph(gs):
+  """Builds the context graph and publishes it in the global state.
+
+  The concurrent calls to build_graph() are admitted by
+  gs.get_admission_controller() (see _admit_build()).
+
+  Args:
+    gs: global state.
+
+  Returns:
+  The published context graph, which is prepared for output.
+
+  Raises:
+    CollectorError: inconsistent or invalid graph data.
+    OverloadError: if the server is too busy to build the graph in time.
+  """
+  with _admit_build(gs):
+    return _do_build_graph(gs)
+
+
+@utilities.global_state_arg
+def get_recent_graph(gs):
+  """Returns a recently built context graph.
+
+  Returns the most recently built context graph if it is less than
+  constants.MAX_CACHED_DATA_AGE_SECONDS old. Otherwise builds a new context
+  graph. The graph builds are admitted by gs.get_admission_controller()
+  (see _admit_build()), and concurrent callers that find a stale graph
+  share a single new build. The callers wait for the shared build at most
+  until their deadline (constants.COMPUTE_GRAPH_DEADLINE_SECONDS).
+
+  Args:
+    gs: global state.
+
+  Returns:
+  A frozen context graph.
+
+  Raises:
+    CollectorError: inconsistent or invalid graph data.
+    OverloadError: if the server is too busy to build the graph in time.
+  """
+  deadline = time.time() + constants.COMPUTE_GRAPH_DEADLINE_SECONDS
+  def is_recent(g, create_seconds):
+    return ((g is not None) and
+            (time.time() < create_seconds +
+             constants.MAX_CACHED_DATA_AGE_SECONDS))
+
+  # Only one thread replaces a stale graph. The other threads wait for it
+  # and use its graph, or replace the graph themselves if its build failed.
+  while True:
+    g, create_seconds = gs.get_context_graph()
+    if is_recent(g, create_seconds):
+      return g
+    claimed, done = gs.claim_graph_build()
+    if claimed:
+      break
+    timeout = deadline - time.time()
+    if (timeout <= 0) or not done.wait(timeout):
+      raise gs.get_admission_controller().reject_expired()
+
+  try:
+    # Another build may have ended since the graph was checked.
+    g, create_seconds = gs.get_context_graph()
+    if is_recent(g, create_seconds):
+      return g
+    with _admit_build(gs, deadline):
+      return _do_build_graph(gs)
+  finally:
+    gs.end_graph_build()
+
+
+def _sort_key(item):
+  """Returns the sort key of a resource or relation in the output."""
+  if 'id' in item:
+    return item['id']
+  return (item['source'], item['target'])
+
+
+def compute_subgraph(gs, root, depth, direction):
+  """Computes the part of the context graph around the given resource.
+
+  The subgraph is extracted from a recently built context graph (see
+  get_recent_graph()).
+
+  Args:
+    gs: global state.
+    root: the ID of the root resource (for example, 'Node:xyz').
+    depth: the maximal number of relations between the root and any
+      resource in the subgraph. It must not exceed
+      constants.MAX_SUBGRAPH_DEPTH.
+    direction: one of 'out', 'in', or 'both'.
+
+  Returns:
+  The subgraph in Cluster-Insight context graph format.
+
+  Raises:
+    CollectorError: if the arguments are invalid, the root resource is not
+      in the context graph, or the graph data is inconsistent.
+  """
+  assert isinstance(gs, global_state.GlobalState)
+  assert utilities.valid_string(root)
+  assert isinstance(depth, int)
+  assert utilities.valid_string(direction)
+
+  if not 0 <= depth <= constants.MAX_SUBGRAPH_DEPTH:
+    msg = 'invalid subgraph depth: %d' % depth
+    app.logger.error(msg)
+    raise collector_error.CollectorError(msg)
+
+  if direction not in ('out', 'in', 'both'):
+    msg = 'invalid subgraph direction: %s' % direction
+    app.logger.error(msg)
+    raise collector_error.CollectorError(msg)
 
-  # Other nodes, not on the list, such as the Kubernetes master.
-  _do_compute_other_nodes(gs, cluster_guid, nodes_list, oldest_timestamp, g)
+  return get_recent_graph(gs).subgraph(root, depth, direction)
 
-  # Keep the relations_to_timestamps mapping for next call.
-  gs.set_relations_to_timestamps(g.get_relations_to_timestamps())
-  g.set_metadata({'timestamp': g.max_resources_and_relations_timestamp()})
 
-  # Dump the resulting graph
-  return g.dump(output_format)
+def _merge_changes(changes_list):
+  """Merges consecutive changes of resources or relations.
 
+  Args:
+    changes_list: a list of dictionaries from a resource ID or relation key
+      to a tuple (change, value), as computed by ContextGraph.compute_delta(),
+      the oldest first.
 
-@utilities.global_state_string_args
-def compute_graph(gs, output_format):
-  """Collects raw information and computes the context graph.
+  Returns:
+  A dictionary with the attributes 'added', 'modified' and 'removed'.
+  'added' and 'modified' are lists of the current values of the added and
+  modified items. 'removed' is a list of the keys of the removed items.
+  An item that was added and then removed is omitted.
+  """
+  # key -> (existed before the first change, current value or None)
+  state = {}
+  for changes in changes_list:
+    for key, (change, value) in changes.iteritems():
+      if key in state:
+        state[key] = (state[key][0], value)
+      else:
+        state[key] = (change != 'added', value)
+
+  result = {'added': [], 'modified': [], 'removed': []}
+  for key, (existed, value) in state.iteritems():
+    if value is None:
+      if existed:
+        result['removed'].append(key)
+    elif existed:
+      result['modified'].append(value)
+    else:
+      result['added'].append(value)
 
-  The number of concurrent calls to compute_graph() is limited by
-  the bounded semaphore gs.get_bounded_semaphore().
+  return result
+
+
+def _make_changes_response(since, version, deltas):
+  """Makes the response containing the merged changes of 'deltas'.
+
+  Args:
+    since: the graph version before the first delta.
+    version: the graph version after the last delta.
+    deltas: a list of global_state.GraphDelta items, the oldest first.
+
+  Returns:
+  A successful response in the format described in compute_changes().
+  """
+  assert isinstance(since, int)
+  assert isinstance(version, int)
+  assert isinstance(deltas, list)
+
+  resources = _merge_changes([d.resources for d in deltas])
+  relations = _merge_changes([d.relations for d in deltas])
+  relations['removed'] = [
+      {'source': source, 'target': target, 'type': kind}
+      for source, target, kind in relations['removed']]
+
+  for changes in (resources, relations):
+    for change in ('added', 'modified'):
+      changes[change] = [utilities.with_iso_timestamp(x) for x in
+                         sorted(changes[change], key=_sort_key)]
+  resources['removed'].sort()
+  relations['removed'].sort(key=_sort_key)
+
+  return {
+      'success': True,
+      'timestamp': utilities.now(),
+      'since': since,
+      'version': version,
+      'resources': resources,
+      'relations': relations,
+  }
+
+
+def compute_changes(gs, since):
+  """Computes the changes of the context graph since the given version.
+
+  A new context graph is built first unless a recent one exists (see
+  get_recent_graph()), so the changes are up to date.
 
   Args:
     gs: global state.
-    output_format: one of 'graph', 'dot', 'context_graph', or 'resources'.
+    since: a graph version previously returned to the client.
 
   Returns:
-  The context graph in the specified format.
+  A successful response with the current 'version' and the added, modified
+  and removed 'resources' and 'relations' since version 'since'.
+  Removed resources are given by their ID, and removed relations by their
+  'source', 'target' and 'type' attributes.
+  If the changes since 'since' are no longer available, returns an error
+  response with the attribute 'resync_required' set to True. The client
+  should then fetch the entire context graph from '/cluster'.
+
+  Raises:
+    CollectorError: inconsistent or invalid graph data.
+  """
+  assert isinstance(gs, global_state.GlobalState)
+  assert isinstance(since, int)
+
+  get_recent_graph(gs)
+  version, deltas = gs.get_graph_deltas_since(since)
+  if deltas is None:
+    response = utilities.make_error(
+        'resync required: changes since version %d are not available' %
+        since)
+    response['resync_required'] = True
+    response['version'] = version
+    return response
+
+  return _make_changes_response(since, version, deltas)
+
+
+def _make_event(event, data):
+  """Returns a server-sent event with the given name and JSON data."""
+  assert utilities.valid_string(event)
+  return _make_json_event(event, utilities.dumps_json(data))
+
+
+def _make_json_event(event, data_json):
+  """Returns a server-sent event with the given name and JSON string."""
+  assert utilities.valid_string(event)
+  return 'event: %s\ndata: %s\n\n' % (event, data_json)
+
+
+def _make_snapshot_event(g, projection):
+  """Returns a 'snapshot' event containing the context graph 'g'."""
+  if projection is None:
+    return _make_json_event('snapshot', g.to_json(g.to_context_graph()))
+  return _make_event('snapshot', utilities.project_response(
+      g.to_context_graph(), projection))
+
+
+def stream_changes(gs, projection=None):
+  """Generates a stream of server-sent events describing the context graph.
+
+  The first event is a 'snapshot' event containing the entire context graph.
+  It is followed by a 'changes' event whenever a new version of the context
+  graph is published, in the format of compute_changes(). If the subscriber
+  falls more than constants.MAX_SUBSCRIBER_QUEUE_SIZE versions behind, it
+  receives a new 'snapshot' event instead of the pending changes.
+
+  When no changes arrive for constants.STREAM_POLL_SECONDS, the generator
+  refreshes the context graph (see get_recent_graph()) and emits a comment
+  to keep the connection alive. The refresh is shared by all subscribers,
+  so many subscribers cost a single graph build per polling interval.
+
+  Args:
+    gs: global state.
+    projection: the projection of the resources in the events (see
+      utilities.parse_fields()) or None for the entire resources.
+
+  Yields:
+  Server-sent events. If building the context graph fails, yields an
+  'error' event containing an error response and stops, unless the server
+  was only too busy to refresh the context graph.
   """
-  with gs.get_bounded_semaphore():
-    return _do_compute_graph(gs, output_format)
+  assert isinstance(gs, global_state.GlobalState)
+
+  q = gs.add_graph_subscriber()
+  try:
+    try:
+      g = get_recent_graph(gs)
+    except collector_error.CollectorError as e:
+      yield _make_event('error', utilities.make_error(str(e)))
+      return
+
+    version = g.get_version()
+    yield _make_snapshot_event(g, projection)
+
+    while True:
+      try:
+        delta = q.get(timeout=constants.STREAM_POLL_SECONDS)
+      except Queue.Empty:
+        try:
+          get_recent_graph(gs)
+        except collector_error.OverloadError:
+          # Other requests are building graphs. Keep the stream open.
+          pass
+        except collector_error.CollectorError as e:
+          yield _make_event('error', utilities.make_error(str(e)))
+          return
+        yield ': keepalive\n\n'
+        continue
+
+      if delta is None:
+        # This subscriber fell behind. Start over from the current graph.
+        g, _ = gs.get_context_graph()
+        version = g.get_version()
+        yield _make_snapshot_event(g, projection)
+      elif delta.version > version:
+        yield _make_event('changes', utilities.project_response(
+            _make_changes_response(version, delta.version, [delta]),
+            projection))
+        version = delta.version
+  finally:
+    gs.remove_graph_subscriber(q)
+
+
+def _parse_selector(selector):
+  """Parses a label selector of the form 'key1=value1,key2=value2'.
+
+  Returns:
+  A dictionary of the label key/value pairs.
+
+  Raises:
+    CollectorError: if the selector is invalid.
+  """
+  assert isinstance(selector, types.StringTypes)
+  result = {}
+  for requirement in selector.split(','):
+    key, sep, value = requirement.partition('=')
+    if not (sep and key.strip()):
+      msg = 'invalid label selector: %s' % selector
+      app.logger.error(msg)
+      raise collector_error.CollectorError(msg)
+    result[key.strip()] = value.strip()
+
+  return result
+
+
+def _encode_continue_token(last_id):
+  """Returns an opaque continuation token encoding 'last_id'."""
+  assert utilities.valid_string(last_id)
+  # The padding is removed, so the token may be used in a URL as is.
+  return base64.urlsafe_b64encode(json.dumps({'after': last_id})).rstrip('=')
+
+
+def _decode_continue_token(token):
+  """Returns the resource ID encoded by _encode_continue_token().
+
+  Raises:
+    CollectorError: if the token is invalid.
+  """
+  assert isinstance(token, types.StringTypes)
+  try:
+    padding = '=' * (-len(token) % 4)
+    after = json.loads(base64.urlsafe_b64decode(str(token) + padding))['after']
+  except (TypeError, ValueError, KeyError):
+    after = None
+
+  if not utilities.valid_string(after):
+    msg = 'invalid continuation token: %s' % token
+    app.logger.error(msg)
+    raise collector_error.CollectorError(msg)
+
+  return after
+
+
+def compute_resources_page(gs, rtype, namespace, selector, limit, token):
+  """Computes a page of the resources matching the given filters.
+
+  The page is extracted from a recently built context graph (see
+  get_recent_graph()) using its index of resources by type and namespace.
+
+  Args:
+    gs: global state.
+    rtype: the resource type (for example, 'Pod') or None for any type.
+    namespace: the Kubernetes namespace or None for any namespace.
+    selector: a label selector of the form 'key1=value1,key2=value2' or None.
+    limit: the maximal number of resources in the page or None for all
+      matching resources.
+    token: the continuation token returned with the previous page or None
+      for the first page.
+
+  Returns:
+  A successful response containing the 'resources' in the page, sorted by
+  their IDs. If there may be more matching resources, the response also
+  contains a 'continue' token for fetching the next page. The 'timestamp' of
+  the response is the maximal timestamp of the resources in the page.
+
+  Raises:
+    CollectorError: if the arguments are invalid, such as an empty 'rtype'
+      or 'namespace', or the graph data is inconsistent.
+  """
+  assert isinstance(gs, global_state.GlobalState)
+  assert (rtype is None) or isinstance(rtype, types.StringTypes)
+  assert (namespace is None) or isinstance(namespace, types.StringTypes)
+  assert (limit is None) or isinstance(limit, int)
+
+  if (limit is not None) and not (
+      0 < limit <= constants.MAX_RESOURCES_PAGE_SIZE):
+    msg = 'invalid page size: %d' % limit
+    app.logger.error(msg)
+    raise collector_error.CollectorError(msg)
+
+  for name, value in (('type', rtype), ('namespace', namespace)):
+    if (value is not None) and not utilities.valid_string(value):
+      msg = 'invalid resource %s: %s' % (name, value)
+      app.logger.error(msg)
+      raise collector_error.CollectorError(msg)
+
+  label_selector = None if selector is None else _parse_selector(selector)
+  after = None if token is None else _decode_continue_token(token)
+
+  g = get_recent_graph(gs)
+  resources, last_id = g.resources_page(
+      rtype, namespace, label_selector, limit, after)
+
+  response = utilities.make_response(resources, 'resources')
+  response['version'] = g.get_version()
+  if last_id is not None:
+    response['continue'] = _encode_continue_token(last_id)
+
+  return response
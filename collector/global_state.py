@@ -16,13 +16,23 @@
 
 """Keeps global system state to be used by concurrent threads."""
 
+import binascii
 import collections
+import multiprocessing
+import multiprocessing.pool
+import os
 import Queue  # "Queue" was renamed "queue" in Python 3.
 import thread
 import threading
+import time
+
+import requests
 
 # local imports
+import admission
 import constants
+import monitoring
+import profiling
 import simple_cache
 import utilities
 
@@ -31,6 +41,12 @@ ElapsedRecord = collections.namedtuple(
     'ElapsedRecord',
     ['start_time', 'what', 'thread_identifier', 'elapsed_seconds'])
 
+# The changes from the previous graph version to 'version'. See
+# context.ContextGraph.compute_delta() for the format of 'resources' and
+# 'relations'.
+GraphDelta = collections.namedtuple(
+    'GraphDelta', ['version', 'resources', 'relations'])
+
 
 class GlobalState(object):
   """Keeps global state to be used by concurrent threads.
@@ -46,6 +62,17 @@ class GlobalState(object):
 
   def __init__(self):
     """Initialize internal state."""
+    # Distinguishes the graph versions of this process from those of other
+    # processes, since the versions restart from zero (see get_etag()).
+    self._instance_id = binascii.hexlify(os.urandom(8))
+
+    # Latency histograms and counters (see get_monitoring()).
+    self._monitoring = monitoring.Monitoring()
+
+    # On-demand profiling of graph builds, disabled by default (see
+    # profiling.Profiler).
+    self._profiler = profiling.Profiler()
+
     # pointers to various caches.
     self._nodes_cache = None
     self._pods_cache = None
@@ -53,15 +80,58 @@ class GlobalState(object):
     self._rcontrollers_cache = None
 
     # pointers to synchronization constructs.
-    self._bounded_semaphore = None
+    self._admission_controller = None
+
+    # The HTTP session of the requests to Kubernetes, which keeps their
+    # connections open for reuse, and the pool of threads that send
+    # concurrent requests (see get_fetch_pool()).
+    self._http_session = None
+    self._fetch_pool_lock = threading.Lock()
+    self._fetch_pool = None
 
-    # Elapsed time queue containing ElapsedRecord items.
-    self._elapsed_queue = Queue.Queue()  # a FIFO queue
+    # pool of worker processes for parallel graph builds.
+    self._build_processes = 0
+    self._build_pool = None
+
+    # The most recent ElapsedRecord items.
+    self._elapsed_records = utilities.RingBuffer(
+        constants.MAX_ELAPSED_RECORDS)
+
+    # The most recent request traces and the exporters of finished traces
+    # (see record_trace()).
+    self._traces = utilities.RingBuffer(constants.MAX_TRACES)
+    self._trace_exporters = []
 
     # pointers to shared dictionaries.
     self._relations_lock = threading.Lock()
     self._relations_to_timestamps = {}
 
+    # The most recently built (frozen) context graph and its creation time.
+    # '_graph_deltas' keeps the changes of the recent graph versions as
+    # GraphDelta items, the oldest first.
+    self._context_graph_lock = threading.Lock()
+    self._context_graph = None
+    self._context_graph_create_seconds = None
+    self._graph_version = 0
+    self._graph_deltas = collections.deque(
+        maxlen=constants.MAX_GRAPH_DELTAS)
+
+    # Pod ID to a tuple (pod timestamp, list of (container, image) pairs)
+    # of the containers and images derived from the pod. See
+    # kubernetes.get_pod_containers().
+    self._pod_containers_lock = threading.Lock()
+    self._pod_containers = {}
+
+    # The threading.Event of the build of a context graph that replaces a
+    # stale published graph, or None. The Event is set when the build ends
+    # (see context.get_recent_graph()).
+    self._graph_build_lock = threading.Lock()
+    self._graph_build_done = None
+
+    # Subscriber queues of graph changes (see add_graph_subscriber()).
+    self._subscribers_lock = threading.Lock()
+    self._subscribers = set()
+
   def init_caches_and_synchronization(self):
     """Initializes all caches."""
     self._nodes_cache = simple_cache.SimpleCache(
@@ -77,8 +147,41 @@ class GlobalState(object):
         constants.MAX_CACHED_DATA_AGE_SECONDS,
         constants.CACHE_DATA_CLEANUP_AGE_SECONDS)
 
-    self._bounded_semaphore = threading.BoundedSemaphore(
-        constants.MAX_CONCURRENT_COMPUTE_GRAPH)
+    self._admission_controller = admission.AdmissionController(
+        constants.MIN_CONCURRENT_COMPUTE_GRAPH,
+        constants.INITIAL_CONCURRENT_COMPUTE_GRAPH,
+        constants.MAX_CONCURRENT_COMPUTE_GRAPH,
+        constants.MAX_QUEUED_COMPUTE_GRAPH)
+
+    self._http_session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_maxsize=constants.MAX_CONCURRENT_FETCHES)
+    self._http_session.mount('http://', adapter)
+    self._http_session.mount('https://', adapter)
+
+  def init_build_pool(self, processes):
+    """Creates a pool of worker processes for building context graphs.
+
+    Must be called before the web server starts serving requests, because
+    the worker processes are forked from the current process.
+
+    Args:
+      processes: the number of worker processes. If it is zero, the context
+        graph will be built serially.
+    """
+    assert isinstance(processes, int) and processes >= 0
+    assert self._build_pool is None
+    if processes > 0:
+      self._build_processes = processes
+      self._build_pool = multiprocessing.Pool(processes)
+
+  def close_build_pool(self):
+    """Terminates the worker processes created by init_build_pool()."""
+    if self._build_pool is not None:
+      self._build_pool.terminate()
+      self._build_pool.join()
+      self._build_pool = None
+      self._build_processes = 0
 
   def get_nodes_cache(self):
     return self._nodes_cache
@@ -92,8 +195,35 @@ class GlobalState(object):
   def get_rcontrollers_cache(self):
     return self._rcontrollers_cache
 
-  def get_bounded_semaphore(self):
-    return self._bounded_semaphore
+  def get_admission_controller(self):
+    return self._admission_controller
+
+  def get_build_pool(self):
+    return self._build_pool
+
+  def get_monitoring(self):
+    return self._monitoring
+
+  def get_profiler(self):
+    return self._profiler
+
+  def get_http_session(self):
+    return self._http_session
+
+  def get_fetch_pool(self):
+    """Returns the pool of threads for fetching data concurrently.
+
+    The pool is created on first use, so it costs nothing to the processes
+    that never fetch data concurrently.
+    """
+    with self._fetch_pool_lock:
+      if self._fetch_pool is None:
+        self._fetch_pool = multiprocessing.pool.ThreadPool(
+            constants.MAX_CONCURRENT_FETCHES)
+      return self._fetch_pool
+
+  def get_build_processes(self):
+    return self._build_processes
 
   def get_relations_to_timestamps(self):
     with self._relations_lock:
@@ -104,11 +234,203 @@ class GlobalState(object):
     with self._relations_lock:
       self._relations_to_timestamps = v
 
+  def get_context_graph(self):
+    """Returns the most recently built context graph.
+
+    Returns:
+    A tuple (graph, create_seconds), where 'graph' is the frozen context
+    graph and 'create_seconds' is the time it was published in seconds since
+    the Epoch. Returns (None, None) if no graph was built yet.
+    """
+    with self._context_graph_lock:
+      return (self._context_graph, self._context_graph_create_seconds)
+
+  def set_context_graph(self, g):
+    """Publishes a frozen context graph for use by other threads.
+
+    Assigns a version to the graph. The version is incremented only if the
+    graph differs from the previously published graph, and the changes are
+    kept in a history of the last constants.MAX_GRAPH_DELTAS versions.
+    If the graph is identical to the previously published graph, the
+    previous graph stays published, so a graph version is sorted and
+    indexed only once.
+
+    The graph is compared with the previous graph and prepared for output
+    without holding '_context_graph_lock', so the readers of the published
+    graph do not wait for this work. If another graph is published
+    meanwhile, the graph is compared with that graph instead.
+
+    Args:
+      g: a frozen context.ContextGraph object. It must not be shared with
+        other threads yet.
+
+    Returns:
+    The published graph, which is either 'g' or the identical previous
+    graph.
+    """
+    assert g.is_frozen()
+    while True:
+      with self._context_graph_lock:
+        previous = self._context_graph
+      delta = g.compute_delta(previous)
+      if (delta is not None) or (previous is None):
+        g.prepare_output(previous)
+
+      with self._context_graph_lock:
+        if self._context_graph is not previous:
+          continue
+        if (delta is None) and (previous is not None):
+          # Keep the identical previous graph, which is already prepared
+          # for output.
+          self._context_graph_create_seconds = time.time()
+          return previous
+
+        if delta is not None:
+          self._graph_version += 1
+          self._graph_deltas.append(
+              GraphDelta(version=self._graph_version,
+                         resources=delta['resources'],
+                         relations=delta['relations']))
+
+        g.set_version(self._graph_version)
+        self._context_graph = g
+        self._context_graph_create_seconds = time.time()
+
+        # Notify the subscribers while holding '_context_graph_lock', so
+        # they receive the changes in version order.
+        if delta is not None:
+          self._notify_graph_subscribers(self._graph_deltas[-1])
+
+        return g
+
+  def get_instance_id(self):
+    return self._instance_id
+
+  def get_etag(self, g):
+    """Returns the entity tag of the outputs of the published graph 'g'.
+
+    The entity tag identifies the graph version, so it does not change as
+    long as the published graph does not change.
+
+    Args:
+      g: a published context.ContextGraph object.
+
+    Returns:
+    A string that is unique for the graph version in this process and in
+    other processes.
+    """
+    assert g.get_version() is not None
+    return '%s-%d' % (self._instance_id, g.get_version())
+
+  def get_pod_containers(self):
+    with self._pod_containers_lock:
+      return self._pod_containers
+
+  def set_pod_containers(self, d):
+    assert isinstance(d, dict)
+    with self._pod_containers_lock:
+      self._pod_containers = d
+
+  def claim_graph_build(self):
+    """Claims the build of a graph that replaces a stale published graph.
+
+    Only one build is claimed at a time. The caller that claimed it must
+    call end_graph_build() when the build ends.
+
+    Returns:
+    A tuple (claimed, done), where 'claimed' is True if the caller claimed
+    the build, and 'done' is the threading.Event that is set when the
+    claimed build ends.
+    """
+    with self._graph_build_lock:
+      if self._graph_build_done is not None:
+        return (False, self._graph_build_done)
+      self._graph_build_done = threading.Event()
+      return (True, self._graph_build_done)
+
+  def end_graph_build(self):
+    """Ends the build claimed by claim_graph_build() and wakes its waiters.
+    """
+    with self._graph_build_lock:
+      done = self._graph_build_done
+      self._graph_build_done = None
+    assert done is not None
+    done.set()
+
+  def add_graph_subscriber(self):
+    """Registers a new subscriber of graph changes.
+
+    Every change of the published context graph is put in the subscriber's
+    queue as a GraphDelta item. The queue holds at most
+    constants.MAX_SUBSCRIBER_QUEUE_SIZE items. If the subscriber falls
+    further behind, its queue is cleared and a single None item is put in
+    it, meaning that the subscriber must resynchronize from the current
+    context graph.
+
+    Returns:
+    The subscriber's queue. Pass it to remove_graph_subscriber() when the
+    subscriber is done.
+    """
+    q = Queue.Queue(constants.MAX_SUBSCRIBER_QUEUE_SIZE)
+    with self._subscribers_lock:
+      self._subscribers.add(q)
+    return q
+
+  def remove_graph_subscriber(self, q):
+    with self._subscribers_lock:
+      self._subscribers.discard(q)
+
+  def _notify_graph_subscribers(self, delta):
+    """Puts the given GraphDelta in the queues of all subscribers."""
+    assert isinstance(delta, GraphDelta)
+    with self._subscribers_lock:
+      subscribers = list(self._subscribers)
+
+    for q in subscribers:
+      try:
+        q.put(delta, block=False)
+      except Queue.Full:
+        # A slow subscriber. Replace its pending changes by a request to
+        # resynchronize.
+        while True:
+          try:
+            q.get(block=False)
+          except Queue.Empty:
+            break
+        q.put(None, block=False)
+
+  def get_graph_deltas_since(self, version):
+    """Returns the changes of all graph versions after the given version.
+
+    Args:
+      version: a graph version previously returned to a client.
+
+    Returns:
+    A tuple (current_version, deltas), where 'deltas' is a list of the
+    GraphDelta items of the versions after 'version', the oldest first.
+    'deltas' is None if the changes since 'version' are no longer kept in
+    the history, or if 'version' is later than the current version (for
+    example, because the collector was restarted).
+    """
+    assert isinstance(version, int)
+    with self._context_graph_lock:
+      if version > self._graph_version:
+        return (self._graph_version, None)
+
+      if version == self._graph_version:
+        return (self._graph_version, [])
+
+      if (not self._graph_deltas) or (
+          version < self._graph_deltas[0].version - 1):
+        return (self._graph_version, None)
+
+      return (self._graph_version,
+              [d for d in self._graph_deltas if d.version > version])
+
   def add_elapsed(self, start_time, url_or_fname, elapsed_seconds):
-    """Append an ElapsedRecord of an access operation to the elapsed time queue.
+    """Records the elapsed time of an access operation.
 
-    Keep at most constants.MAX_ELAPSED_QUEUE_SIZE elements in the elapsed
-    time queue.
+    Keeps the most recent constants.MAX_ELAPSED_RECORDS records.
 
     Args:
       start_time: the timestamp at the start of the operation.
@@ -118,37 +440,53 @@ class GlobalState(object):
     assert isinstance(start_time, float)
     assert utilities.valid_string(url_or_fname)
     assert isinstance(elapsed_seconds, float)
-
-    # If the queue is too large, remove some items until it contains less
-    # than constants.MAX_ELAPSED_QUEUE_SIZE elements.
-    while self._elapsed_queue.qsize() >= constants.MAX_ELAPSED_QUEUE_SIZE:
-      try:
-        self._elapsed_queue.get(block=False)
-      except Queue.Empty:
-        # self._elapsed_queue.get() may raise the EMPTY exception if the
-        # queue becomes empty (for example, due to concurrent access).
-        break
-
-    self._elapsed_queue.put(
+    self._elapsed_records.append(
         ElapsedRecord(start_time=start_time, what=url_or_fname,
                       thread_identifier=thread.get_ident(),
                       elapsed_seconds=elapsed_seconds))
 
-  def get_elapsed(self):
-    """Returns a list of all queued elapsed time records and clears the queue.
+  def get_elapsed(self, since=0):
+    """Returns the elapsed time records recorded since a sequence number.
+
+    Reading the records does not remove them. See
+    utilities.RingBuffer.snapshot() for details.
+
+    Args:
+      since: the sequence number of the first record to return. The first
+        record has the sequence number zero.
 
     Returns:
-    An empty list if the elapsed time queue is empty.
-    Otherwise, a list of ElapsedRecord in the order that they appear
-    in the queue.
+    A tuple (records, start, end). 'records' is the list of ElapsedRecord
+    whose sequence numbers are at least 'start' and less than 'end', in the
+    order they were recorded. Pass 'end' as 'since' to get the new records
+    only. 'start' is greater than 'since' if older records were discarded.
     """
-    result = []
-    while not self._elapsed_queue.empty():
-      try:
-        result.append(self._elapsed_queue.get(block=False))
-      except Queue.Empty:
-        # self._elapsed_queue.get() may raise the Empty exception if the
-        # queue becomes empty (for example, due to concurrent access).
-        break
+    return self._elapsed_records.snapshot(since)
+
+  def add_trace_exporter(self, exporter):
+    """Adds an exporter of the finished traces (see tracing.FileExporter).
+
+    Must be called before the web server starts serving requests.
+    """
+    self._trace_exporters.append(exporter)
+
+  def record_trace(self, trace):
+    """Keeps a finished trace for get_traces() and exports it.
 
-    return result
+    Args:
+      trace: a finished tracing.Trace.
+
+    Raises:
+      Exceptions raised by the exporters.
+    """
+    self._traces.append(trace)
+    for exporter in self._trace_exporters:
+      exporter.export(trace)
+
+  def get_traces(self, since=0):
+    """Returns the traces recorded since a sequence number.
+
+    Reading the traces does not remove them. See get_elapsed() for the
+    meaning of 'since' and of the returned tuple (traces, start, end).
+    """
+    return self._traces.snapshot(since)
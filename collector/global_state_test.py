@@ -32,26 +32,31 @@ class TestGlobalState(unittest.TestCase):
     self._state.init_caches_and_synchronization()
 
   def test_elapsed(self):
-    result = self._state.get_elapsed()
-    self.assertTrue(isinstance(result, list))
-    self.assertEqual([], result)
+    records, start, end = self._state.get_elapsed()
+    self.assertEqual(([], 0, 0), (records, start, end))
 
     now = time.time()
     self._state.add_elapsed(now, 'abc', 13.4)
 
     # expect to get a list of one elapsed time records.
-    result = self._state.get_elapsed()
-    self.assertTrue(isinstance(result, list))
-    self.assertEqual(1, len(result))
-    self.assertEqual(now, result[0].start_time)
-    self.assertEqual('abc', result[0].what)
-    self.assertEqual(13.4, result[0].elapsed_seconds)
-    self.assertEqual(thread.get_ident(), result[0].thread_identifier)
-
-    # Calling get_elapsed() should clear the list of elapsed times.
-    result = self._state.get_elapsed()
-    self.assertTrue(isinstance(result, list))
-    self.assertEqual([], result)
+    records, start, end = self._state.get_elapsed()
+    self.assertTrue(isinstance(records, list))
+    self.assertEqual(1, len(records))
+    self.assertEqual((0, 1), (start, end))
+    self.assertEqual(now, records[0].start_time)
+    self.assertEqual('abc', records[0].what)
+    self.assertEqual(13.4, records[0].elapsed_seconds)
+    self.assertEqual(thread.get_ident(), records[0].thread_identifier)
+
+    # Calling get_elapsed() does not clear the list of elapsed times.
+    self.assertEqual(records, self._state.get_elapsed()[0])
+
+    # Only the records since the previous call are returned.
+    self._state.add_elapsed(now, 'def', 1.5)
+    records, start, end = self._state.get_elapsed(end)
+    self.assertEqual(['def'], [r.what for r in records])
+    self.assertEqual((1, 2), (start, end))
+    self.assertEqual(([], 2, 2), self._state.get_elapsed(end))
 
 
 if __name__ == '__main__':
@@ -27,10 +27,11 @@ import sys
 import time
 
 from flask import current_app as app
-import requests
 
 import collector_error
+import global_state
 import metrics
+import tracing
 import utilities
 
 
@@ -140,19 +141,28 @@ def fetch_data(gs, url):
     fetch the URL.
   """
   start_time = time.time()
-  if app.testing:
-    # Read the data from a file.
-    url_elements = url.split('/')
-    fname = 'testdata/' + url_elements[-1] + '.input.json'
-    v = json.loads(open(fname, 'r').read())
-    gs.add_elapsed(start_time, fname, time.time() - start_time)
-    return v
-  else:
-    # Send the request to Kubernetes
-    headers = get_kubernetes_headers()
-    v = requests.get(url, headers=headers, verify=False).json()
-    gs.add_elapsed(start_time, url, time.time() - start_time)
-    return v
+  kind = url.split('/')[-1]
+  try:
+    with tracing.span('fetch', {'kind': kind}):
+      if app.testing:
+        # Read the data from a file.
+        what = 'testdata/' + kind + '.input.json'
+        v = json.loads(open(what, 'r').read())
+      else:
+        # Send the request to Kubernetes. The session reuses its
+        # connections.
+        what = url
+        headers = get_kubernetes_headers()
+        v = gs.get_http_session().get(
+            url, headers=headers, verify=False).json()
+  except Exception:
+    gs.get_monitoring().fetch_errors.inc((kind,))
+    raise
+
+  elapsed_seconds = time.time() - start_time
+  gs.get_monitoring().fetch_seconds.observe((kind,), elapsed_seconds)
+  gs.add_elapsed(start_time, what, elapsed_seconds)
+  return v
 
 
 @utilities.global_state_arg
@@ -163,7 +173,7 @@ def get_nodes(gs):
     gs: global state.
 
   Returns:
-    list of wrapped node objects.
+    list of wrapped node objects annotated with their metrics.
     Each element in the list is the result of
     utilities.wrap_object(node, 'Node', ...)
 
@@ -171,12 +181,13 @@ def get_nodes(gs):
     CollectorError: in case of failure to fetch data from Kubernetes.
     Other exceptions may be raised due to exectution errors.
   """
-  nodes, timestamp_secs = gs.get_nodes_cache().lookup('')
+  with tracing.span('cache.lookup', {'kind': 'nodes'}):
+    nodes, timestamp_secs = gs.get_nodes_cache().lookup('')
   if timestamp_secs is not None:
     app.logger.debug('get_nodes() cache hit returns %d nodes', len(nodes))
     return nodes
 
-  nodes = []
+  nodes = utilities.TimestampedList()
   url = get_kubernetes_base_url() + '/nodes'
   try:
     result = fetch_data(gs, url)
@@ -197,9 +208,13 @@ def get_nodes(gs):
       # an invalid node without a valid node ID value.
       continue
     wrapped_node = utilities.wrap_object(node, 'Node', name, now)
+    # Annotate the node once per fetch, so the cached nodes already
+    # contain their metric annotations.
+    metrics.annotate_node(wrapped_node)
     nodes.append(wrapped_node)
 
-  ret_value = gs.get_nodes_cache().update('', nodes, now)
+  with tracing.span('cache.update', {'kind': 'nodes'}):
+    ret_value = gs.get_nodes_cache().update('', nodes, now)
   app.logger.info('get_nodes() returns %d nodes', len(nodes))
   return ret_value
 
@@ -220,12 +235,9 @@ def get_nodes_with_metrics(gs):
     CollectorError in case of failure to fetch data from Kubernetes.
     Other exceptions may be raised due to exectution errors.
   """
-  nodes_list = get_nodes(gs)
-
-  for node in nodes_list:
-    metrics.annotate_node(node)
-
-  return nodes_list
+  # get_nodes() annotates the nodes when it fetches them, so the metric
+  # annotations are computed once per node version rather than per call.
+  return get_nodes(gs)
 
 
 @utilities.global_state_arg
@@ -244,12 +256,13 @@ def get_pods(gs):
     CollectorError: in case of failure to fetch data from Kubernetes.
     Other exceptions may be raised due to exectution errors.
   """
-  pods, timestamp_secs = gs.get_pods_cache().lookup('')
+  with tracing.span('cache.lookup', {'kind': 'pods'}):
+    pods, timestamp_secs = gs.get_pods_cache().lookup('')
   if timestamp_secs is not None:
     app.logger.debug('get_pods() cache hit returns %d pods', len(pods))
     return pods
 
-  pods = []
+  pods = utilities.TimestampedList()
   url = get_kubernetes_base_url() + '/pods'
   try:
     result = fetch_data(gs, url)
@@ -272,11 +285,83 @@ def get_pods(gs):
     wrapped_pod = utilities.wrap_object(pod, 'Pod', name, now)
     pods.append(wrapped_pod)
 
-  ret_value = gs.get_pods_cache().update('', pods, now)
+  with tracing.span('cache.update', {'kind': 'pods'}):
+    ret_value = gs.get_pods_cache().update('', pods, now)
+  with tracing.span('derive_containers'):
+    _update_pod_containers(gs, ret_value)
   app.logger.info('get_pods() returns %d pods', len(pods))
   return ret_value
 
 
+def derive_pod_containers(pod):
+  """Derives the containers of a pod and their images.
+
+  The containers are annotated with their metrics.
+
+  Args:
+    pod: a wrapped Pod object.
+
+  Returns:
+    a list of (wrapped Container object, wrapped Image object) pairs.
+  """
+  assert utilities.is_wrapped_object(pod, 'Pod')
+  result = []
+  for container in get_containers_from_pod(pod):
+    metrics.annotate_container(container, pod)
+    result.append((container, get_image_from_container(container)))
+
+  return result
+
+
+def _update_pod_containers(gs, pods):
+  """Derives the containers and images of new or changed pods.
+
+  The derived objects are kept in the global state and reused by
+  get_pod_containers() until the pod changes. A pod is identified by its ID
+  and timestamp, because the pods cache keeps the timestamp of a pod as long
+  as the pod does not change, even when other pods change (see
+  SimpleCache.update()). The entries of pods that no longer exist are
+  dropped.
+
+  Args:
+    gs: global state.
+    pods: the list of wrapped Pod objects returned by the pods cache.
+  """
+  assert isinstance(gs, global_state.GlobalState)
+  assert isinstance(pods, list)
+  old_pod_containers = gs.get_pod_containers()
+  pod_containers = {}
+  for pod in pods:
+    entry = old_pod_containers.get(pod['id'])
+    if (entry is None) or (entry[0] != pod['timestamp']):
+      entry = (pod['timestamp'], derive_pod_containers(pod))
+    pod_containers[pod['id']] = entry
+
+  gs.set_pod_containers(pod_containers)
+
+
+@utilities.global_state_dict_args
+def get_pod_containers(gs, pod):
+  """Returns the containers of a pod and their images.
+
+  The containers and images are derived once per pod version when the pod
+  is fetched from Kubernetes (see _update_pod_containers()), and they are
+  shared by all later calls. The caller must not modify them.
+
+  Args:
+    gs: global state.
+    pod: a wrapped Pod object.
+
+  Returns:
+    a list of (wrapped Container object, wrapped Image object) pairs.
+  """
+  entry = gs.get_pod_containers().get(pod['id'])
+  if (entry is not None) and (entry[0] == pod['timestamp']):
+    return entry[1]
+
+  return derive_pod_containers(pod)
+
+
 def get_containers_from_pod(pod):
   """Extracts synthesized container resources from a pod.
 
@@ -337,13 +422,13 @@ def matching_labels(pod, selector):
   Returns:
     True iff the pod's label matches the key/value pairs in 'selector'.
   """
-  pod_labels = utilities.get_attribute(
-      pod, ['properties', 'metadata', 'labels'])
+  # This function runs for every pair of pod and selector, so it accesses
+  # the labels directly. The pod was validated when it was wrapped.
+  metadata = pod['properties'].get('metadata')
+  pod_labels = metadata.get('labels') if isinstance(metadata, dict) else None
   if not isinstance(pod_labels, dict):
     return False
-  selector_view = selector.viewitems()
-  pod_labels_view = pod_labels.viewitems()
-  return len(selector_view & pod_labels_view) == len(selector_view)
+  return selector.viewitems() <= pod_labels.viewitems()
 
 
 @utilities.global_state_dict_args
@@ -404,13 +489,14 @@ def get_services(gs):
     CollectorError: in case of failure to fetch data from Kubernetes.
     Other exceptions may be raised due to exectution errors.
   """
-  services, timestamp_secs = gs.get_services_cache().lookup('')
+  with tracing.span('cache.lookup', {'kind': 'services'}):
+    services, timestamp_secs = gs.get_services_cache().lookup('')
   if timestamp_secs is not None:
     app.logger.debug('get_services() cache hit returns %d services',
                      len(services))
     return services
 
-  services = []
+  services = utilities.TimestampedList()
   url = get_kubernetes_base_url() + '/services'
   try:
     result = fetch_data(gs, url)
@@ -433,7 +519,8 @@ def get_services(gs):
     services.append(
         utilities.wrap_object(service, 'Service', name, now))
 
-  ret_value = gs.get_services_cache().update('', services, now)
+  with tracing.span('cache.update', {'kind': 'services'}):
+    ret_value = gs.get_services_cache().update('', services, now)
   app.logger.info('get_services() returns %d services', len(services))
   return ret_value
 
@@ -454,14 +541,15 @@ def get_rcontrollers(gs):
     CollectorError: in case of failure to fetch data from Kubernetes.
     Other exceptions may be raised due to exectution errors.
   """
-  rcontrollers, ts = gs.get_rcontrollers_cache().lookup('')
+  with tracing.span('cache.lookup', {'kind': 'rcontrollers'}):
+    rcontrollers, ts = gs.get_rcontrollers_cache().lookup('')
   if ts is not None:
     app.logger.debug(
         'get_rcontrollers() cache hit returns %d rcontrollers',
         len(rcontrollers))
     return rcontrollers
 
-  rcontrollers = []
+  rcontrollers = utilities.TimestampedList()
   url = get_kubernetes_base_url() + '/replicationcontrollers'
 
   try:
@@ -486,7 +574,41 @@ def get_rcontrollers(gs):
     rcontrollers.append(utilities.wrap_object(
         rcontroller, 'ReplicationController', name, now))
 
-  ret_value = gs.get_rcontrollers_cache().update('', rcontrollers, now)
+  with tracing.span('cache.update', {'kind': 'rcontrollers'}):
+    ret_value = gs.get_rcontrollers_cache().update('', rcontrollers, now)
   app.logger.info(
       'get_rcontrollers() returns %d rcontrollers', len(rcontrollers))
   return ret_value
+
+
+# The getters of all resource kinds, which fetch the resources when they are
+# not in the cache. A new resource kind is collected by adding its getter.
+RESOURCE_GETTERS = (get_nodes, get_pods, get_services, get_rcontrollers)
+
+
+@utilities.global_state_arg
+def prefetch_resources(gs):
+  """Fetches the resources of all kinds concurrently.
+
+  Calls the getters in RESOURCE_GETTERS by the threads of
+  gs.get_fetch_pool(), so the resources that are not in the cache are
+  fetched concurrently rather than one kind after another. The getters
+  return the fetched resources from the cache afterwards.
+
+  Args:
+    gs: global state.
+
+  Raises:
+    CollectorError: in case of failure to fetch data from Kubernetes.
+    Other exceptions may be raised due to exectution errors.
+  """
+  # The threads of the pool need the application context and the trace of
+  # the caller.
+  flask_app = app._get_current_object()
+  trace_context = tracing.current_context()
+
+  def get_resources(getter):
+    with flask_app.app_context(), tracing.activate(trace_context):
+      getter(gs)
+
+  gs.get_fetch_pool().map(get_resources, RESOURCE_GETTERS)
@@ -0,0 +1,170 @@
+#!/usr/bin/python
+#
+# Copyright 2015 The Cluster-Insight Authors. All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A load test of a running data collector.
+
+Concurrent clients request a path over persistent connections as fast as
+they can, while another client requests '/healthz' every
+HEALTH_CHECK_INTERVAL_SECONDS. Optionally, slow clients hold connections
+whose requests never complete. The test prints the request rate and the
+latencies of both paths.
+
+Usage:
+  python loadtest.py --port 5555 --clients 20 --seconds 30 --path /cluster
+"""
+
+import argparse
+import httplib
+import socket
+import threading
+import time
+
+# local imports
+import constants
+
+HEALTH_CHECK_PATH = '/healthz'
+HEALTH_CHECK_INTERVAL_SECONDS = 0.05
+
+
+class _Results(object):
+  """The results of the load test.
+
+  Attributes:
+    lock: a lock protecting access to all other attributes.
+    latencies: a dictionary from paths to the list of latencies of their
+      successful requests in seconds.
+    errors: the number of failed requests.
+  """
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.latencies = {}
+    self.errors = 0
+
+  def add(self, path, latency):
+    with self.lock:
+      self.latencies.setdefault(path, []).append(latency)
+
+  def add_error(self):
+    with self.lock:
+      self.errors += 1
+
+
+def percentile(values, fraction):
+  """Returns the given percentile of 'values' in milliseconds."""
+  if not values:
+    return float('nan')
+  values = sorted(values)
+  return 1000 * values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run_client(host, port, path, end_time, pause, results):
+  """Requests 'path' until 'end_time' over a persistent connection."""
+  connection = None
+  while time.time() < end_time:
+    start_time = time.time()
+    try:
+      if connection is None:
+        connection = httplib.HTTPConnection(
+            host, port, timeout=constants.REQUEST_TIMEOUT_SECONDS)
+      connection.request('GET', path)
+      response = connection.getresponse()
+      response.read()
+      if response.getheader('Connection') == 'close':
+        connection.close()
+        connection = None
+      if response.status == 200:
+        results.add(path, time.time() - start_time)
+      else:
+        results.add_error()
+    except (httplib.HTTPException, socket.error):
+      results.add_error()
+      if connection is not None:
+        connection.close()
+      connection = None
+    if pause:
+      time.sleep(pause)
+  if connection is not None:
+    connection.close()
+
+
+def run_slow_client(host, port, end_time):
+  """Holds a connection whose request does not complete until 'end_time'."""
+  try:
+    sock = socket.create_connection((host, port))
+    sock.sendall('GET %s HTTP/1.1\r\n' % HEALTH_CHECK_PATH)
+  except socket.error:
+    return
+  time.sleep(max(0, end_time - time.time()))
+  sock.close()
+
+
+def main():
+  """Runs the load test and prints its results."""
+  parser = argparse.ArgumentParser(
+      description='Load test of a Cluster-Insight data collector')
+  parser.add_argument('--host', action='store', type=str,
+                      default='localhost',
+                      help='data collector host name [default=%(default)s]')
+  parser.add_argument('-p', '--port', action='store', type=int,
+                      default=constants.DATA_COLLECTOR_PORT,
+                      help='data collector port number [default=%(default)d]')
+  parser.add_argument('--path', action='store', type=str,
+                      default='/cluster',
+                      help='path of the requests [default=%(default)s]')
+  parser.add_argument('--clients', action='store', type=int, default=20,
+                      help='number of concurrent clients [default=%(default)d]')
+  parser.add_argument('--slow-clients', action='store', type=int, default=0,
+                      help=('number of clients that never complete their '
+                            'requests [default=%(default)d]'))
+  parser.add_argument('--seconds', action='store', type=float, default=30,
+                      help='duration of the test [default=%(default)g]')
+  args = parser.parse_args()
+
+  results = _Results()
+  end_time = time.time() + args.seconds
+  threads = [threading.Thread(target=run_slow_client,
+                              args=(args.host, args.port, end_time))
+             for _ in xrange(args.slow_clients)]
+  threads.extend(
+      threading.Thread(target=run_client,
+                       args=(args.host, args.port, args.path, end_time, 0,
+                             results))
+      for _ in xrange(args.clients))
+  threads.append(
+      threading.Thread(target=run_client,
+                       args=(args.host, args.port, HEALTH_CHECK_PATH,
+                             end_time, HEALTH_CHECK_INTERVAL_SECONDS,
+                             results)))
+  for t in threads:
+    t.daemon = True
+    t.start()
+  for t in threads:
+    t.join()
+
+  latencies = results.latencies.get(args.path, [])
+  health_latencies = results.latencies.get(HEALTH_CHECK_PATH, [])
+  print '%s: %.1f requests/s, latency p50 %.1f ms, p99 %.1f ms' % (
+      args.path, len(latencies) / args.seconds,
+      percentile(latencies, 0.5), percentile(latencies, 0.99))
+  print '%s: latency p50 %.1f ms, p99 %.1f ms, max %.1f ms' % (
+      HEALTH_CHECK_PATH, percentile(health_latencies, 0.5),
+      percentile(health_latencies, 0.99), percentile(health_latencies, 1))
+  print 'errors: %d' % results.errors
+
+
+if __name__ == '__main__':
+  main()
@@ -23,14 +23,15 @@ Heapster. It is dependent on issue
 https://github.com/GoogleCloudPlatform/heapster/issues/241.
 """
 
-# global imports
-import copy
-
 # local imports
 import utilities
 
 METRIC_PREFIX = 'custom.cloudmonitoring.googleapis.com/kubernetes.io/'
-METRIC_NAMES = [
+# The metric names are shared by the metric descriptors of all nodes and
+# containers. They are a tuple, so they cannot be modified through any
+# descriptor, and copy.deepcopy() returns the same tuple instead of copying
+# its elements.
+METRIC_NAMES = (
     METRIC_PREFIX + 'cpu/usage',
     METRIC_PREFIX + 'memory/page_faults',
     METRIC_PREFIX + 'memory/usage',
@@ -40,7 +41,8 @@ METRIC_NAMES = [
     METRIC_PREFIX + 'network/tx',
     METRIC_PREFIX + 'network/tx_errors',
     METRIC_PREFIX + 'uptime'
-]
+)
+METRIC_LABELS_PREFIX = METRIC_PREFIX + 'label/'
 
 
 def _get_container_labels(container, parent_pod):
@@ -117,6 +119,11 @@ def _make_gcm_metrics(labels_dict):
   See below for details.
   If 'labels_dict' is None, returns None.
 
+  The 'names' attribute is the shared METRIC_NAMES tuple, which is
+  serialized as a JSON list. Only the 'labels' attribute differs between
+  descriptors. It is 'labels_dict' itself, which must not be shared with
+  other objects.
+
   Typical output is:
   {
     'gcm': {
@@ -135,10 +142,10 @@ def _make_gcm_metrics(labels_dict):
   assert isinstance(labels_dict, dict)
 
   return {'gcm': {
-      'names': copy.deepcopy(METRIC_NAMES),
+      'names': METRIC_NAMES,
       'project': '_unknown_',
-      'labels': copy.deepcopy(labels_dict),
-      'labels_prefix': METRIC_PREFIX + 'label/'
+      'labels': labels_dict,
+      'labels_prefix': METRIC_LABELS_PREFIX
   }}
 
 
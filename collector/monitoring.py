@@ -0,0 +1,258 @@
+#!/usr/bin/python
+#
+# Copyright 2015 The Cluster-Insight Authors. All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Cumulative latency histograms and counters of the data collector.
+
+The histograms and counters are rendered in the Prometheus text exposition
+format (version 0.0.4), so a monitoring system can scrape them from the
+'/metrics' endpoint and compute percentiles over any time window. Unlike
+the elapsed time records of '/elapsed', they cover all requests since the
+process started.
+
+Recording a value takes a lock and a binary search of the bucket bounds.
+The cumulative bucket counts are computed only when the histograms are
+rendered.
+
+Usage:
+  m = Monitoring()
+  m.fetch_seconds.observe(('pods',), 0.25)
+  m.requests.inc(('/cluster', '200'))
+  text = m.render()
+"""
+
+import bisect
+import threading
+import time
+import types
+
+# local imports
+import constants
+
+# The content type of the Prometheus text exposition format.
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+
+def _format_value(value):
+  """Returns the text representation of a sample value."""
+  if isinstance(value, float):
+    if value == float('inf'):
+      return '+Inf'
+    return repr(value)
+  return str(value)
+
+
+def _escape_label_value(value):
+  return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def format_samples(name, help_text, metric_type, samples):
+  """Returns the text representation of a metric family.
+
+  Args:
+    name: the name of the metric family.
+    help_text: a one-line description of the metric family.
+    metric_type: 'counter', 'gauge' or 'histogram'.
+    samples: a sequence of (name suffix, label pairs, value) tuples, where
+      the label pairs are a sequence of (label name, label value) pairs.
+
+  Returns:
+  The '# HELP' and '# TYPE' lines followed by a line per sample.
+  """
+  assert isinstance(name, types.StringTypes)
+  assert metric_type in ('counter', 'gauge', 'histogram')
+  lines = ['# HELP %s %s' % (name, help_text),
+           '# TYPE %s %s' % (name, metric_type)]
+  for suffix, labels, value in samples:
+    if labels:
+      lines.append('%s%s{%s} %s' % (
+          name, suffix,
+          ','.join(['%s="%s"' % (label_name, _escape_label_value(label_value))
+                    for label_name, label_value in labels]),
+          _format_value(value)))
+    else:
+      lines.append('%s%s %s' % (name, suffix, _format_value(value)))
+  return '\n'.join(lines) + '\n'
+
+
+class Counter(object):
+  """A family of counters distinguished by the values of their labels.
+
+  This class is thread-safe.
+  """
+
+  def __init__(self, name, help_text, label_names):
+    assert isinstance(name, types.StringTypes)
+    assert isinstance(label_names, tuple)
+    self._name = name
+    self._help_text = help_text
+    self._label_names = label_names
+    self._lock = threading.Lock()
+    self._counts = {}
+
+  def inc(self, label_values, amount=1):
+    """Increments the counter of the given label values.
+
+    Args:
+      label_values: a tuple of the values of the labels, in the order of
+        the label names.
+      amount: the increment.
+    """
+    assert len(label_values) == len(self._label_names)
+    with self._lock:
+      self._counts[label_values] = self._counts.get(label_values, 0) + amount
+
+  def get(self, label_values):
+    """Returns the counter of the given label values."""
+    with self._lock:
+      return self._counts.get(label_values, 0)
+
+  def render(self):
+    with self._lock:
+      counts = sorted(self._counts.items())
+    return format_samples(
+        self._name, self._help_text, 'counter',
+        [('', zip(self._label_names, label_values), count)
+         for label_values, count in counts])
+
+
+class Histogram(object):
+  """A family of cumulative histograms distinguished by their label values.
+
+  Every histogram counts the observed values whose upper bucket bounds are
+  at least the value, plus the sum and the count of all values.
+
+  This class is thread-safe.
+  """
+
+  def __init__(self, name, help_text, label_names, buckets):
+    """Initializes the histogram family.
+
+    Args:
+      name: the name of the metric family.
+      help_text: a one-line description of the metric family.
+      label_names: a tuple of the names of the labels.
+      buckets: an increasing sequence of the upper bounds of the buckets.
+        A bucket without an upper bound is added implicitly.
+    """
+    assert isinstance(name, types.StringTypes)
+    assert isinstance(label_names, tuple)
+    assert list(buckets) == sorted(buckets)
+    self._name = name
+    self._help_text = help_text
+    self._label_names = label_names
+    self._buckets = tuple(float(b) for b in buckets)
+    self._lock = threading.Lock()
+    # The label values to [per-bucket counts, sum, count]. Unlike the
+    # rendered buckets, the per-bucket counts are not cumulative.
+    self._histograms = {}
+
+  def observe(self, label_values, value):
+    """Records a value in the histogram of the given label values.
+
+    Args:
+      label_values: a tuple of the values of the labels, in the order of
+        the label names.
+      value: the observed value, such as a duration in seconds.
+    """
+    assert len(label_values) == len(self._label_names)
+    i = bisect.bisect_left(self._buckets, value)
+    with self._lock:
+      h = self._histograms.get(label_values)
+      if h is None:
+        h = [[0] * (len(self._buckets) + 1), 0.0, 0]
+        self._histograms[label_values] = h
+      h[0][i] += 1
+      h[1] += value
+      h[2] += 1
+
+  def observe_since(self, label_values, start_time):
+    """Records the time elapsed since 'start_time' and returns the time now.
+
+    The returned time can be the start time of the next observation.
+    """
+    now = time.time()
+    self.observe(label_values, now - start_time)
+    return now
+
+  def get_count(self, label_values):
+    """Returns the number of values recorded for the given label values."""
+    with self._lock:
+      h = self._histograms.get(label_values)
+      return 0 if h is None else h[2]
+
+  def render(self):
+    with self._lock:
+      histograms = sorted((label_values, (list(h[0]), h[1], h[2]))
+                          for label_values, h in self._histograms.items())
+
+    samples = []
+    bounds = self._buckets + (float('inf'),)
+    for label_values, (bucket_counts, total, count) in histograms:
+      labels = zip(self._label_names, label_values)
+      cumulative = 0
+      for bound, bucket_count in zip(bounds, bucket_counts):
+        cumulative += bucket_count
+        samples.append(('_bucket', labels + [('le', _format_value(bound))],
+                        cumulative))
+      samples.append(('_sum', labels, total))
+      samples.append(('_count', labels, count))
+    return format_samples(self._name, self._help_text, 'histogram', samples)
+
+
+class Monitoring(object):
+  """The histograms and counters of the data collector.
+
+  Attributes:
+    request_seconds: the latency of the HTTP requests by endpoint (the
+      route of the request, such as '/cluster/resources').
+    requests: the number of HTTP requests by endpoint and status code.
+    request_errors: the number of error responses by endpoint, including
+      the error responses whose status code is '200 OK'.
+    fetch_seconds: the latency of the Kubernetes API requests by kind
+      (the last element of the URL, such as 'pods').
+    fetch_errors: the number of failed Kubernetes API requests by kind.
+    build_phase_seconds: the duration of the phases of the context graph
+      builds by phase.
+  """
+
+  def __init__(self):
+    buckets = constants.LATENCY_BUCKETS_SECONDS
+    self.request_seconds = Histogram(
+        'collector_request_duration_seconds',
+        'Latency of HTTP requests until the response is returned.',
+        ('endpoint',), buckets)
+    self.requests = Counter(
+        'collector_requests_total', 'Number of HTTP requests.',
+        ('endpoint', 'code'))
+    self.request_errors = Counter(
+        'collector_request_errors_total', 'Number of error responses.',
+        ('endpoint',))
+    self.fetch_seconds = Histogram(
+        'collector_kubernetes_fetch_duration_seconds',
+        'Latency of Kubernetes API requests.', ('kind',), buckets)
+    self.fetch_errors = Counter(
+        'collector_kubernetes_fetch_errors_total',
+        'Number of failed Kubernetes API requests.', ('kind',))
+    self.build_phase_seconds = Histogram(
+        'collector_graph_build_phase_duration_seconds',
+        'Duration of the phases of context graph builds.', ('phase',),
+        buckets)
+
+  def render(self):
+    """Returns all histograms and counters in the text exposition format."""
+    return ''.join([m.render() for m in (
+        self.request_seconds, self.requests, self.request_errors,
+        self.fetch_seconds, self.fetch_errors, self.build_phase_seconds)])
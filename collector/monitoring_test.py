@@ -0,0 +1,67 @@
+#!/usr/bin/python
+#
+# Copyright 2015 The Cluster-Insight Authors. All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for collector/monitoring.py."""
+
+import unittest
+
+# local imports
+import monitoring
+
+
+class TestMonitoring(unittest.TestCase):
+
+  def test_histogram(self):
+    """Tests the cumulative buckets of a histogram."""
+    h = monitoring.Histogram('latency_seconds', 'Latency.', ('kind',),
+                             (0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 2.0):
+      h.observe(('pods',), value)
+    h.observe(('nodes',), 0.5)
+    self.assertEqual(4, h.get_count(('pods',)))
+    self.assertEqual(0, h.get_count(('services',)))
+    self.assertEqual(
+        '# HELP latency_seconds Latency.\n'
+        '# TYPE latency_seconds histogram\n'
+        'latency_seconds_bucket{kind="nodes",le="0.1"} 0\n'
+        'latency_seconds_bucket{kind="nodes",le="1.0"} 1\n'
+        'latency_seconds_bucket{kind="nodes",le="+Inf"} 1\n'
+        'latency_seconds_sum{kind="nodes"} 0.5\n'
+        'latency_seconds_count{kind="nodes"} 1\n'
+        'latency_seconds_bucket{kind="pods",le="0.1"} 2\n'
+        'latency_seconds_bucket{kind="pods",le="1.0"} 3\n'
+        'latency_seconds_bucket{kind="pods",le="+Inf"} 4\n'
+        'latency_seconds_sum{kind="pods"} 2.65\n'
+        'latency_seconds_count{kind="pods"} 4\n',
+        h.render())
+
+  def test_counter(self):
+    """Tests counters and the escaping of label values."""
+    c = monitoring.Counter('requests_total', 'Requests.', ('path', 'code'))
+    c.inc(('/a"b', '200'))
+    c.inc(('/a"b', '200'), 2)
+    c.inc(('/c\\d', '503'))
+    self.assertEqual(3, c.get(('/a"b', '200')))
+    self.assertEqual(
+        '# HELP requests_total Requests.\n'
+        '# TYPE requests_total counter\n'
+        'requests_total{path="/a\\"b",code="200"} 3\n'
+        'requests_total{path="/c\\\\d",code="503"} 1\n',
+        c.render())
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,429 @@
+#!/usr/bin/python
+#
+# Copyright 2015 The Cluster-Insight Authors. All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Encodes responses in a compact binary format based on MessagePack.
+
+A packed response consists of two consecutive MessagePack objects:
+the string table, which is an array of strings, followed by the response.
+In the response, the values of the attributes in INTERNED_KEYS (the
+resource IDs and types, and the source and target IDs of the relations) are
+replaced by references to the string table if they are at least
+MIN_INTERNED_LENGTH characters long. A reference is a MessagePack extension
+object of type STRING_REFERENCE_EXT_TYPE whose data is the big-endian index
+of the string in the string table (1, 2 or 4 bytes).
+
+The map keys and the values of the attributes in PLAIN_KEYS (the
+annotations and the raw Kubernetes objects) are not interned. The map keys
+are short, so their references would not be much shorter, and decoding a
+reference is slower than decoding a string in most MessagePack libraries.
+The packed annotations and properties of a resource do not depend on the
+string table, so they may be computed once per resource version (see
+pack()).
+
+For example, a client using the 'msgpack' Python package may decode a
+packed response like this:
+
+  strings = []
+  unpacker = msgpack.Unpacker(
+      encoding='utf-8',
+      ext_hook=lambda code, data: strings[int(data.encode('hex'), 16)])
+  unpacker.feed(packed_response)
+  strings.extend(unpacker.unpack())
+  response = unpacker.unpack()
+
+If the optional 'msgpack' package is installed, it packs the values of the
+attributes in PLAIN_KEYS, which is faster than the implementation here.
+Otherwise the collector does not depend on a MessagePack library.
+"""
+
+import struct
+import types
+
+# msgpack is an optional faster MessagePack encoder. See pack_plain().
+try:
+  import msgpack
+except ImportError:
+  msgpack = None
+
+# local imports
+import collector_error
+
+# The MIME type of packed responses.
+MIMETYPE = 'application/x-msgpack'
+
+# The MessagePack extension type of references to the string table.
+STRING_REFERENCE_EXT_TYPE = 0
+
+# The values of these attributes are interned in the string table.
+INTERNED_KEYS = frozenset(['id', 'type', 'source', 'target'])
+
+# The values of these attributes are packed without the string table.
+PLAIN_KEYS = frozenset(['annotations', 'properties'])
+
+# Shorter strings are not interned, because a reference to the string table
+# takes at least 3 bytes.
+MIN_INTERNED_LENGTH = 4
+
+_UINT8 = struct.Struct('>B')
+_UINT16 = struct.Struct('>H')
+_UINT32 = struct.Struct('>I')
+_UINT64 = struct.Struct('>Q')
+_INT8 = struct.Struct('>b')
+_INT16 = struct.Struct('>h')
+_INT32 = struct.Struct('>i')
+_INT64 = struct.Struct('>q')
+_DOUBLE = struct.Struct('>d')
+
+# The one-byte headers of short strings, arrays and maps, and the
+# representations of small integers.
+_FIXSTR = [chr(0xa0 | n) for n in xrange(32)]
+_FIXARRAY = [chr(0x90 | n) for n in xrange(16)]
+_FIXMAP = [chr(0x80 | n) for n in xrange(16)]
+_FIXINT = dict((n, chr(n & 0xff)) for n in xrange(-32, 128))
+
+# The prefixes of references to the string table with 1, 2 and 4 byte
+# indexes (fixext 1, fixext 2 and fixext 4).
+_REFERENCE_PREFIX8 = '\xd4' + chr(STRING_REFERENCE_EXT_TYPE)
+_REFERENCE_PREFIX16 = '\xd5' + chr(STRING_REFERENCE_EXT_TYPE)
+_REFERENCE_PREFIX32 = '\xd6' + chr(STRING_REFERENCE_EXT_TYPE)
+
+
+def _pack_string(s, append):
+  if type(s) is unicode:
+    s = s.encode('utf-8')
+  n = len(s)
+  if n < 32:
+    append(_FIXSTR[n])
+  elif n < 0x100:
+    append('\xd9' + _UINT8.pack(n))
+  elif n < 0x10000:
+    append('\xda' + _UINT16.pack(n))
+  else:
+    append('\xdb' + _UINT32.pack(n))
+  append(s)
+
+
+def _pack_array_header(n, append):
+  if n < 16:
+    append(_FIXARRAY[n])
+  elif n < 0x10000:
+    append('\xdc' + _UINT16.pack(n))
+  else:
+    append('\xdd' + _UINT32.pack(n))
+
+
+def _pack_map_header(n, append):
+  if n < 16:
+    append(_FIXMAP[n])
+  elif n < 0x10000:
+    append('\xde' + _UINT16.pack(n))
+  else:
+    append('\xdf' + _UINT32.pack(n))
+
+
+def _pack_int(value, append):
+  if -32 <= value < 0x80:
+    append(_FIXINT[value])
+  elif value >= 0:
+    if value < 0x100:
+      append('\xcc' + _UINT8.pack(value))
+    elif value < 0x10000:
+      append('\xcd' + _UINT16.pack(value))
+    elif value < 0x100000000:
+      append('\xce' + _UINT32.pack(value))
+    elif value < 0x10000000000000000:
+      append('\xcf' + _UINT64.pack(value))
+    else:
+      raise collector_error.CollectorError(
+          'integer too large to pack: %d' % value)
+  elif value >= -0x80:
+    append('\xd0' + _INT8.pack(value))
+  elif value >= -0x8000:
+    append('\xd1' + _INT16.pack(value))
+  elif value >= -0x80000000:
+    append('\xd2' + _INT32.pack(value))
+  elif value >= -0x8000000000000000:
+    append('\xd3' + _INT64.pack(value))
+  else:
+    raise collector_error.CollectorError(
+        'integer too small to pack: %d' % value)
+
+
+def _pack_scalar(obj, append):
+  """Packs a value that is not a string, list, tuple or dictionary."""
+  if obj is None:
+    append('\xc0')
+  elif obj is True:
+    append('\xc3')
+  elif obj is False:
+    append('\xc2')
+  elif isinstance(obj, (int, long)):
+    _pack_int(obj, append)
+  elif isinstance(obj, float):
+    append('\xcb' + _DOUBLE.pack(obj))
+  else:
+    raise collector_error.CollectorError(
+        'cannot pack an object of type %s' % type(obj).__name__)
+
+
+def _pack_plain(obj, append):
+  """Packs 'obj' recursively without interning any strings."""
+  if isinstance(obj, types.StringTypes):
+    _pack_string(obj, append)
+  elif isinstance(obj, dict):
+    _pack_map_header(len(obj), append)
+    for key, value in obj.iteritems():
+      _pack_plain(key, append)
+      _pack_plain(value, append)
+  elif isinstance(obj, (list, tuple)):
+    _pack_array_header(len(obj), append)
+    for value in obj:
+      _pack_plain(value, append)
+  else:
+    _pack_scalar(obj, append)
+
+
+def pack_plain(obj):
+  """Returns the MessagePack representation of 'obj' without a string table.
+
+  The output of pack_plain() may be embedded in the output of pack() (see
+  the 'packed_plain' argument of pack()).
+
+  Args:
+    obj: a JSON-compatible object.
+
+  Returns:
+  The MessagePack representation of 'obj'.
+
+  Raises:
+    CollectorError: if 'obj' contains values that cannot be packed.
+  """
+  if msgpack is not None:
+    try:
+      return msgpack.packb(obj, use_bin_type=False)
+    except (TypeError, ValueError, OverflowError) as e:
+      raise collector_error.CollectorError('cannot pack object: %s' % e)
+
+  parts = []
+  _pack_plain(obj, parts.append)
+  return ''.join(parts)
+
+
+class _Packer(object):
+  """Packs one response and collects its string table."""
+
+  def __init__(self, packed_plain):
+    self._parts = []
+    self._packed_plain = packed_plain
+    # Interned string to its packed reference to the string table.
+    self._references = {}
+    self._strings = []
+    # Map key to its packed representation. There are few distinct keys
+    # outside the 'properties' attributes.
+    self._packed_keys = {}
+
+  def _reference(self, s):
+    """Returns the packed reference to the string 's' in the string table.
+    """
+    reference = self._references.get(s)
+    if reference is None:
+      index = len(self._strings)
+      self._strings.append(s)
+      if index < 0x100:
+        reference = _REFERENCE_PREFIX8 + _UINT8.pack(index)
+      elif index < 0x10000:
+        reference = _REFERENCE_PREFIX16 + _UINT16.pack(index)
+      else:
+        reference = _REFERENCE_PREFIX32 + _UINT32.pack(index)
+      self._references[s] = reference
+    return reference
+
+  def _packed_key(self, key):
+    packed = self._packed_keys.get(key)
+    if packed is None:
+      parts = []
+      _pack_plain(key, parts.append)
+      packed = ''.join(parts)
+      self._packed_keys[key] = packed
+    return packed
+
+  def pack(self, obj):
+    """Packs 'obj' recursively."""
+    append = self._parts.append
+    if isinstance(obj, dict):
+      _pack_map_header(len(obj), append)
+      packed_keys = self._packed_keys
+      for key, value in obj.iteritems():
+        packed_key = packed_keys.get(key)
+        append(packed_key if packed_key is not None
+               else self._packed_key(key))
+        if key in INTERNED_KEYS:
+          if isinstance(value, types.StringTypes) and (
+              len(value) >= MIN_INTERNED_LENGTH):
+            append(self._reference(value))
+          else:
+            self.pack(value)
+        elif key in PLAIN_KEYS:
+          if self._packed_plain is not None:
+            append(self._packed_plain(obj, key))
+          else:
+            append(pack_plain(value))
+        else:
+          self.pack(value)
+    elif isinstance(obj, types.StringTypes):
+      _pack_string(obj, append)
+    elif isinstance(obj, (list, tuple)):
+      _pack_array_header(len(obj), append)
+      for value in obj:
+        self.pack(value)
+    else:
+      _pack_scalar(obj, append)
+
+  def get_packed(self):
+    """Returns the string table followed by the packed objects."""
+    parts = []
+    _pack_plain(self._strings, parts.append)
+    parts.extend(self._parts)
+    return ''.join(parts)
+
+
+def pack(obj, packed_plain=None):
+  """Returns the packed representation of 'obj'.
+
+  Args:
+    obj: a JSON-compatible object, such as a response dictionary.
+    packed_plain: an optional function of a dictionary 'd', such as a
+      resource, and an attribute 'key' in PLAIN_KEYS, which returns
+      pack_plain(d[key]). It is usually a cache of the packed annotations
+      and properties of the resources.
+
+  Returns:
+  The string table followed by the MessagePack representation of 'obj'.
+
+  Raises:
+    CollectorError: if 'obj' contains values that cannot be packed.
+  """
+  packer = _Packer(packed_plain)
+  packer.pack(obj)
+  return packer.get_packed()
+
+
+class _Unpacker(object):
+  """Unpacks one packed response."""
+
+  def __init__(self, data):
+    self._data = data
+    self._offset = 0
+    self._strings = []
+
+  def _read(self, n):
+    start = self._offset
+    self._offset += n
+    if self._offset > len(self._data):
+      raise collector_error.CollectorError('truncated packed data')
+    return self._data[start:self._offset]
+
+  def _read_struct(self, s):
+    return s.unpack(self._read(s.size))[0]
+
+  def _unpack_ext(self, n):
+    code = ord(self._read(1))
+    data = self._read(n)
+    if code != STRING_REFERENCE_EXT_TYPE:
+      raise collector_error.CollectorError(
+          'unknown extension type %d' % code)
+    index = {1: _UINT8, 2: _UINT16, 4: _UINT32}[n].unpack(data)[0]
+    if index >= len(self._strings):
+      raise collector_error.CollectorError(
+          'invalid string reference %d' % index)
+    return self._strings[index]
+
+  def unpack(self):
+    """Unpacks the next object recursively."""
+    b = ord(self._read(1))
+    if b < 0x80:
+      return b
+    elif b >= 0xe0:
+      return b - 0x100
+    elif b & 0xe0 == 0xa0:
+      return self._read(b & 0x1f).decode('utf-8')
+    elif b & 0xf0 == 0x90:
+      return [self.unpack() for _ in xrange(b & 0x0f)]
+    elif b & 0xf0 == 0x80:
+      return self._unpack_map(b & 0x0f)
+    elif b == 0xc0:
+      return None
+    elif b == 0xc2:
+      return False
+    elif b == 0xc3:
+      return True
+    elif b in (0xd9, 0xda, 0xdb):
+      n = self._read_struct({0xd9: _UINT8, 0xda: _UINT16, 0xdb: _UINT32}[b])
+      return self._read(n).decode('utf-8')
+    elif b in (0xdc, 0xdd):
+      n = self._read_struct(_UINT16 if b == 0xdc else _UINT32)
+      return [self.unpack() for _ in xrange(n)]
+    elif b in (0xde, 0xdf):
+      return self._unpack_map(
+          self._read_struct(_UINT16 if b == 0xde else _UINT32))
+    elif b in (0xd4, 0xd5, 0xd6):
+      return self._unpack_ext({0xd4: 1, 0xd5: 2, 0xd6: 4}[b])
+    elif b == 0xcb:
+      return self._read_struct(_DOUBLE)
+    elif b in _INTEGER_STRUCTS:
+      return self._read_struct(_INTEGER_STRUCTS[b])
+    else:
+      raise collector_error.CollectorError(
+          'unsupported packed type 0x%02x' % b)
+
+  def _unpack_map(self, n):
+    result = {}
+    for _ in xrange(n):
+      key = self.unpack()
+      result[key] = self.unpack()
+    return result
+
+  def unpack_response(self):
+    self._strings = self.unpack()
+    if not isinstance(self._strings, list):
+      raise collector_error.CollectorError('missing string table')
+    result = self.unpack()
+    if self._offset != len(self._data):
+      raise collector_error.CollectorError('extra data after packed object')
+    return result
+
+
+_INTEGER_STRUCTS = {
+    0xcc: _UINT8, 0xcd: _UINT16, 0xce: _UINT32, 0xcf: _UINT64,
+    0xd0: _INT8, 0xd1: _INT16, 0xd2: _INT32, 0xd3: _INT64}
+
+
+def unpack(data):
+  """Returns the object represented by the output of pack().
+
+  The strings in the result are unicode strings.
+
+  Args:
+    data: the output of pack().
+
+  Returns:
+  The unpacked object.
+
+  Raises:
+    CollectorError: if 'data' is not a valid packed representation.
+  """
+  assert isinstance(data, str)
+  return _Unpacker(data).unpack_response()
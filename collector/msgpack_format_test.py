@@ -0,0 +1,107 @@
+#!/usr/bin/python
+#
+# Copyright 2015 The Cluster-Insight Authors. All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for collector/msgpack_format.py."""
+
+import json
+import unittest
+
+import collector_error
+import msgpack_format
+
+
+class TestMsgpackFormat(unittest.TestCase):
+
+  def test_pack_values(self):
+    """Tests pack() and unpack() with values of all supported types."""
+    values = [
+        None, True, False, 0, 1, 127, 128, 255, 256, 65535, 65536,
+        2 ** 32 - 1, 2 ** 32, 2 ** 64 - 1, -1, -32, -33, -128, -129,
+        -32768, -32769, -2 ** 31, -2 ** 31 - 1, -2 ** 63, 0.0, 1.5, -1e100,
+        u'', u'abc', u'\u05e9\u05dc\u05d5\u05dd', u'x' * 31, u'x' * 32,
+        u'x' * 255, u'x' * 256, u'x' * 65536,
+        [], range(15), range(16), range(65536),
+        {}, dict((str(i), i) for i in range(15)),
+        dict((str(i), i) for i in range(16)),
+    ]
+    for value in values:
+      self.assertEqual(value, msgpack_format.unpack(msgpack_format.pack(value)))
+
+    # The unpacked strings are unicode strings.
+    self.assertEqual(u'abc', msgpack_format.unpack(msgpack_format.pack('abc')))
+    self.assertTrue(isinstance(
+        msgpack_format.unpack(msgpack_format.pack('abc')), unicode))
+    self.assertEqual([1, 2], msgpack_format.unpack(msgpack_format.pack((1, 2))))
+
+    # Known encodings.
+    self.assertEqual('\x90\xc0', msgpack_format.pack(None))
+    self.assertEqual('\x90\xa3abc', msgpack_format.pack('abc'))
+    self.assertEqual('\x90\xcd\x01\x00', msgpack_format.pack(256))
+    self.assertEqual('\x90\xff', msgpack_format.pack(-1))
+
+    self.assertRaises(collector_error.CollectorError, msgpack_format.pack,
+                      object())
+    self.assertRaises(collector_error.CollectorError, msgpack_format.pack,
+                      2 ** 64)
+
+  def test_string_table(self):
+    """Tests that repeated IDs and types are packed once."""
+    relations = [{'source': 'Pod:guestbook-%d' % (i // 10),
+                  'target': 'Container:php-redis-%d' % i,
+                  'type': 'contains',
+                  'timestamp': '2015-05-29T18:42:52.217499'}
+                 for i in range(1000)]
+    response = {'success': True, 'relations': relations}
+    packed = msgpack_format.pack(response)
+    self.assertEqual(response, msgpack_format.unpack(packed))
+
+    # The string table is the first packed object.
+    self.assertEqual('\xdc', packed[0])
+    self.assertEqual(1, packed.count('Pod:guestbook-99'))
+    self.assertEqual(1, packed.count('contains'))
+    self.assertEqual(1000, packed.count('timestamp'))
+    self.assertTrue(len(packed) < len(json.dumps(response)) * 3 / 4)
+
+  def test_packed_plain(self):
+    """Tests that the annotations and properties are packed separately."""
+    resource = {'id': 'Pod:guestbook', 'type': 'Pod',
+                'annotations': {'label': 'guestbook'},
+                'properties': {'id': 'Pod:guestbook', 'phase': 'Running'}}
+    packed = msgpack_format.pack(resource)
+    self.assertEqual(resource, msgpack_format.unpack(packed))
+    self.assertEqual(2, packed.count('Pod:guestbook'))
+    self.assertTrue(msgpack_format.pack_plain(resource['properties']) in
+                    packed)
+
+    calls = []
+    def packed_plain(obj, key):
+      calls.append(key)
+      return msgpack_format.pack_plain(obj[key])
+
+    self.assertEqual(packed, msgpack_format.pack(resource, packed_plain))
+    self.assertEqual(['annotations', 'properties'], sorted(calls))
+
+  def test_unpack_errors(self):
+    """Tests unpack() with invalid data."""
+    packed = msgpack_format.pack({'id': 'Node:abcd', 'x': [1, 2.5]})
+    for data in [packed[:-1], packed + '\xc0', '\xc0\xc0', '\x90\xc1',
+                 '\x90\xd4\x00\x00', '\x90\xd4\x01\x00']:
+      self.assertRaises(collector_error.CollectorError,
+                        msgpack_format.unpack, data)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,290 @@
+#!/usr/bin/python
+#
+# Copyright 2015 The Cluster-Insight Authors. All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""On-demand profiling of context graph builds.
+
+Profiler profiles the next context graph builds, or the builds during a
+time window, in one of two modes:
+- 'cprofile' runs each build under cProfile, and returns the aggregated
+  statistics of the builds as a text table sorted by cumulative time.
+- 'sample' samples the stacks of the threads running the builds at a fixed
+  interval, and returns the collapsed stacks: one line per distinct stack
+  with its frames from the outermost to the innermost separated by ';',
+  followed by the number of samples. Flame graph tools such as
+  flamegraph.pl and speedscope read this format.
+
+Only the threads running the builds are profiled. Work done on behalf of a
+build by other threads or by the build processes appears as the build
+thread waiting for it.
+
+The profiler is disabled until a token is set, and it is idle until a
+session is started. An idle profiler costs a single attribute check per
+build.
+
+This class is thread-safe.
+
+Usage:
+  profiler = Profiler()
+  profiler.set_token('secret')
+
+  # In the thread running a build:
+  if profiler.is_active():
+    with profiler.profile_build():
+      build()
+  else:
+    build()
+
+  # In another thread:
+  text, builds = profiler.profile('sample', max_builds=3, seconds=30)
+"""
+
+import collections
+import contextlib
+import cProfile
+import cStringIO
+import hmac
+import os.path
+import pstats
+import sys
+import thread
+import threading
+import types
+
+# local imports
+import collector_error
+import constants
+
+# The profiling modes.
+PROFILE_MODES = ('cprofile', 'sample')
+
+
+def frame_label(frame):
+  """Returns the label of the frame in a collapsed stack.
+
+  The label cannot contain ';', which separates the frames of the stack.
+  """
+  code = frame.f_code
+  return '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename),
+                         code.co_firstlineno)
+
+
+def collapse_stack(frame):
+  """Returns the stack ending at 'frame' in the collapsed stacks format."""
+  labels = []
+  while frame is not None:
+    labels.append(frame_label(frame).replace(';', ':'))
+    frame = frame.f_back
+  labels.reverse()
+  return ';'.join(labels)
+
+
+class _Session(object):
+  """A profiling session.
+
+  Attributes:
+    mode: one of PROFILE_MODES.
+    max_builds: the number of builds to profile.
+    started_builds: the number of builds whose profiling started.
+    finished_builds: the number of builds whose profiling finished.
+    done: an Event that is set when 'max_builds' builds finished.
+    profiles: the cProfile.Profile objects of the finished builds in
+      the 'cprofile' mode.
+    build_threads: a dictionary from the identifiers of the threads running
+      profiled builds to the number of their profiled builds, in the
+      'sample' mode.
+    stacks: a Counter of the collapsed stacks sampled in the 'sample' mode.
+  """
+
+  def __init__(self, mode, max_builds):
+    self.mode = mode
+    self.max_builds = max_builds
+    self.started_builds = 0
+    self.finished_builds = 0
+    self.done = threading.Event()
+    self.profiles = []
+    self.build_threads = {}
+    self.stacks = collections.Counter()
+
+
+class Profiler(object):
+  """Profiles context graph builds on demand.
+
+  Attributes:
+    _lock: a lock protecting access to all other attributes.
+    _token: the token that authorizes profiling, or None if profiling is
+      disabled.
+    _session: the active _Session or None. It is read without the lock by
+      is_active().
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._token = None
+    self._session = None
+
+  def set_token(self, token):
+    """Enables profiling with the given token, or disables it if None."""
+    assert (token is None) or isinstance(token, types.StringTypes)
+    with self._lock:
+      self._token = token or None
+
+  def is_enabled(self):
+    return self._token is not None
+
+  def check_token(self, token):
+    """Returns True if profiling is enabled and 'token' authorizes it."""
+    expected = self._token
+    if (expected is None) or not isinstance(token, types.StringTypes):
+      return False
+    # Compare in constant time, so the response time does not reveal the
+    # length of the matching prefix of the token.
+    return hmac.compare_digest(str(expected), str(token))
+
+  def is_active(self):
+    return self._session is not None
+
+  def profile(self, mode, max_builds, seconds):
+    """Profiles the next builds and returns the profile.
+
+    Waits until 'max_builds' builds were profiled or 'seconds' passed,
+    whichever comes first. The profile contains only the builds that
+    finished by then in the 'cprofile' mode, and the samples taken by then
+    in the 'sample' mode.
+
+    Args:
+      mode: one of PROFILE_MODES.
+      max_builds: the number of builds to profile. It should be positive.
+      seconds: the maximal duration of the profiling in seconds.
+
+    Returns:
+    A tuple (text, builds), where 'text' is the profile in the format of
+    'mode' and 'builds' is the number of builds that were profiled.
+
+    Raises:
+      CollectorError: if profiling is disabled or another profiling session
+      is active.
+    """
+    assert mode in PROFILE_MODES
+    assert isinstance(max_builds, int) and (max_builds > 0)
+    assert isinstance(seconds, (int, float)) and (seconds > 0)
+
+    session = _Session(mode, max_builds)
+    with self._lock:
+      if self._token is None:
+        raise collector_error.CollectorError('profiling is disabled')
+      if self._session is not None:
+        raise collector_error.CollectorError(
+            'another profiling session is active')
+      self._session = session
+
+    sampler = None
+    if mode == 'sample':
+      sampler = threading.Thread(target=self._sample, args=(session,),
+                                 name='profile-sampler')
+      sampler.daemon = True
+      sampler.start()
+
+    try:
+      session.done.wait(seconds)
+    finally:
+      with self._lock:
+        self._session = None
+      if sampler is not None:
+        sampler.join()
+
+    if mode == 'cprofile':
+      return (self._format_profiles(session.profiles), len(session.profiles))
+
+    with self._lock:
+      stacks = sorted(session.stacks.iteritems())
+      builds = session.finished_builds
+    return (''.join('%s %d\n' % item for item in stacks), builds)
+
+  @contextlib.contextmanager
+  def profile_build(self):
+    """A context manager that profiles the enclosed build if needed.
+
+    The build is profiled if a session is active and has not yet started
+    profiling all of its builds.
+    """
+    with self._lock:
+      session = self._session
+      if (session is None) or (session.started_builds >= session.max_builds):
+        session = None
+      else:
+        session.started_builds += 1
+
+    if session is None:
+      yield
+      return
+
+    if session.mode == 'cprofile':
+      profile = cProfile.Profile()
+      profile.enable()
+      try:
+        yield
+      finally:
+        profile.disable()
+        self._finish_build(session, profile)
+      return
+
+    thread_id = thread.get_ident()
+    with self._lock:
+      session.build_threads[thread_id] = (
+          session.build_threads.get(thread_id, 0) + 1)
+    try:
+      yield
+    finally:
+      with self._lock:
+        session.build_threads[thread_id] -= 1
+        if not session.build_threads[thread_id]:
+          del session.build_threads[thread_id]
+      self._finish_build(session, None)
+
+  def _finish_build(self, session, profile):
+    with self._lock:
+      if profile is not None:
+        session.profiles.append(profile)
+      session.finished_builds += 1
+      if session.finished_builds >= session.max_builds:
+        session.done.set()
+
+  def _sample(self, session):
+    """Samples the stacks of the build threads until the session ends."""
+    sampler_id = thread.get_ident()
+    while (self._session is session) and not session.done.is_set():
+      with self._lock:
+        thread_ids = [thread_id for thread_id in session.build_threads
+                      if thread_id != sampler_id]
+      if thread_ids:
+        frames = sys._current_frames()  # pylint: disable=protected-access
+        stacks = [collapse_stack(frames[thread_id])
+                  for thread_id in thread_ids if thread_id in frames]
+        with self._lock:
+          session.stacks.update(stacks)
+      session.done.wait(constants.PROFILE_SAMPLE_INTERVAL_SECONDS)
+
+  def _format_profiles(self, profiles):
+    """Returns the aggregated statistics of the profiles as text."""
+    if not profiles:
+      return ''
+    output = cStringIO.StringIO()
+    stats = pstats.Stats(profiles[0], stream=output)
+    for profile in profiles[1:]:
+      stats.add(profile)
+    stats.strip_dirs().sort_stats('cumulative').print_stats(
+        constants.MAX_PROFILED_FUNCTIONS)
+    return output.getvalue()
@@ -0,0 +1,100 @@
+#!/usr/bin/python
+#
+# Copyright 2015 The Cluster-Insight Authors. All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for collector/profiling.py."""
+
+import threading
+import time
+import unittest
+
+# local imports
+import collector_error
+import profiling
+
+
+def busy_build(seconds):
+  """Keeps the CPU busy for the given time."""
+  end_time = time.time() + seconds
+  while time.time() < end_time:
+    sum(range(100))
+
+
+class TestProfiling(unittest.TestCase):
+
+  def setUp(self):
+    self.profiler = profiling.Profiler()
+
+  def start_builds(self, count, seconds):
+    """Starts a thread running 'count' profiled builds once profiling starts.
+    """
+    def run():
+      while not self.profiler.is_active():
+        time.sleep(0.001)
+      for _ in range(count):
+        with self.profiler.profile_build():
+          busy_build(seconds)
+
+    t = threading.Thread(target=run)
+    t.start()
+    return t
+
+  def test_token(self):
+    """Tests that profiling is disabled until a token is set."""
+    self.assertFalse(self.profiler.is_enabled())
+    self.assertFalse(self.profiler.check_token('secret'))
+    self.assertRaises(collector_error.CollectorError,
+                      self.profiler.profile, 'sample', 1, 0.01)
+
+    self.profiler.set_token('secret')
+    self.assertTrue(self.profiler.is_enabled())
+    self.assertTrue(self.profiler.check_token('secret'))
+    self.assertFalse(self.profiler.check_token('secrets'))
+    self.assertFalse(self.profiler.check_token(None))
+
+  def test_cprofile(self):
+    """Tests the aggregated statistics of the next builds."""
+    self.profiler.set_token('secret')
+    t = self.start_builds(3, 0.02)
+    text, builds = self.profiler.profile('cprofile', 2, 10)
+    t.join()
+    self.assertEqual(2, builds)
+    self.assertTrue('cumulative' in text)
+    self.assertTrue('busy_build' in text)
+    self.assertFalse(self.profiler.is_active())
+
+  def test_sample(self):
+    """Tests the collapsed stacks of the builds during a time window."""
+    self.profiler.set_token('secret')
+    t = self.start_builds(1, 0.2)
+    text, builds = self.profiler.profile('sample', 5, 0.1)
+    t.join()
+    self.assertEqual(0, builds)
+    lines = text.splitlines()
+    self.assertTrue(lines)
+    for line in lines:
+      stack, count = line.rsplit(' ', 1)
+      self.assertTrue(int(count) > 0)
+      self.assertTrue(stack.startswith('__bootstrap (threading.py:'))
+      self.assertTrue(';busy_build (profiling_test.py:' in stack)
+
+    # Builds outside a session are not profiled.
+    with self.profiler.profile_build():
+      pass
+    self.assertFalse(self.profiler.is_active())
+
+
+if __name__ == '__main__':
+  unittest.main()
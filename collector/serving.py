@@ -0,0 +1,501 @@
+#!/usr/bin/python
+#
+# Copyright 2015 The Cluster-Insight Authors. All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A WSGI server for production use.
+
+The Flask development server starts a new thread for every connection and
+closes the connection after every request. PooledWSGIServer serves the
+requests by fixed pools of worker threads and keeps the connections alive
+between requests (HTTP/1.1 persistent connections).
+
+A worker thread serves one request at a time. A connection waits in a
+poller thread until the headers of its next request arrive, and only then
+it is queued for the worker threads. Idle connections and slow clients
+therefore do not occupy worker threads, and all connections are served in
+turn. The thread accepting the connections never waits for a client.
+
+The server peeks at the request line of every request, including the
+later requests of persistent connections, and serves it according to the
+path:
+  - priority requests (such as health checks) are served by a separate
+    pool of worker threads, so they are not queued behind slow requests.
+    Their connections are closed after the request.
+  - streaming requests (such as '/cluster/stream') are served by their
+    own threads, because they are long-lived.
+  - all other requests are served by the general pool of worker threads.
+"""
+
+import errno
+import os
+import Queue  # "Queue" was renamed "queue" in Python 3.
+import select
+import socket
+import threading
+import time
+import types
+
+from werkzeug import serving
+
+# local imports
+import constants
+
+
+def _request_path(data):
+  """Returns the path of the request that starts with 'data'.
+
+  Returns:
+  The path without the query string, or None if the request line is
+  malformed.
+  """
+  # The request line is "<method> <path>[?<query>] <version>".
+  elements = data.split(' ', 2)
+  if len(elements) < 3:
+    return None
+  return elements[1].split('?', 1)[0]
+
+
+def _has_headers(data):
+  """Returns True if 'data' contains the headers of a request.
+
+  A request whose headers are longer than constants.REQUEST_PEEK_SIZE
+  counts as complete, because the server cannot peek at more of it.
+  """
+  return (('\r\n\r\n' in data) or ('\n\n' in data) or
+          (len(data) >= constants.REQUEST_PEEK_SIZE))
+
+
+class _InputStream(object):
+  """A buffered input stream of a socket.
+
+  It replaces the input file of a request handler, because unlike a
+  socket._fileobject it returns the input it buffered (see
+  buffered_input()). The poller thread cannot see the buffered input.
+
+  It implements the methods of a file that the request handler and the
+  WSGI application call: read(), readline() and close().
+  """
+
+  def __init__(self, sock):
+    self._sock = sock
+    self._buf = ''
+    self._pos = 0
+
+  def buffered_size(self):
+    """Returns the number of bytes that were received but not read."""
+    return len(self._buf) - self._pos
+
+  def buffered_input(self):
+    """Returns the bytes that were received but not read."""
+    return self._buf[self._pos:]
+
+  def _fill(self, size):
+    """Receives more input into the buffer.
+
+    Args:
+      size: the number of bytes needed. At least
+        constants.REQUEST_BUFFER_SIZE bytes are requested.
+
+    Returns:
+    False if the input ended.
+    """
+    while True:
+      try:
+        data = self._sock.recv(max(size, constants.REQUEST_BUFFER_SIZE))
+        break
+      except socket.error as e:
+        if e.args[0] != errno.EINTR:
+          raise
+    self._buf = self._buf[self._pos:] + data
+    self._pos = 0
+    return bool(data)
+
+  def _take(self, size):
+    data = self._buf[self._pos:self._pos + size]
+    self._pos += len(data)
+    return data
+
+  def read(self, size=-1):
+    """Reads 'size' bytes, or until the end of the input if 'size' < 0."""
+    while (((size < 0) or (self.buffered_size() < size)) and
+           self._fill(size - self.buffered_size())):
+      pass
+    if size < 0:
+      return self._take(self.buffered_size())
+    return self._take(size)
+
+  def readline(self, size=-1):
+    """Reads a line, or at most 'size' bytes of it if 'size' >= 0."""
+    while True:
+      end = self._buf.find('\n', self._pos)
+      if end >= 0:
+        length = end + 1 - self._pos
+        break
+      if (0 <= size <= self.buffered_size()) or not self._fill(0):
+        length = self.buffered_size()
+        break
+    if size >= 0:
+      length = min(length, size)
+    return self._take(length)
+
+  def close(self):
+    # The socket is closed by the server.
+    self._buf = ''
+    self._pos = 0
+
+
+class _RequestHandler(serving.WSGIRequestHandler):
+  """Serves the requests of a connection one at a time.
+
+  A connection is kept alive only if the response has a Content-Length
+  header. Otherwise the end of the response is marked by closing the
+  connection (see serving.WSGIRequestHandler.run_wsgi()).
+
+  Unlike a standard request handler, which serves all the requests of its
+  connection when it is created, the handler serves a request whenever the
+  server calls serve_request(), and the server calls finish() at the end.
+  """
+  protocol_version = 'HTTP/1.1'
+
+  # Applies to reading a request and writing its response. See setup().
+  timeout = constants.REQUEST_TIMEOUT_SECONDS
+
+  # Buffer the output, so the status line and the headers are sent together
+  # with the body (see serving.WSGIRequestHandler.run_wsgi()).
+  wbufsize = -1
+
+  # Whether the connection is closed after serving the next request. The
+  # server sets it for priority requests.
+  single_request = False
+
+  def __init__(self, request, client_address, server):
+    # Do not call the base class constructor, which serves the requests.
+    self.request = request
+    self.client_address = client_address
+    self.server = server
+    self.setup()
+
+  def setup(self):
+    # Responses are flushed when complete, so do not delay sending them.
+    # Otherwise the responses on a persistent connection may wait for
+    # delayed TCP acknowledgements.
+    self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    serving.WSGIRequestHandler.setup(self)
+    self.rfile.close()
+    self.rfile = _InputStream(self.connection)
+
+  def serve_request(self):
+    """Serves the next request of the connection.
+
+    Returns:
+    True if the connection should be kept alive for another request.
+    """
+    self.close_connection = 1
+    try:
+      self.handle_one_request()
+      self.wfile.flush()
+    except (socket.error, socket.timeout):
+      return False
+    return not (self.close_connection or self.single_request)
+
+  def buffered_input(self):
+    """Returns the part of the next request read into the input buffer."""
+    return self.rfile.buffered_input()
+
+  def send_response(self, code, message=None):
+    self._connection_header_sent = False
+    serving.WSGIRequestHandler.send_response(self, code, message)
+
+  def send_header(self, keyword, value):
+    if keyword.lower() == 'connection':
+      self._connection_header_sent = True
+    serving.WSGIRequestHandler.send_header(self, keyword, value)
+
+  def end_headers(self):
+    """Tells the client if the connection will be closed."""
+    if self.single_request and not self._connection_header_sent:
+      self.send_header('Connection', 'close')
+    serving.WSGIRequestHandler.end_headers(self)
+
+
+class _WaitingConnection(object):
+  """A connection that waits in the poller thread for its next request.
+
+  Attributes:
+    request: the socket of the connection.
+    client_address: the address of the client.
+    handler: the request handler of the connection, or None if the
+      connection is new.
+    deadline: the time when the connection is closed unless the headers of
+      its request arrived.
+    retry_time: the time when the poller thread peeks at the partial
+      headers again, or None if it waits until the connection is readable.
+  """
+
+  def __init__(self, request, client_address, handler, deadline):
+    self.request = request
+    self.client_address = client_address
+    self.handler = handler
+    self.deadline = deadline
+    self.retry_time = None
+
+
+class PooledWSGIServer(serving.BaseWSGIServer):
+  """Serves the requests by fixed pools of worker threads.
+
+  Call serve_forever() to serve the requests and shutdown() from another
+  thread to stop it. The server threads are daemon threads.
+  """
+  multithread = True
+
+  def __init__(self, host, port, app, threads, priority_threads,
+               priority_paths, streaming_paths):
+    """Creates the server and starts its threads.
+
+    Args:
+      host: the host name or address to listen on.
+      port: the port number to listen on. Zero selects any free port.
+      app: the WSGI application.
+      threads: the number of worker threads of the general requests.
+      priority_threads: the number of worker threads of the connections
+        whose first request is for one of 'priority_paths'.
+      priority_paths: a sequence of the paths of requests that must be
+        served promptly, such as health checks.
+      streaming_paths: a sequence of the paths of long-lived responses.
+        The first request of a connection for one of them is served by its
+        own thread.
+    """
+    assert isinstance(threads, int) and threads > 0
+    assert isinstance(priority_threads, int) and priority_threads > 0
+    assert not isinstance(priority_paths, types.StringTypes)
+    assert not isinstance(streaming_paths, types.StringTypes)
+    serving.BaseWSGIServer.__init__(self, host, port, app,
+                                    handler=_RequestHandler)
+    self._priority_paths = frozenset(priority_paths)
+    self._streaming_paths = frozenset(streaming_paths)
+    self._closed = False
+
+    # Request handlers of the connections whose next request is ready.
+    self._handlers = Queue.Queue()
+    self._priority_handlers = Queue.Queue()
+
+    # The _WaitingConnection objects that the poller thread has not seen
+    # yet. Writing to '_wakeup_write_fd' makes the poller thread take them.
+    self._waiting_lock = threading.Lock()
+    self._new_waiting = []
+    self._wakeup_read_fd, self._wakeup_write_fd = os.pipe()
+
+    # The queue of every worker thread.
+    self._worker_queues = []
+    for q, n in ((self._handlers, threads),
+                 (self._priority_handlers, priority_threads)):
+      for _ in xrange(n):
+        self._start_thread(self._serve_handlers, q)
+        self._worker_queues.append(q)
+    self._start_thread(self._poll_connections)
+
+  def _start_thread(self, target, *args):
+    t = threading.Thread(target=target, args=args)
+    t.daemon = True
+    t.start()
+
+  def process_request(self, request, client_address):
+    """Passes a new connection to the poller thread."""
+    self._wait_for_request(request, client_address, None,
+                           constants.REQUEST_TIMEOUT_SECONDS)
+
+  def _wait_for_request(self, request, client_address, handler, timeout):
+    """Makes the connection wait in the poller thread for its next request.
+
+    Args:
+      request: the socket of the connection.
+      client_address: the address of the client.
+      handler: the request handler of the connection, or None if the
+        connection is new.
+      timeout: the connection is closed if the next request does not start
+        within this time in seconds.
+    """
+    connection = _WaitingConnection(request, client_address, handler,
+                                    time.time() + timeout)
+    with self._waiting_lock:
+      self._new_waiting.append(connection)
+    self._wakeup()
+
+  def _queue_request(self, handler, data):
+    """Queues the next request of a connection according to its path.
+
+    Args:
+      handler: the request handler of the connection.
+      data: the beginning of the request.
+    """
+    path = _request_path(data)
+    if path in self._priority_paths:
+      handler.single_request = True
+      self._priority_handlers.put(handler)
+    elif path in self._streaming_paths:
+      self._start_thread(self._serve_request, handler)
+    else:
+      self._handlers.put(handler)
+
+  def _serve_request(self, handler):
+    """Serves one request and keeps the connection alive if possible."""
+    try:
+      keep_alive = handler.serve_request()
+    except Exception:
+      self.handle_error(handler.request, handler.client_address)
+      keep_alive = False
+
+    # A pipelined request may have been read into the input buffer, where
+    # the poller thread cannot see it.
+    data = handler.buffered_input() if keep_alive else ''
+    if data:
+      self._queue_request(handler, data)
+    elif keep_alive:
+      self._wait_for_request(handler.request, handler.client_address,
+                             handler, constants.KEEPALIVE_TIMEOUT_SECONDS)
+    else:
+      self._close_handler(handler)
+
+  def _serve_handlers(self, q):
+    """Serves the requests in the queue 'q' until it contains None."""
+    while True:
+      handler = q.get()
+      if handler is None:
+        return
+      self._serve_request(handler)
+
+  def _close_handler(self, handler):
+    try:
+      handler.finish()
+    except socket.error:
+      pass
+    self.shutdown_request(handler.request)
+
+  def _wakeup(self):
+    os.write(self._wakeup_write_fd, 'x')
+
+  def _close_connection(self, connection):
+    if connection.handler is not None:
+      self._close_handler(connection.handler)
+    else:
+      self.shutdown_request(connection.request)
+
+  def _poll_connections(self):
+    """Queues the waiting connections when their request headers arrive.
+
+    The poller thread peeks at the input of every readable connection. A
+    connection with partial headers remains readable, so the poller thread
+    stops polling it and peeks at it again every
+    constants.REQUEST_PEEK_INTERVAL_SECONDS until the headers are complete.
+    The deadline of such a connection is extended to
+    constants.REQUEST_TIMEOUT_SECONDS after its request started.
+
+    Closes the connections whose deadline passed, and all of them when the
+    server is closed.
+    """
+    # select.poll() is not limited to file descriptors below FD_SETSIZE
+    # like select.select().
+    poller = select.poll()
+    poller.register(self._wakeup_read_fd, select.POLLIN)
+    connections = {}  # file descriptors to _WaitingConnection objects.
+    timeout_ms = None
+    while True:
+      try:
+        events = poller.poll(timeout_ms)
+      except select.error:
+        # Interrupted by a signal.
+        events = []
+
+      # Drain the wakeup pipe before taking the new connections. Otherwise
+      # the wakeup of a connection added in between would be lost.
+      if (self._wakeup_read_fd, select.POLLIN) in events:
+        os.read(self._wakeup_read_fd, 4096)
+      with self._waiting_lock:
+        new_waiting = self._new_waiting
+        self._new_waiting = []
+      for connection in new_waiting:
+        fd = connection.request.fileno()
+        connections[fd] = connection
+        poller.register(fd, select.POLLIN)
+
+      now = time.time()
+      ready = [fd for fd, _ in events if fd in connections]
+      ready.extend(fd for fd, connection in connections.iteritems()
+                   if (connection.retry_time is not None) and
+                   (connection.retry_time <= now))
+
+      for fd in ready:
+        connection = connections[fd]
+        try:
+          data = connection.request.recv(constants.REQUEST_PEEK_SIZE,
+                                         socket.MSG_PEEK)
+        except socket.error:
+          data = ''
+
+        if data and not _has_headers(data):
+          if connection.retry_time is None:
+            poller.unregister(fd)
+            connection.deadline = max(
+                connection.deadline,
+                now + constants.REQUEST_TIMEOUT_SECONDS)
+          connection.retry_time = now + constants.REQUEST_PEEK_INTERVAL_SECONDS
+          continue
+
+        if connection.retry_time is None:
+          poller.unregister(fd)
+        del connections[fd]
+        if not data:
+          # The client closed the connection.
+          self._close_connection(connection)
+          continue
+        try:
+          handler = connection.handler
+          if handler is None:
+            handler = _RequestHandler(connection.request,
+                                      connection.client_address, self)
+          self._queue_request(handler, data)
+        except Exception:
+          self.handle_error(connection.request, connection.client_address)
+          self._close_connection(connection)
+
+      for fd, connection in connections.items():
+        if self._closed or (connection.deadline <= now):
+          if connection.retry_time is None:
+            poller.unregister(fd)
+          del connections[fd]
+          self._close_connection(connection)
+      if self._closed:
+        return
+
+      # Wake up at the next deadline or retry.
+      times = [connection.deadline for connection in connections.itervalues()]
+      times.extend(connection.retry_time
+                   for connection in connections.itervalues()
+                   if connection.retry_time is not None)
+      timeout_ms = None
+      if times:
+        timeout_ms = max(0, int((min(times) - now) * 1000) + 1)
+
+  def server_close(self):
+    """Closes the listening socket and stops the threads.
+
+    The worker threads stop after serving the requests in their queues.
+    The connections waiting in the poller thread are closed.
+    """
+    serving.BaseWSGIServer.server_close(self)
+    self._closed = True
+    self._wakeup()
+    for q in self._worker_queues:
+      q.put(None)
@@ -0,0 +1,211 @@
+#!/usr/bin/python
+#
+# Copyright 2015 The Cluster-Insight Authors. All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for collector/serving.py."""
+
+import httplib
+import resource
+import socket
+import threading
+import unittest
+
+# local imports
+import constants
+import serving
+
+
+class TestServing(unittest.TestCase):
+
+  def setUp(self):
+    # Requests of '/slow' wait until the event is set.
+    self.release = threading.Event()
+    self.server = serving.PooledWSGIServer(
+        'localhost', 0, self.app, 1, 1, ['/healthz'], ['/stream'])
+    self.port = self.server.server_address[1]
+    self.server_thread = threading.Thread(target=self.server.serve_forever)
+    self.server_thread.start()
+
+  def tearDown(self):
+    self.release.set()
+    self.server.shutdown()
+    self.server_thread.join()
+
+  def app(self, environ, start_response):
+    """A WSGI application that returns the client's port number."""
+    path = environ['PATH_INFO']
+    if path == '/slow':
+      self.release.wait()
+    body = str(environ['REMOTE_PORT'])
+    headers = [('Content-Type', 'text/plain')]
+    if path == '/stream':
+      start_response('200 OK', headers)
+      return iter([body])
+
+    headers.append(('Content-Length', str(len(body))))
+    start_response('200 OK', headers)
+    return [body]
+
+  def get(self, path, connection=None):
+    """Returns the response of a GET request of 'path'."""
+    if connection is None:
+      connection = httplib.HTTPConnection('localhost', self.port, timeout=10)
+    connection.request('GET', path)
+    response = connection.getresponse()
+    response.body = response.read()
+    return response
+
+  def test_keepalive(self):
+    """Tests that connections are kept alive between requests."""
+    connection = httplib.HTTPConnection('localhost', self.port, timeout=10)
+    first = self.get('/a', connection)
+    self.assertEqual(200, first.status)
+    second = self.get('/b?c=d', connection)
+    self.assertEqual(200, second.status)
+    self.assertEqual(first.body, second.body)
+    self.assertFalse(second.getheader('Connection'))
+
+    # The idle connection does not occupy the only worker thread.
+    other_connection = httplib.HTTPConnection('localhost', self.port,
+                                              timeout=2)
+    third = self.get('/c', other_connection)
+    self.assertEqual(200, third.status)
+    self.assertTrue(third.body != first.body)
+    self.assertEqual(first.body, self.get('/d', connection).body)
+    other_connection.close()
+    connection.close()
+
+    # A response without a Content-Length header closes the connection.
+    self.assertEqual('close', self.get('/stream').getheader('Connection'))
+
+  def test_priority(self):
+    """Tests that health checks are not queued behind slow requests."""
+    slow_responses = []
+    slow_thread = threading.Thread(
+        target=lambda: slow_responses.append(self.get('/slow')))
+    slow_thread.start()
+
+    # The only general worker thread is busy, but the priority and streaming
+    # requests are served by other threads.
+    response = self.get('/healthz')
+    self.assertEqual(200, response.status)
+    self.assertEqual('close', response.getheader('Connection'))
+    self.assertEqual(200, self.get('/stream').status)
+    self.assertFalse(slow_responses)
+
+    self.release.set()
+    slow_thread.join()
+    self.assertEqual(200, slow_responses[0].status)
+
+  def test_keepalive_routing(self):
+    """Tests that later requests of a connection are routed by their paths.
+    """
+    stream_connection = httplib.HTTPConnection('localhost', self.port,
+                                               timeout=2)
+    health_connection = httplib.HTTPConnection('localhost', self.port,
+                                               timeout=2)
+    self.assertEqual(200, self.get('/a', stream_connection).status)
+    self.assertEqual(200, self.get('/b', health_connection).status)
+
+    slow_responses = []
+    slow_thread = threading.Thread(
+        target=lambda: slow_responses.append(self.get('/slow')))
+    slow_thread.start()
+
+    # The only general worker thread is busy.
+    response = self.get('/stream', stream_connection)
+    self.assertEqual(200, response.status)
+    self.assertEqual('close', response.getheader('Connection'))
+    response = self.get('/healthz', health_connection)
+    self.assertEqual(200, response.status)
+    self.assertEqual('close', response.getheader('Connection'))
+    self.assertFalse(slow_responses)
+
+    self.release.set()
+    slow_thread.join()
+    self.assertEqual(200, slow_responses[0].status)
+    stream_connection.close()
+    health_connection.close()
+
+  def connect(self):
+    """Returns a socket connected to the server."""
+    return socket.create_connection(('localhost', self.port), timeout=10)
+
+  def read_response(self, sock):
+    """Returns the next response on the socket."""
+    response = httplib.HTTPResponse(sock)
+    response.begin()
+    response.body = response.read()
+    return response
+
+  def test_slow_client(self):
+    """Tests that partial requests do not occupy the worker threads."""
+    slow = self.connect()
+    slow.sendall('GET /a HTTP/1.1\r\nHost: localhost\r\n')
+
+    # The only general worker thread serves other connections meanwhile.
+    connection = httplib.HTTPConnection('localhost', self.port, timeout=2)
+    self.assertEqual(200, self.get('/b', connection).status)
+    self.assertEqual(200, self.get('/c').status)
+
+    slow.sendall('\r\n')
+    self.assertEqual(200, self.read_response(slow).status)
+    connection.close()
+    slow.close()
+
+  def test_pipelining(self):
+    """Tests requests sent before the previous response arrived."""
+    sock = self.connect()
+    sock.sendall('GET /a HTTP/1.1\r\nHost: localhost\r\n\r\n'
+                 'GET /b HTTP/1.1\r\nHost: localhost\r\n\r\n')
+    first = self.read_response(sock)
+    second = self.read_response(sock)
+    self.assertEqual(200, first.status)
+    self.assertEqual(200, second.status)
+    self.assertEqual(first.body, second.body)
+    sock.close()
+
+  def test_many_connections(self):
+    """Tests file descriptors above the limit of select.select()."""
+    count = 1100
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < 3 * count:
+      if (hard != resource.RLIM_INFINITY) and (hard < 3 * count):
+        self.skipTest('too few file descriptors')
+      resource.setrlimit(resource.RLIMIT_NOFILE, (3 * count, hard))
+      self.addCleanup(resource.setrlimit, resource.RLIMIT_NOFILE,
+                      (soft, hard))
+
+    # Opening the connections may take longer than the keep-alive timeout.
+    saved_timeout = constants.KEEPALIVE_TIMEOUT_SECONDS
+    constants.KEEPALIVE_TIMEOUT_SECONDS = 60
+    connections = []
+    try:
+      for _ in xrange(count):
+        connection = httplib.HTTPConnection('localhost', self.port,
+                                            timeout=10)
+        self.assertEqual(200, self.get('/a', connection).status)
+        connections.append(connection)
+      # All the connections are still alive.
+      for connection in connections[::100] + connections[-1:]:
+        self.assertEqual(200, self.get('/b', connection).status)
+    finally:
+      constants.KEEPALIVE_TIMEOUT_SECONDS = saved_timeout
+      for connection in connections:
+        connection.close()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -37,6 +37,12 @@ In other words, the creation time is updated whenever the value is also changed
 in the cache. Calling update() always changes the update time, but it may
 not change the value or the creation time.
 
+If the value is a list of wrapped objects (see utilities.wrap_object()), the
+objects are compared one by one. When the list changed, the objects that did
+not change (without their 'timestamp' attributes) are replaced by their
+previously cached versions. An object therefore keeps its timestamp until
+it changes, even when other objects in the list change.
+
 Old data is removed from the cache as a side effect of calling the update()
 operation. Old data is removed when it was created more than
 DATA_CLEANUP_AGE_SECONDS seconds ago.
@@ -82,10 +88,12 @@ class SimpleCache(object):
     _data_cleanup_age_seconds: data older than this many seconds will be cleaned
       from the cache.
     _label_to_tuple: a lookup table from label to a named tuple
-      (update_timestamp, value), where 'update_timestamp' is
-      the time the data was last updated. 'value' is a deep copy of the data.
-    _namedtuple: a named tuple containing a 'update_timestamp' and 'value'
-      fields.
+      (create_timestamp, update_timestamp, value, object_hashes), where
+      'update_timestamp' is the time the data was last updated. 'value' is a
+      deep copy of the data. 'object_hashes' is the list of the IDs and
+      timeless hashes of the objects in 'value' if it is a list of wrapped
+      objects, and None otherwise (see _object_hashes()).
+    _namedtuple: a named tuple containing the above fields.
   """
 
   def __init__(self, max_data_age_seconds, data_cleanup_age_seconds):
@@ -103,7 +111,24 @@ class SimpleCache(object):
     self._data_cleanup_age_seconds = data_cleanup_age_seconds
     self._label_to_tuple = {}
     self._namedtuple = collections.namedtuple(
-        'Tuple', ['create_timestamp', 'update_timestamp', 'value'])
+        'Tuple', ['create_timestamp', 'update_timestamp', 'value',
+                  'object_hashes'])
+
+  def _object_hashes(self, value):
+    """Returns the IDs and timeless hashes of the objects in 'value'.
+
+    Args:
+      value: any value.
+
+    Returns:
+    A list of (ID, timeless hash) pairs in the order of the objects in
+    'value' if 'value' is a non-empty list of wrapped objects. Otherwise
+    None.
+    """
+    if not (isinstance(value, list) and value and
+            all(utilities.is_wrapped_object(obj) for obj in value)):
+      return None
+    return [(obj['id'], utilities.timeless_json_hash(obj)) for obj in value]
 
   def _cleanup(self, now):
     """Removes all data older than _data_cleanup_age_seconds from the cache.
@@ -173,7 +198,9 @@ class SimpleCache(object):
 
     If 'value' is the same as the current value associated with the label
     after removal of 'timestamp' attributes, then the cached value is not
-    changed.
+    changed. Otherwise, if both values are lists of wrapped objects, the
+    unchanged objects of 'value' are replaced by their cached versions, so
+    they keep their timestamps.
     The cache keeps a deep copy of 'value', so the caller may change 'value'
     afterwards.
 
@@ -181,7 +208,8 @@ class SimpleCache(object):
     The values that was stored in the cache. If the value stored in the cache
     was not changed, then the returned value is the deep copy of the old cached
     value.
-    Otherwise the returned value is 'value'.
+    Otherwise the returned value is 'value', or a list of the same type
+    as 'value' with the unchanged objects replaced.
 
     In any case, the caller may modify 'value' or the returned value after
     this method returns.
@@ -196,21 +224,39 @@ class SimpleCache(object):
     # avoid penalizing the cache hit operation.
     ts = time.time() if update_timestamp is None else update_timestamp
     self._cleanup(ts)
-    if ((label in self._label_to_tuple) and
-        (utilities.timeless_json_hash(value) ==
-         utilities.timeless_json_hash(self._label_to_tuple[label].value))):
-      # cannot update just one field in a named tuple.
-      create_ts = self._label_to_tuple[label].create_timestamp
-      update_value = self._label_to_tuple[label].value
+    old_tuple = self._label_to_tuple.get(label)
+    object_hashes = self._object_hashes(value)
+    if old_tuple is None:
+      unchanged = False
+    elif (object_hashes is None) or (old_tuple.object_hashes is None):
+      unchanged = (utilities.timeless_json_hash(value) ==
+                   utilities.timeless_json_hash(old_tuple.value))
+    else:
+      unchanged = (object_hashes == old_tuple.object_hashes)
+
+    if unchanged:
+      create_ts = old_tuple.create_timestamp
+      update_value = old_tuple.value
+      object_hashes = old_tuple.object_hashes
       ret_value = copy.deepcopy(update_value)
     else:
       create_ts = ts
-      update_value = copy.deepcopy(value)
-      ret_value = value
+      if (object_hashes is not None) and (old_tuple is not None) and (
+          old_tuple.object_hashes is not None):
+        # Reuse the cached versions of the unchanged objects. The cached
+        # value is replaced below, so its objects are not shared.
+        old_objects = dict(zip(old_tuple.object_hashes, old_tuple.value))
+        ret_value = type(value)()
+        ret_value.extend(old_objects.get(key, obj)
+                         for key, obj in zip(object_hashes, value))
+      else:
+        ret_value = value
+      update_value = copy.deepcopy(ret_value)
 
     # cannot update just one field in a named tuple.
     self._label_to_tuple[label] = self._namedtuple(
-        update_timestamp=ts, create_timestamp=create_ts, value=update_value)
+        update_timestamp=ts, create_timestamp=create_ts, value=update_value,
+        object_hashes=object_hashes)
     self._lock.release()
     return ret_value
 
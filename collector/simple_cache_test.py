@@ -232,6 +232,33 @@ class TestSimpleCache(unittest.TestCase):
          'lastHeartbeatTime': utilities.seconds_to_timestamp(seconds)},
         'Node', KEY, seconds)
 
+  def test_update_list(self):
+    """Verify that unchanged objects in a changed list keep their timestamps.
+    """
+    now = time.time()
+    nodes = utilities.TimestampedList()
+    nodes.extend([self.make_same_node(now),
+                  utilities.wrap_object({'uid': 'x'}, 'Node', 'x', now)])
+    self._cache.update(KEY, nodes, now)
+
+    later = now + 1
+    changed_nodes = utilities.TimestampedList()
+    changed_nodes.extend([self.make_same_node(later),
+                          utilities.wrap_object({'uid': 'y'}, 'Node', 'x',
+                                                later)])
+    ret_value = self._cache.update(KEY, changed_nodes, later)
+    self.assertTrue(isinstance(ret_value, utilities.TimestampedList))
+    self.assertEqual([now, later], [obj['timestamp'] for obj in ret_value])
+    self.assertEqual(later, ret_value.max_timestamp())
+    # The unchanged object is the cached version, including its
+    # 'lastHeartbeatTime'.
+    self.assertEqual(self.make_same_node(now), ret_value[0])
+    self.assertEqual({'uid': 'y'}, ret_value[1]['properties'])
+
+    value, timestamp = self._cache.lookup(KEY, later)
+    self.assertEqual(ret_value, value)
+    self.assertEqual(later, timestamp)
+
   def test_continuous_access_same_object(self):
     """Verify continuous access of the same object."""
     start_timestamp = time.time()
@@ -0,0 +1,277 @@
+#!/usr/bin/python
+#
+# Copyright 2015 The Cluster-Insight Authors. All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Lightweight tracing of the phases of requests.
+
+A trace records the spans of a request: the named and timed phases, such as
+fetching the pods or serializing the context graph. Spans are nested, so
+every span has the ID of its parent span, or None if it is a top-level span
+of the request. The trace ID identifies the request, and it is returned in
+the 'X-Trace-Id' response header.
+
+The current trace and span are kept per thread. Code running in other
+threads on behalf of the request continues the trace by calling
+activate() with the value of current_context() in the request's thread.
+Spans outside a trace are not recorded, so instrumented code costs little
+when it is not traced.
+
+Finished traces are passed to exporters, which are objects with an
+export(trace) method. FileExporter writes the traces to a local file, and
+stands in for exporters to external tracing backends.
+
+Usage:
+  trace = start_trace('GET /cluster')
+  with span('fetch', {'kind': 'pods'}):
+    fetch_pods()
+  end_trace()
+  FileExporter('/tmp/traces.json').export(trace)
+"""
+
+import binascii
+import collections
+import contextlib
+import json
+import os
+import thread
+import threading
+import time
+import types
+
+# local imports
+import utilities
+
+# A finished span. 'span_id' is unique within its trace, 'parent_id' is the
+# ID of the enclosing span or None, and 'attributes' is a dictionary or None.
+Span = collections.namedtuple(
+    'Span', ['span_id', 'parent_id', 'name', 'start_time',
+             'duration_seconds', 'thread_identifier', 'attributes'])
+
+# The current trace and span ID of the thread.
+_local = threading.local()
+
+
+class Trace(object):
+  """The spans of a request.
+
+  Spans may be added from several threads. The other attributes are set by
+  the thread that started the trace.
+
+  Attributes:
+    trace_id: a random hexadecimal ID of the trace.
+    name: the name of the trace, such as the method and path of the request.
+    start_time: the start time of the trace in seconds since the epoch.
+    duration_seconds: the duration of the trace, or None if it is active.
+    attributes: a dictionary of attributes of the trace, such as the
+      status code of the response.
+  """
+
+  def __init__(self, name):
+    assert isinstance(name, types.StringTypes)
+    self.trace_id = binascii.hexlify(os.urandom(8))
+    self.name = name
+    self.start_time = time.time()
+    self.duration_seconds = None
+    self.attributes = {}
+    self._lock = threading.Lock()
+    self._spans = []
+    self._last_span_id = 0
+
+  def new_span_id(self):
+    with self._lock:
+      self._last_span_id += 1
+      return self._last_span_id
+
+  def add_span(self, s):
+    assert isinstance(s, Span)
+    with self._lock:
+      self._spans.append(s)
+
+  def get_spans(self):
+    """Returns the finished spans in order of their start times."""
+    with self._lock:
+      return sorted(self._spans, key=lambda s: (s.start_time, s.span_id))
+
+  def finish(self):
+    self.duration_seconds = time.time() - self.start_time
+
+  def to_dict(self):
+    """Returns a description of the trace for encoding in JSON.
+
+    The start times of the spans are relative to the start of the trace.
+    """
+    return {
+        'traceId': self.trace_id,
+        'name': self.name,
+        'start_time': utilities.seconds_to_timestamp(self.start_time),
+        'duration_seconds': self.duration_seconds,
+        'attributes': self.attributes,
+        'spans': [{'id': s.span_id,
+                   'parent': s.parent_id,
+                   'name': s.name,
+                   'start_offset_seconds': s.start_time - self.start_time,
+                   'duration_seconds': s.duration_seconds,
+                   'threadIdentifier': s.thread_identifier,
+                   'attributes': s.attributes}
+                  for s in self.get_spans()]}
+
+
+def start_trace(name):
+  """Starts a new trace in the current thread and returns it."""
+  trace = Trace(name)
+  _local.trace = trace
+  _local.span_id = None
+  return trace
+
+
+def current_trace():
+  """Returns the trace of the current thread or None."""
+  return getattr(_local, 'trace', None)
+
+
+def end_trace():
+  """Finishes the trace of the current thread and returns it or None."""
+  trace = current_trace()
+  _local.trace = None
+  _local.span_id = None
+  if trace is not None:
+    trace.finish()
+  return trace
+
+
+def current_context():
+  """Returns the current trace and span ID for passing to activate()."""
+  return (current_trace(), getattr(_local, 'span_id', None))
+
+
+@contextlib.contextmanager
+def activate(context):
+  """Continues a trace of another thread in the current thread.
+
+  Args:
+    context: the value of current_context() in the other thread. The spans
+      of the current thread will be children of its current span.
+  """
+  saved_context = current_context()
+  _local.trace, _local.span_id = context
+  try:
+    yield
+  finally:
+    _local.trace, _local.span_id = saved_context
+
+
+@contextlib.contextmanager
+def span(name, attributes=None, observe=None):
+  """Records the enclosed code as a span of the current trace.
+
+  Args:
+    name: the name of the span.
+    attributes: an optional dictionary of attributes of the span.
+    observe: an optional function that is called with the duration of the
+      span in seconds, even if there is no current trace.
+  """
+  trace = current_trace()
+  start_time = time.time()
+  if trace is None:
+    try:
+      yield
+    finally:
+      if observe is not None:
+        observe(time.time() - start_time)
+    return
+
+  parent_id = _local.span_id
+  span_id = trace.new_span_id()
+  _local.span_id = span_id
+  try:
+    yield
+  finally:
+    _local.span_id = parent_id
+    duration = time.time() - start_time
+    trace.add_span(Span(span_id=span_id, parent_id=parent_id, name=name,
+                        start_time=start_time, duration_seconds=duration,
+                        thread_identifier=thread.get_ident(),
+                        attributes=attributes))
+    if observe is not None:
+      observe(duration)
+
+
+def iter_span(name, iterable, attributes=None):
+  """Records the iteration over 'iterable' as a span of the current trace.
+
+  The span is a child of the current span, and it is recorded when the
+  iteration ends or the returned generator is closed, even if that happens
+  after the trace ended, such as when a streamed response is generated. Its
+  duration is the time spent producing the items, excluding the time
+  between them.
+
+  Args:
+    name: the name of the span.
+    iterable: the iterable to iterate over.
+    attributes: an optional dictionary of attributes of the span.
+
+  Returns:
+  An iterator over the items of 'iterable'.
+  """
+  trace, parent_id = current_context()
+  if trace is None:
+    return iter(iterable)
+  return _iter_span(trace, parent_id, trace.new_span_id(), name, iterable,
+                    attributes)
+
+
+def _iter_span(trace, parent_id, span_id, name, iterable, attributes):
+  """A generator of the items of 'iterable' that records their span."""
+  iterator = iter(iterable)
+  start_time = time.time()
+  duration = 0.0
+  try:
+    while True:
+      item_start_time = time.time()
+      try:
+        item = next(iterator)
+      except StopIteration:
+        return
+      finally:
+        duration += time.time() - item_start_time
+      yield item
+  finally:
+    trace.add_span(Span(span_id=span_id, parent_id=parent_id, name=name,
+                        start_time=start_time, duration_seconds=duration,
+                        thread_identifier=thread.get_ident(),
+                        attributes=attributes))
+
+
+class FileExporter(object):
+  """Appends the finished traces to a file, one JSON object per line.
+
+  This class is thread-safe.
+  """
+
+  def __init__(self, path):
+    assert isinstance(path, types.StringTypes)
+    self._lock = threading.Lock()
+    self._file = open(path, 'a')
+
+  def export(self, trace):
+    assert isinstance(trace, Trace)
+    line = json.dumps(trace.to_dict()) + '\n'
+    with self._lock:
+      self._file.write(line)
+      self._file.flush()
+
+  def close(self):
+    with self._lock:
+      self._file.close()
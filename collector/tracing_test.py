@@ -0,0 +1,131 @@
+#!/usr/bin/python
+#
+# Copyright 2015 The Cluster-Insight Authors. All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for collector/tracing.py."""
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+# local imports
+import tracing
+
+
+class TestTracing(unittest.TestCase):
+
+  def tearDown(self):
+    tracing.end_trace()
+
+  def test_spans(self):
+    """Tests nested spans in the current thread and in another thread."""
+    durations = []
+    with tracing.span('untraced', observe=durations.append):
+      pass
+    self.assertEqual(1, len(durations))
+
+    trace = tracing.start_trace('GET /cluster')
+    self.assertTrue(tracing.current_trace() is trace)
+    with tracing.span('outer', {'kind': 'pods'}):
+      context = tracing.current_context()
+
+      def run():
+        with tracing.activate(context):
+          with tracing.span('inner'):
+            pass
+        self.assertEqual((None, None), tracing.current_context())
+
+      t = threading.Thread(target=run)
+      t.start()
+      t.join()
+    with tracing.span('next', observe=durations.append):
+      pass
+    self.assertTrue(tracing.end_trace() is trace)
+    self.assertTrue(tracing.current_trace() is None)
+
+    self.assertEqual(2, len(durations))
+    self.assertTrue(trace.duration_seconds >= 0)
+    spans = trace.get_spans()
+    self.assertEqual(['outer', 'inner', 'next'], [s.name for s in spans])
+    outer, inner, following = spans
+    self.assertEqual({'kind': 'pods'}, outer.attributes)
+    self.assertTrue(outer.parent_id is None)
+    self.assertEqual(outer.span_id, inner.parent_id)
+    self.assertTrue(inner.thread_identifier != outer.thread_identifier)
+    self.assertTrue(following.parent_id is None)
+    self.assertEqual(3, len(set(s.span_id for s in spans)))
+
+  def test_iter_span(self):
+    """Tests a span of an iteration that continues after the trace ended."""
+    self.assertEqual([1, 2], list(tracing.iter_span('untraced', [1, 2])))
+
+    def generate():
+      time.sleep(0.01)
+      yield 'a'
+      time.sleep(0.01)
+      yield 'b'
+
+    trace = tracing.start_trace('GET /cluster')
+    with tracing.span('outer'):
+      items = tracing.iter_span('serialize', generate(), {'encoding': 'json'})
+    tracing.end_trace()
+    self.assertEqual(['outer'], [s.name for s in trace.get_spans()])
+
+    self.assertEqual('a', next(items))
+    time.sleep(0.05)
+    self.assertEqual(['b'], list(items))
+    outer, serialize = trace.get_spans()
+    self.assertEqual('serialize', serialize.name)
+    self.assertEqual(outer.span_id, serialize.parent_id)
+    self.assertEqual({'encoding': 'json'}, serialize.attributes)
+    # The time between the items is excluded.
+    self.assertTrue(0.02 <= serialize.duration_seconds < 0.05)
+
+    # Closing the iteration records its span.
+    trace = tracing.start_trace('GET /cluster')
+    items = tracing.iter_span('serialize', generate())
+    tracing.end_trace()
+    next(items)
+    items.close()
+    self.assertEqual(['serialize'], [s.name for s in trace.get_spans()])
+
+  def test_file_exporter(self):
+    """Tests that the file exporter writes a JSON line per trace."""
+    tmp_dir = tempfile.mkdtemp()
+    try:
+      path = os.path.join(tmp_dir, 'traces.json')
+      exporter = tracing.FileExporter(path)
+      for name in ('first', 'second'):
+        tracing.start_trace(name)
+        with tracing.span('phase'):
+          pass
+        exporter.export(tracing.end_trace())
+      exporter.close()
+
+      with open(path) as f:
+        traces = [json.loads(line) for line in f]
+      self.assertEqual(['first', 'second'], [t['name'] for t in traces])
+      self.assertEqual('phase', traces[0]['spans'][0]['name'])
+      self.assertTrue(traces[0]['traceId'] != traces[1]['traceId'])
+    finally:
+      shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -16,15 +16,44 @@
 
 """Common utility routines for the Cluster-Insight data collector."""
 
+import cStringIO
 import datetime
+import gzip
 import hashlib
 import json
 import re
+import threading
+import time
 import types
 
+# ujson is an optional faster JSON encoder. See dumps_json().
+try:
+  import ujson
+except ImportError:
+  ujson = None
+
 # local imports
+import collector_error
+import constants
 import global_state
 
+# The argument checking decorators below (global_state_arg() etc.) wrap
+# their function only when assertions are enabled. When Python runs with
+# optimizations (python -O), the assertions are disabled, and the decorators
+# return their function as is, so hot functions are called without the
+# overhead of a wrapper. The objects are validated when they are wrapped
+# (see wrap_object()), so the per-call checks are redundant in production.
+CHECK_ARGUMENTS = __debug__
+
+# The JSON encoder of dumps_json() when ujson is not installed. It does not
+# sort the keys, because the json module of Python 2.7 uses its C encoder
+# only when the keys are not sorted.
+_json_encoder = json.JSONEncoder()
+
+# Maps whole seconds since the epoch to their ISO 8601 format.
+# See seconds_to_timestamp().
+_seconds_to_iso = {}
+
 
 def valid_string(x):
   """Returns True iff 'x' is a non-empty string."""
@@ -36,17 +65,56 @@ def valid_optional_string(x):
   return (x is None) or valid_string(x)
 
 
+def valid_timestamp(x):
+  """Returns True iff 'x' is seconds since the epoch or a non-empty string."""
+  return (isinstance(x, (int, long, float)) and
+          not isinstance(x, bool)) or valid_string(x)
+
+
 def seconds_to_timestamp(seconds):
   """Converts a timestamp in seconds since the epoch to ISO 8601 format.
 
   Args:
     seconds: timestamp in seconds since the epoch.
 
+  The formatting of whole seconds is memoised, because many timestamps
+  share the same second. The result is identical to
+  datetime.datetime.fromtimestamp(seconds).isoformat().
+
   Returns:
   An ISO 8601 date/time value, which is YYYY-MM-DDTHH:MM:SS[.mmmmmm].
   """
   assert isinstance(seconds, (int, long, float))
-  return datetime.datetime.fromtimestamp(seconds).isoformat()
+  whole_seconds = int(seconds // 1)
+  microseconds = int(round((seconds - whole_seconds) * 1e6))
+  if microseconds >= 1000000:
+    whole_seconds += 1
+    microseconds -= 1000000
+
+  prefix = _seconds_to_iso.get(whole_seconds)
+  if prefix is None:
+    if len(_seconds_to_iso) >= constants.MAX_CACHED_TIMESTAMP_SECONDS:
+      _seconds_to_iso.clear()
+    prefix = datetime.datetime.fromtimestamp(whole_seconds).isoformat()
+    _seconds_to_iso[whole_seconds] = prefix
+
+  if microseconds == 0:
+    return prefix
+  return '%s.%06d' % (prefix, microseconds)
+
+
+def iso_timestamp(timestamp):
+  """Returns the given timestamp in ISO 8601 format.
+
+  Args:
+    timestamp: either seconds since the epoch or an ISO 8601 date/time value.
+
+  Returns:
+  An ISO 8601 date/time value, which is YYYY-MM-DDTHH:MM:SS[.mmmmmm].
+  """
+  if isinstance(timestamp, types.StringTypes):
+    return timestamp
+  return seconds_to_timestamp(timestamp)
 
 
 def now():
@@ -55,12 +123,15 @@ def now():
   Returns:
   An ISO 8601 date/time value, which is YYYY-MM-DDTHH:MM:SS[.mmmmmm].
   """
-  return datetime.datetime.now().isoformat()
+  return seconds_to_timestamp(time.time())
 
 
 def global_state_arg(func):
   """A decorator for a function that should be given a global state argument.
   """
+  if not CHECK_ARGUMENTS:
+    return func
+
   def inner(arg1):
     assert isinstance(arg1, global_state.GlobalState)
     return func(arg1)
@@ -71,6 +142,9 @@ def global_state_arg(func):
 def one_string_arg(func):
   """A decorator for a function that should be given exactly one valid string.
   """
+  if not CHECK_ARGUMENTS:
+    return func
+
   def inner(arg1):
     assert valid_string(arg1)
     return func(arg1)
@@ -83,6 +157,9 @@ def global_state_string_args(func):
 
   The string argument must be valid (see valid_string() above).
   """
+  if not CHECK_ARGUMENTS:
+    return func
+
   def inner(arg1, arg2):
     assert isinstance(arg1, global_state.GlobalState)
     assert valid_string(arg2)
@@ -103,6 +180,9 @@ def global_state_dict_args(func):
   Returns:
   A decorated function.
   """
+  if not CHECK_ARGUMENTS:
+    return func
+
   def inner(arg1, arg2):
     assert isinstance(arg1, global_state.GlobalState)
     assert isinstance(arg2, dict) and arg2
@@ -123,6 +203,9 @@ def two_dict_args(func):
   Returns:
   A decorated function.
   """
+  if not CHECK_ARGUMENTS:
+    return func
+
   def inner(arg1, arg2):
     assert isinstance(arg1, dict) and arg1
     assert isinstance(arg2, dict) and arg2
@@ -134,15 +217,16 @@ def two_dict_args(func):
 def wrap_object(obj, obj_type, obj_id, timestamp, label=None,
                 alt_label=None):
   """Returns a dictionary containing the standard wrapper around 'obj'.
+
+  The timestamp is kept as is. Wrapped objects usually carry timestamps in
+  seconds since the epoch, which are converted to ISO 8601 format only in
+  the output (see with_iso_timestamp()).
   """
   assert valid_string(obj_type) and valid_string(obj_id)
   assert isinstance(timestamp, (float, str))
   assert valid_optional_string(label)
   assert valid_optional_string(alt_label)
 
-  if not isinstance(timestamp, str):
-    timestamp = seconds_to_timestamp(timestamp)
-
   wrapped_obj = {
       'id': obj_id, 'type': obj_type,
       'timestamp': timestamp,
@@ -175,11 +259,111 @@ def is_wrapped_object(obj, expected_type=None):
   True iff 'obj' is a wrapped object of the expected type.
   """
   assert valid_optional_string(expected_type)
-  return (valid_string(get_attribute(obj, ['id'])) and
-          valid_string(get_attribute(obj, ['type'])) and
-          ((expected_type is None) or (obj['type'] == expected_type)) and
-          valid_string(get_attribute(obj, ['timestamp'])) and
-          isinstance(get_attribute(obj, ['properties']), dict))
+  # This function is called for every object in the graph build, so it
+  # accesses the attributes directly instead of calling get_attribute().
+  return bool(isinstance(obj, dict) and
+              valid_string(obj.get('id')) and
+              valid_string(obj.get('type')) and
+              ((expected_type is None) or (obj['type'] == expected_type)) and
+              valid_timestamp(obj.get('timestamp')) and
+              isinstance(obj.get('properties'), dict))
+
+
+def with_iso_timestamp(obj):
+  """Returns 'obj' with its 'timestamp' attribute in ISO 8601 format.
+
+  Args:
+    obj: a wrapped object, resource or relation.
+
+  Returns:
+  'obj' if its timestamp is already in ISO 8601 format. Otherwise a shallow
+  copy of 'obj' with the formatted timestamp, so 'obj' is not modified.
+  """
+  timestamp = obj['timestamp']
+  if isinstance(timestamp, types.StringTypes):
+    return obj
+  result = dict(obj)
+  result['timestamp'] = seconds_to_timestamp(timestamp)
+  return result
+
+
+class TimestampedList(list):
+  """A list of wrapped objects that tracks their maximal timestamp.
+
+  The maximal timestamp is updated as objects are added by append() or
+  extend(), so max_timestamp() does not scan the list. Objects must not be
+  added in any other way, and they must not be removed or replaced.
+  Deep copies and pickled copies of a TimestampedList are TimestampedLists
+  with the same maximal timestamp.
+  """
+  # A class attribute, because unpickling appends the elements before it
+  # restores the instance attributes.
+  _max_timestamp = None
+
+  def append(self, obj):
+    list.append(self, obj)
+    if (self._max_timestamp is None) or (obj['timestamp'] >
+                                         self._max_timestamp):
+      self._max_timestamp = obj['timestamp']
+
+  def extend(self, objs):
+    for obj in objs:
+      self.append(obj)
+
+  def max_timestamp(self):
+    """Returns the maximal timestamp of the objects or None if empty."""
+    return self._max_timestamp
+
+
+class RingBuffer(object):
+  """A fixed-size buffer of the most recently appended items.
+
+  Every appended item gets the next sequence number, starting from zero.
+  When the buffer is full, an appended item overwrites the oldest item.
+  Reading the items does not remove them. A reader reads only the new items
+  by passing the sequence number returned by its previous read.
+
+  This class is thread-safe.
+  """
+
+  def __init__(self, size):
+    assert isinstance(size, int) and size > 0
+    self._lock = threading.Lock()
+    self._items = [None] * size
+    self._next_sequence = 0
+
+  def append(self, item):
+    with self._lock:
+      self._items[self._next_sequence % len(self._items)] = item
+      self._next_sequence += 1
+
+  def snapshot(self, since=0):
+    """Returns the items appended since the given sequence number.
+
+    Args:
+      since: the sequence number of the first item to return.
+
+    Returns:
+    A tuple (items, start, end). 'items' is the list of the items whose
+    sequence numbers are at least 'start' and less than 'end', in the order
+    they were appended. 'end' is the sequence number of the next item, which
+    should be passed as 'since' in the next call to read the new items only.
+    'start' is greater than 'since' if the items between them were
+    overwritten before they were read.
+    """
+    assert isinstance(since, (int, long)) and since >= 0
+    with self._lock:
+      size = len(self._items)
+      end = self._next_sequence
+      start = min(max(since, end - size), end)
+      first = start % size
+      last = first + (end - start)
+      if last <= size:
+        items = self._items[first:last]
+      else:
+        # The items wrap around the end of the list.
+        items = self._items[first:] + self._items[:last - size]
+    return items, start, end
 
 
 def timeless_json_hash(obj):
@@ -194,12 +378,14 @@ def timeless_json_hash(obj):
   values. The values of these attributes change continously and they do not
   add much to the semantics of the object. Ignoring the values of these
   attributes prevent false positive indications that the object changed.
+  The 'timestamp' values may be ISO 8601 strings or seconds since the epoch.
   The JSON representation lists all attributes in sorted order to ensure
   consistent hashing.
   """
   s = json.dumps(obj, sort_keys=True)
   m = hashlib.sha1()
   s = re.sub(r'"(timestamp|lastHeartbeatTime)": "[-0-9:.TZ]+"', '', s)
+  s = re.sub(r'"timestamp": [-0-9.e+]+', '', s)
   s = re.sub(r'"resourceVersion": "[0-9]+"', '', s)
   m.update(s)
   return m.digest()
@@ -238,25 +424,234 @@ def get_attribute(obj, names_list):
   return v
 
 
+def parse_fields(fields):
+  """Parses a list of attribute paths into a projection.
+
+  Args:
+    fields: a comma-separated list of attribute paths. Each path is a
+      dot-separated list of attribute names, such as 'properties.metadata.name'.
+
+  Returns:
+  A projection, which is a dictionary from attribute names to either None
+  (meaning the entire attribute value) or a nested projection of the
+  attribute value. See project().
+
+  Raises:
+    CollectorError: if 'fields' contains an empty path or attribute name.
+  """
+  assert isinstance(fields, types.StringTypes)
+  projection = {}
+  for path in fields.split(','):
+    names = path.strip().split('.')
+    if not all(names):
+      raise collector_error.CollectorError('invalid fields: %s' % fields)
+
+    node = projection
+    for name in names[:-1]:
+      if (name in node) and (node[name] is None):
+        # The entire value of this attribute was already requested.
+        break
+      node = node.setdefault(name, {})
+    else:
+      node[names[-1]] = None
+
+  return projection
+
+
+def project(obj, projection):
+  """Returns the parts of 'obj' selected by 'projection'.
+
+  Only the dictionaries along the selected attribute paths are copied.
+  The selected values are shared with 'obj', and the unselected values are
+  never visited. Lists are projected element by element, so the path
+  'properties.spec.containers.image' selects the image of every container.
+  Selected attributes that do not exist in 'obj' are omitted.
+
+  Args:
+    obj: a dictionary.
+    projection: the output of parse_fields().
+
+  Returns:
+  A new dictionary containing the selected attributes of 'obj'.
+  """
+  assert isinstance(obj, dict)
+  assert isinstance(projection, dict)
+  result = {}
+  for name, sub_projection in projection.iteritems():
+    if name not in obj:
+      continue
+    value = obj[name]
+    if sub_projection is None:
+      result[name] = value
+    elif isinstance(value, dict):
+      result[name] = project(value, sub_projection)
+    elif isinstance(value, list):
+      result[name] = [project(x, sub_projection) if isinstance(x, dict)
+                      else x for x in value]
+    else:
+      result[name] = value
+
+  return result
+
+
+def project_response(response, projection):
+  """Applies 'projection' to the resources of a successful response.
+
+  The resources are either a list (for example, in the output of
+  make_response()) or a dictionary containing 'added' and 'modified'
+  lists (in the output of context.compute_changes()).
+
+  Args:
+    response: a response dictionary. It is modified in place.
+    projection: the output of parse_fields() or None.
+
+  Returns:
+  'response' after replacing its resources by their projections.
+  If 'projection' is None, 'response' is not changed.
+  """
+  assert isinstance(response, dict)
+  if (projection is None) or not response.get('success'):
+    return response
+
+  resources = response.get('resources')
+  if isinstance(resources, list):
+    response['resources'] = [project(r, projection) for r in resources]
+  elif isinstance(resources, dict):
+    for change in ('added', 'modified'):
+      resources[change] = [project(r, projection) for r in resources[change]]
+
+  return response
+
+
+def dumps_json(obj):
+  """Returns the compact JSON representation of 'obj'.
+
+  Uses the ujson encoder if it is installed, and the standard json encoder
+  otherwise. The keys of dictionaries are not sorted.
+  """
+  if ujson is not None:
+    return ujson.dumps(obj, escape_forward_slashes=False)
+  return _json_encoder.encode(obj)
+
+
+def gzip_compress(data):
+  """Returns the gzip-compressed 'data'.
+
+  The compressed data does not depend on the compression time, so equal
+  data is always compressed the same way.
+
+  Args:
+    data: a string or an iterable of strings, which are compressed one
+      after the other.
+  """
+  buf = cStringIO.StringIO()
+  f = gzip.GzipFile(fileobj=buf, mode='wb', mtime=0,
+                    compresslevel=constants.GZIP_COMPRESSION_LEVEL)
+  for chunk in ([data] if isinstance(data, str) else data):
+    f.write(chunk)
+  f.close()
+  return buf.getvalue()
+
+
+def iter_chunks(strings, chunk_size):
+  """Concatenates consecutive strings into chunks.
+
+  Args:
+    strings: an iterable of strings.
+    chunk_size: the approximate size of each chunk in bytes. A chunk may
+      exceed it by the size of one string.
+
+  Yields:
+  Consecutive chunks of the concatenation of 'strings'.
+  """
+  assert isinstance(chunk_size, int) and chunk_size > 0
+  parts = []
+  size = 0
+  for s in strings:
+    parts.append(s)
+    size += len(s)
+    if size >= chunk_size:
+      yield ''.join(parts)
+      parts = []
+      size = 0
+
+  if parts:
+    yield ''.join(parts)
+
+
+def iter_response_json(response, resource_json, chunk_size):
+  """Generates the JSON representation of a response in chunks.
+
+  The elements of the lists in the response, such as the resources and
+  relations of a context graph, are encoded one at a time, so the entire
+  representation is never kept in memory. The resources are encoded by
+  'resource_json', which usually returns a cached JSON fragment.
+
+  Args:
+    response: a response dictionary.
+    resource_json: a function from an element of the 'resources' list of
+      'response' to its JSON representation.
+    chunk_size: the approximate size of each chunk in bytes. A chunk may
+      exceed it by the size of one list element.
+
+  Yields:
+  Consecutive chunks of the JSON representation of 'response'. The keys of
+  'response' are sorted.
+  """
+  assert isinstance(response, dict)
+  assert isinstance(chunk_size, int) and chunk_size > 0
+  parts = ['{']
+  size = 1
+  for i, key in enumerate(sorted(response)):
+    value = response[key]
+    prefix = (', ' if i else '') + dumps_json(key) + ': '
+    if not isinstance(value, list):
+      parts.append(prefix + dumps_json(value))
+      size += len(parts[-1])
+      continue
+
+    encode = resource_json if key == 'resources' else dumps_json
+    parts.append(prefix + '[')
+    for j, element in enumerate(value):
+      parts.append((', ' if j else '') + encode(element))
+      size += len(parts[-1])
+      if size >= chunk_size:
+        yield ''.join(parts)
+        parts = []
+        size = 0
+    parts.append(']')
+
+  parts.append('}')
+  yield ''.join(parts)
+
+
 def make_response(value, attribute_name):
   """Makes the JSON response containing the given attribute name and value.
 
   Args:
-    value: the value associated with 'attribute_name'.
+    value: the value associated with 'attribute_name'. If it is a
+      TimestampedList, its maximal timestamp is used without scanning it.
     attribute_name: a string containing the attribute name.
 
   Returns:
     A dictionary containing a context-graph successful response with the given
-    attribute name and value.
+    attribute name and value. If 'value' is a list of wrapped objects, the
+    objects in the response have their timestamps in ISO 8601 format.
   """
   assert valid_string(attribute_name)
+  if isinstance(value, TimestampedList):
+    ts = value.max_timestamp()
+    ts = now() if ts is None else iso_timestamp(ts)
+    value = [with_iso_timestamp(x) for x in value]
   # Compute the maximum timestamp of the values in the list 'value'.
-  if (isinstance(value, list) and value and
-      all([is_wrapped_object(x) for x in value])):
+  elif (isinstance(value, list) and value and
+        all([is_wrapped_object(x) for x in value])):
     ts = value[0]['timestamp']  # we know that the list is not empty
     for x in value:
       if x['timestamp'] > ts:
         ts = x['timestamp']
+    ts = iso_timestamp(ts)
+    value = [with_iso_timestamp(x) for x in value]
   else:
     # 'value' is not a list or it does not contain wrapped objects.
     ts = now()
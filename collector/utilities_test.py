@@ -16,9 +16,13 @@
 
 """Tests for collector/utilities.py."""
 
+import copy
+import datetime
+import pickle
 import time
 import unittest
 
+import collector_error
 import utilities
 
 CONTAINER = {
@@ -61,6 +65,22 @@ PARENT_POD = {
 
 class TestUtilities(unittest.TestCase):
 
+  def test_seconds_to_timestamp(self):
+    """Tests seconds_to_timestamp() and with_iso_timestamp()."""
+    now = time.time()
+    for seconds in (now, now + 0.5, now + 0.9999999, float(int(now)),
+                    1432921372.217499):
+      self.assertEqual(datetime.datetime.fromtimestamp(seconds).isoformat(),
+                       utilities.seconds_to_timestamp(seconds))
+
+    wrapped = utilities.wrap_object({}, 'Node', 'aaa', now)
+    self.assertEqual(now, wrapped['timestamp'])
+    formatted = utilities.with_iso_timestamp(wrapped)
+    self.assertEqual(utilities.seconds_to_timestamp(now),
+                     formatted['timestamp'])
+    self.assertEqual(now, wrapped['timestamp'])
+    self.assertTrue(formatted is utilities.with_iso_timestamp(formatted))
+
   def test_timeless_json_hash(self):
     """Tests timeless_json_hash() with multiple similar and dissimilar objects.
     """
@@ -134,6 +154,82 @@ class TestUtilities(unittest.TestCase):
         utilities.timeless_json_hash(resp))
     self.assertEqual(CONTAINER['timestamp'], resp['timestamp'])
 
+  def test_timestamped_list(self):
+    """Tests TimestampedList."""
+    objs = utilities.TimestampedList()
+    self.assertTrue(objs.max_timestamp() is None)
+    objs.append(PARENT_POD)
+    objs.extend([CONTAINER])
+    max_timestamp = max(CONTAINER['timestamp'], PARENT_POD['timestamp'])
+    self.assertEqual(max_timestamp, objs.max_timestamp())
+
+    # Copies keep the maximal timestamp.
+    for objs_copy in (copy.deepcopy(objs), pickle.loads(pickle.dumps(objs))):
+      self.assertTrue(isinstance(objs_copy, utilities.TimestampedList))
+      self.assertEqual(objs, objs_copy)
+      self.assertEqual(max_timestamp, objs_copy.max_timestamp())
+
+    resp = utilities.make_response(objs, 'resources')
+    self.assertEqual(max_timestamp, resp['timestamp'])
+
+  def test_ring_buffer(self):
+    """Tests RingBuffer."""
+    buf = utilities.RingBuffer(3)
+    self.assertEqual(([], 0, 0), buf.snapshot())
+    buf.append('a')
+    buf.append('b')
+    self.assertEqual((['a', 'b'], 0, 2), buf.snapshot())
+    self.assertEqual((['b'], 1, 2), buf.snapshot(1))
+
+    # The oldest items are overwritten, and the items wrap around.
+    buf.append('c')
+    buf.append('d')
+    self.assertEqual((['b', 'c', 'd'], 1, 4), buf.snapshot())
+    self.assertEqual((['c', 'd'], 2, 4), buf.snapshot(2))
+    buf.append('e')
+    self.assertEqual((['c', 'd', 'e'], 2, 5), buf.snapshot(1))
+    self.assertEqual(([], 5, 5), buf.snapshot(5))
+    self.assertEqual(([], 5, 5), buf.snapshot(7))
+
+  def test_project(self):
+    """Tests parse_fields() and project()."""
+    projection = utilities.parse_fields(
+        'id,properties.status.phase,properties.status.containerStatuses.image')
+    self.assertEqual(
+        {'id': 'guestbook-controller-14zj2',
+         'properties': {
+             'status': {
+                 'containerStatuses': [{'image': 'brendanburns/php-redis'}],
+                 'phase': 'Running'}}},
+        utilities.project(PARENT_POD, projection))
+
+    # Missing attributes are omitted.
+    self.assertEqual(
+        {'id': CONTAINER['id'], 'properties': {}},
+        utilities.project(CONTAINER, projection))
+
+    # A path selects the entire value even if a longer path shares its prefix.
+    self.assertEqual(
+        {'properties': None},
+        utilities.parse_fields('properties.status,properties'))
+    self.assertEqual(
+        {'properties': None},
+        utilities.parse_fields('properties,properties.status'))
+    self.assertEqual(PARENT_POD['properties'],
+                     utilities.project(PARENT_POD, {'properties': None})[
+                         'properties'])
+
+    for fields in ['', 'id,', 'properties..status']:
+      self.assertRaises(collector_error.CollectorError,
+                        utilities.parse_fields, fields)
+
+  def test_argument_checking(self):
+    """Tests that the tests run with argument checking enabled."""
+    self.assertTrue(utilities.CHECK_ARGUMENTS)
+    f = utilities.two_dict_args(lambda x, y: True)
+    self.assertTrue(f({'a': 1}, {'b': 2}))
+    self.assertRaises(AssertionError, f, {}, {'b': 2})
+
   def test_is_wrapped_object(self):
     """Tests is_wrapped_object()."""
     self.assertTrue(utilities.is_wrapped_object(CONTAINER, 'Container'))